@@ -1,45 +1,644 @@
 #!/usr/bin/env python3
 
 import argparse
+import csv
+import fnmatch
+import glob
+import hashlib
+import json
+import mmap
+import multiprocessing
 import os
-# DEFINE ALL FIND/REPLACE STRINGS HERE:
-replacements = {
-        'oldstring1': 'newstring1',
-        'oldstring2': 'newstring2',
-        'oldstring3': 'newstring3',
-        'oldstring4': 'newstring4',
-        'oldstring5': 'newstring5',
-        'oldstring6': 'newstring6'
-    }
-
-
-# DO NOT EDIT BELOW HERE:
+import re
+import shutil
+import sys
+
+# Bytes rewritten per regex pass, extended to the end of the line
+BLOCK_SIZE = 1024 * 1024
+
+# Files bigger than this are split on line boundaries into chunks of
+# this size that are rewritten in parallel
+CHUNK_SIZE = 64 * 1024 * 1024
+
+INDEX_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'BulkFindAndReplace', 'index.json')
+
+
+# Load the Find/Replace strings from a CSV (find,replace per row) or
+# YAML (a find: replace mapping, or a list of {find:, replace:}) file:
+def load_rules(path):
+    rules = {}
+    if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+        import yaml
+        with open(path) as raw:
+            loaded = yaml.safe_load(raw) or {}
+        if isinstance(loaded, dict):
+            pairs = loaded.items()
+        elif isinstance(loaded, list) and all(
+                isinstance(entry, dict) and 'find' in entry
+                and 'replace' in entry for entry in loaded):
+            pairs = [(entry['find'], entry['replace']) for entry in loaded]
+        else:
+            raise ValueError('{} must hold a find: replace mapping or a list '
+                             'of find/replace entries'.format(path))
+    else:
+        pairs = []
+        with open(path, newline='') as raw:
+            reader = csv.reader(raw)
+            for row in reader:
+                if not row or row[0].startswith('#'):
+                    continue
+                if len(row) != 2:
+                    raise ValueError(
+                        'Line {} of {} must have a find and a replace '
+                        'column: {}'.format(reader.line_num, path, ','.join(row)))
+                pairs.append(row)
+        if pairs and pairs[0] == ['find', 'replace']:
+            pairs = pairs[1:]
+
+    for find, replace in pairs:
+        find, replace = str(find), '' if replace is None else str(replace)
+        if not find:
+            raise ValueError('Empty find string in {}'.format(path))
+        if '\n' in find:
+            raise ValueError(
+                'Find strings must fit on one line: {!r}'.format(find))
+        if rules.get(find, replace) != replace:
+            raise ValueError('{!r} is replaced with both {!r} and {!r}'.format(
+                find, rules[find], replace))
+        rules[find] = replace
+    if not rules:
+        raise ValueError('No find/replace rules in {}'.format(path))
+    return rules
+
+
+def trie_pattern(node):
+    """Regex for a trie of bytes, longest match first.
+
+    Only one branch can start with the next byte, so matching follows a
+    single path down the trie instead of trying every rule at every
+    position.  A rule that ends part way down is an optional tail, tried
+    after the longer rules that continue past it.
+    """
+    end = b'' in node
+    branches = []
+    chars = []
+    for char in sorted(key for key in node if key):
+        child = node[char]
+        if list(child) == [b'']:
+            chars.append(re.escape(char))
+        else:
+            branches.append(re.escape(char) + trie_pattern(child))
+    if len(chars) == 1:
+        branches.append(chars[0])
+    elif chars:
+        branches.append(b'[' + b''.join(chars) + b']')
+    if not branches:
+        return b''
+    if len(branches) == 1 and not end:
+        return branches[0]
+    return b'(?:' + b'|'.join(branches) + (b')?' if end else b')')
+
+
+class Replacer:
+    """Every rule compiled into one regex, applied in a single pass.
+
+    At each position the longest find string that matches there is
+    replaced, and scanning resumes after it, so replaced text is never
+    matched again.  Works on UTF-8 bytes, so files are rewritten
+    without being decoded.
+
+    \w in a bytes regex only knows ASCII letters, so with word a block
+    holding anything else is decoded and matched with a str regex,
+    where a non-ASCII letter next to a match is part of the word too.
+    """
+    def __init__(self, rules, word=False):
+        self.rules = dict((find.encode('utf-8'), replace.encode('utf-8'))
+                          for find, replace in rules.items())
+        trie = {}
+        for find in self.rules:
+            node = trie
+            for index in range(len(find)):
+                node = node.setdefault(find[index:index + 1], {})
+            node[b''] = True
+        # Rules are numbered in sorted order, for the hits of a scan
+        self.finds = sorted(self.rules)
+        self.replacements = [self.rules[find] for find in self.finds]
+        self.ids = dict((find, rule) for rule, find in enumerate(self.finds))
+        pattern = trie_pattern(trie)
+        self.text_regex = None
+        if word:
+            pattern = rb'(?<!\w)(?:' + pattern + rb')(?!\w)'
+            self.text_regex = re.compile(r'(?<!\w)(?:{})(?!\w)'.format('|'.join(
+                re.escape(find) for find in sorted(rules, key=len, reverse=True))))
+            self.text_rules = rules
+        self.regex = re.compile(pattern)
+
+    def replace(self, data):
+        if self.text_regex is None or data.isascii():
+            return self.regex.sub(lambda match: self.rules[match.group()], data)
+        return self.text_regex.sub(
+            lambda match: self.text_rules[match.group()],
+            data.decode('utf-8', 'surrogateescape')).encode(
+                'utf-8', 'surrogateescape')
+
+    def matches(self, data):
+        """(offset, find) of every match in data, offsets in bytes"""
+        if self.text_regex is None or data.isascii():
+            for match in self.regex.finditer(data):
+                yield match.start(), match.group()
+            return
+        text = data.decode('utf-8', 'surrogateescape')
+        offset = last = 0
+        for match in self.text_regex.finditer(text):
+            offset += len(text[last:match.start()].encode(
+                'utf-8', 'surrogateescape'))
+            last = match.start()
+            yield offset, match.group().encode('utf-8')
+
+
+def rules_digest(rules, word):
+    """Hash of a rule set, changes whenever any rule does"""
+    return hashlib.sha1(json.dumps(
+        [sorted(rules.items()), word]).encode('utf-8')).hexdigest()
+
+
+def chunk_digest(digests):
+    """Digest of a file from the SHA-1 of each of its split_chunks(),
+    so the chunks can be hashed apart by the processes reading them"""
+    if len(digests) == 1:
+        return digests[0]
+    return hashlib.sha1(''.join(digests).encode('ascii')).hexdigest()
+
+
+def file_digest(path):
+    digests = []
+    with open(path, 'rb') as raw:
+        for start, end in split_chunks(path):
+            digest = hashlib.sha1()
+            raw.seek(start)
+            while start < end:
+                block = raw.read(min(BLOCK_SIZE, end - start))
+                digest.update(block)
+                start += len(block)
+            digests.append(digest.hexdigest())
+    return chunk_digest(digests)
+
+
+class Index:
+    """Size, mtime and content hash of every file last converted, and
+    the rule set it was converted with.
+
+    A file is unchanged if its size and mtime match, or if they do not
+    but its content hash still does.
+    """
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        try:
+            with open(path) as raw:
+                self.entries = json.load(raw)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def unchanged(self, path, rules):
+        entry = self.entries.get(os.path.abspath(path))
+        if not entry or entry['rules'] != rules \
+                or not os.path.exists(output_path(path)):
+            return False
+        stat = os.stat(path)
+        if [stat.st_size, stat.st_mtime] == [entry['size'], entry['mtime']]:
+            return True
+        if stat.st_size == entry['size'] \
+                and file_digest(path) == entry['digest']:
+            self.record(path, rules, entry['digest'])
+            return True
+        return False
+
+    def record(self, path, rules, digest):
+        stat = os.stat(path)
+        self.entries[os.path.abspath(path)] = dict(
+            size=stat.st_size, mtime=stat.st_mtime, digest=digest,
+            rules=rules)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as raw:
+            json.dump(self.entries, raw)
+        os.rename(tmp, self.path)
+
+
+def output_path(path):
+    input_file_name, file_ext = os.path.splitext(path)
+    return '{}_new{}'.format(input_file_name, file_ext)
+
+
+def converted_output(path):
+    """Whether path is the _new output of a file next to it"""
+    stem, ext = os.path.splitext(path)
+    return stem.endswith('_new') and os.path.isfile(stem[:-4] + ext)
+
+
+def find_files(args):
+    """Files to convert, leaving out earlier _new outputs"""
+    if args.file:
+        return [args.file]
+    if args.directory:
+        paths = []
+        for root, dirs, names in os.walk(args.directory):
+            paths.extend(os.path.join(root, name) for name in names
+                         if fnmatch.fnmatch(name, args.pattern))
+    else:
+        paths = glob.glob(args.glob, recursive=True)
+    return sorted(path for path in paths if os.path.isfile(path)
+                  and not converted_output(path))
+
+
+def split_chunks(path, chunk_size=None):
+    """(start, end) byte ranges of path, each ending at a newline"""
+    chunk_size = chunk_size or CHUNK_SIZE
+    size = os.path.getsize(path)
+    if size <= chunk_size:
+        return [(0, size)]
+    chunks = []
+    with open(path, 'rb') as raw, \
+            mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = 0
+        while start < size:
+            end = data.find(b'\n', min(start + chunk_size, size) - 1)
+            end = size if end == -1 else end + 1
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+# Each worker process compiles the rules once
+replacer = None
+
+
+def init_worker(rules, word):
+    global replacer
+    replacer = Replacer(rules, word)
+
+
+def blocks(data, start, end):
+    """(offset, bytes) of about BLOCK_SIZE from start to end of data,
+    each ending at a newline"""
+    position = start
+    while position < end:
+        stop = min(end, position + BLOCK_SIZE)
+        if stop < end:
+            newline = data.find(b'\n', stop - 1, end)
+            stop = end if newline == -1 else newline + 1
+        yield position, data[position:stop]
+        position = stop
+
+
+def convert_range(task):
+    """Rewrite bytes start to end of path into output, a block at a time.
+
+    Returns the task and the SHA-1 of the bytes read.
+    """
+    path, start, end, output = task
+    digest = hashlib.sha1()
+    with open(output, 'wb') as outfile:
+        if start == end:
+            return task, digest.hexdigest()
+        with open(path, 'rb') as raw, \
+                mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for position, block in blocks(data, start, end):
+                digest.update(block)
+                outfile.write(replacer.replace(block))
+    return task, digest.hexdigest()
+
+
+def scan_range(task):
+    """Matches from start to end of path, without rewriting anything.
+
+    Returns the task with a list of [offset, line, rule] hits, lines
+    counted from start, and the number of lines in the range.
+    """
+    path, start, end = task
+    hits = []
+    lines = 0
+    if start == end:
+        return task, hits, lines
+    with open(path, 'rb') as raw, \
+            mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for position, block in blocks(data, start, end):
+            last = 0
+            for offset, find in replacer.matches(block):
+                lines += block.count(b'\n', last, offset)
+                last = offset
+                hits.append([position + last, lines + 1, replacer.ids[find]])
+            lines += block.count(b'\n', last)
+    return task, hits, lines
+
+
+def apply_hits(task):
+    """Write output from path, replacing only the ranges in hits.
+
+    Returns the task and the digest of path, hashed from the same map.
+    """
+    path, hits, output = task
+    tmp = '{}.part'.format(output)
+    with open(path, 'rb') as raw, open(tmp, 'wb') as outfile:
+        if not os.fstat(raw.fileno()).st_size:
+            os.rename(tmp, output)
+            return task, hashlib.sha1().hexdigest()
+        with mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                memoryview(data) as view:
+            position = 0
+            for offset, line, rule in hits:
+                outfile.write(view[position:offset])
+                outfile.write(replacer.replacements[rule])
+                position = offset + len(replacer.finds[rule])
+            outfile.write(view[position:])
+            digest = chunk_digest([hashlib.sha1(view[start:end]).hexdigest()
+                                   for start, end in split_chunks(path)])
+    os.rename(tmp, output)
+    return task, digest
+
+
+def run_tasks(function, tasks, rules, word, jobs):
+    """Results of function over tasks, in a pool of jobs processes if
+    there is more than one task to share out"""
+    if jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(jobs, init_worker, (rules, word)) as pool:
+            yield from pool.imap_unordered(function, tasks)
+    else:
+        init_worker(rules, word)
+        yield from map(function, tasks)
+
+
+def convert_files(paths, rules, word, jobs):
+    """Convert every file in paths across a pool of jobs processes,
+    yielding (path, digest) as each is done.
+
+    Each file is written to a temporary file, or one per chunk for big
+    files, which are joined up and renamed into place once all are done.
+    """
+    tasks = []
+    parts = {}
+    for path in paths:
+        chunks = split_chunks(path)
+        parts[path] = []
+        for number, (start, end) in enumerate(chunks):
+            part = '{}.part{}'.format(output_path(path), number)
+            parts[path].append(part)
+            tasks.append((path, start, end, part))
+
+    remaining = dict((path, len(parts[path])) for path in paths)
+    digests = dict((path, {}) for path in paths)
+    for (path, start, end, part), digest in run_tasks(
+            convert_range, tasks, rules, word, jobs):
+        digests[path][start] = digest
+        remaining[path] -= 1
+        if remaining[path]:
+            continue
+        output = output_path(path)
+        if len(parts[path]) > 1:
+            with open(parts[path][0], 'ab') as joined:
+                for part in parts[path][1:]:
+                    with open(part, 'rb') as raw:
+                        shutil.copyfileobj(raw, joined, BLOCK_SIZE)
+                    os.remove(part)
+        os.rename(parts[path][0], output)
+        yield path, chunk_digest([digests[path][start]
+                                  for start in sorted(digests[path])])
+        del digests[path]
+
+
+def scan_files(paths, rules, word, jobs):
+    """(path, hits) for every file in paths, hits in file order with
+    line numbers counted from the start of the file"""
+    tasks = [(path, start, end) for path in paths
+             for start, end in split_chunks(path)]
+    chunks = dict((path, {}) for path in paths)
+    remaining = dict((path, 0) for path in paths)
+    for path, start, end in tasks:
+        remaining[path] += 1
+    for (path, start, end), hits, lines in run_tasks(
+            scan_range, tasks, rules, word, jobs):
+        chunks[path][start] = hits, lines
+        remaining[path] -= 1
+        if remaining[path]:
+            continue
+        found = []
+        before = 0
+        for start in sorted(chunks[path]):
+            hits, lines = chunks[path][start]
+            for hit in hits:
+                hit[1] += before
+            found.extend(hits)
+            before += lines
+        del chunks[path]
+        yield path, found
+
+
+class Hits:
+    """Every match of a rule set in a set of files, found by --scan.
+
+    Saved as JSON lines, a header with the rules followed by one line
+    per file scanned, with or without hits:
+
+        {"rules": <rules_digest>, "finds": [...], "counts": [...]}
+        {"path": ..., "size": ..., "mtime": ..., "hits": [[offset, line, rule]]}
+
+    where rule is an index into finds.  A file whose size or mtime has
+    changed since it was scanned is scanned again before it is applied.
+    """
+    def __init__(self, rules, word):
+        self.digest = rules_digest(rules, word)
+        # Numbered as Replacer numbers them
+        self.finds = sorted(find.encode('utf-8') for find in rules)
+        self.counts = [0] * len(self.finds)
+        self.files = {}
+
+    def add(self, path, hits):
+        stat = os.stat(path)
+        self.files[os.path.abspath(path)] = dict(
+            size=stat.st_size, mtime=stat.st_mtime, hits=hits)
+        for offset, line, rule in hits:
+            self.counts[rule] += 1
+
+    def stale(self):
+        """Files that have changed since they were scanned"""
+        stale = []
+        for path, entry in self.files.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append(path)
+                continue
+            if [stat.st_size, stat.st_mtime] != [entry['size'], entry['mtime']]:
+                stale.append(path)
+        return stale
+
+    def save(self, path):
+        with open(path, 'w') as raw:
+            raw.write(json.dumps(dict(
+                rules=self.digest, counts=self.counts,
+                finds=[find.decode('utf-8') for find in self.finds])) + '\n')
+            for name in sorted(self.files):
+                raw.write(json.dumps(dict(self.files[name], path=name)) + '\n')
+
+    @classmethod
+    def load(cls, path, rules, word):
+        hits = cls(rules, word)
+        with open(path) as raw:
+            header = json.loads(raw.readline())
+            if header['rules'] != hits.digest:
+                raise ValueError('{} was scanned with different rules or '
+                                 '--word'.format(path))
+            hits.counts = header['counts']
+            for line in raw:
+                entry = json.loads(line)
+                hits.files[entry.pop('path')] = entry
+        return hits
+
+
 # Collect User input from CLI:
 def check_cli_args():
     parser = argparse.ArgumentParser(
         description="Performs a Find/Replace All of multiple strings in an entire file")
 
+    files = parser.add_mutually_exclusive_group(required=True)
+    files.add_argument(
+        '-f', '--file', type=str, help='File to be converted'
+    )
+    files.add_argument(
+        '-d', '--directory', type=str,
+        help='Convert every file under this directory'
+    )
+    files.add_argument(
+        '-g', '--glob', type=str,
+        help='Convert every file matching this glob, ** matches directories'
+    )
+    files.add_argument(
+        '-a', '--apply', type=str,
+        help='Convert the files with hits in this file saved by --scan'
+    )
     parser.add_argument(
-        '-f', '--file', type=str, help='File to be converted', required=True
+        '-p', '--pattern', type=str, default='*',
+        help='Only convert files whose names match this in --directory'
+    )
+    parser.add_argument(
+        '-r', '--rules', type=str, required=True,
+        help='CSV (find,replace per line) or YAML file of strings to replace'
+    )
+    parser.add_argument(
+        '-w', '--word', action='store_true',
+        help='Only replace strings that are not part of a longer word'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='Number of processes to convert files with'
+    )
+    parser.add_argument(
+        '--index', type=str, default=INDEX_PATH,
+        help='Index of converted files used to skip unchanged ones'
+    )
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Convert every file even if it has not changed'
+    )
+    parser.add_argument(
+        '-s', '--scan', type=str,
+        help='Only count the hits of each rule, and save them to this file'
+    )
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='List the file and line of every hit found by --scan'
     )
 
     args = parser.parse_args()
+    if args.scan and args.apply:
+        parser.error('--scan and --apply can not be used together')
     return args
 
 
-# Find and replace all items in replacements dictionary and output to a new file:
+# Count the hits of every rule without writing any converted files:
+def scan(args, rules):
+    hits = Hits(rules, args.word)
+    paths = find_files(args)
+    for path, found in scan_files(paths, rules, args.word, args.jobs):
+        hits.add(path, found)
+        if args.verbose:
+            for offset, line, rule in found:
+                print('{}:{}: {}'.format(
+                    path, line, hits.finds[rule].decode('utf-8')))
+    hits.save(args.scan)
+
+    print(('{0}' * 40).format('*'))
+    for count, find in sorted(zip(hits.counts, hits.finds),
+                              key=lambda pair: -pair[0]):
+        find = find.decode('utf-8')
+        print('{:>10}  {} -> {}'.format(count, find, rules[find]))
+    print('{} hits in {} of {} files, saved to {}'.format(
+        sum(hits.counts), sum(1 for entry in hits.files.values()
+                              if entry['hits']), len(paths), args.scan))
+    print(('{0}' * 40).format('*'))
+
+
+# Rewrite only the ranges found by an earlier --scan, scanning files
+# that have changed since again:
+def apply(args, rules):
+    hits = Hits.load(args.apply, rules, args.word)
+    stale = hits.stale()
+    for path in stale:
+        del hits.files[path]
+    stale = [path for path in stale if os.path.isfile(path)]
+    for path, found in scan_files(stale, rules, args.word, args.jobs):
+        hits.add(path, found)
+
+    tasks = [(path, entry['hits'], output_path(path))
+             for path, entry in sorted(hits.files.items()) if entry['hits']]
+    for (path, found, output), digest in run_tasks(
+            apply_hits, tasks, rules, args.word, args.jobs):
+        yield path, digest
+
+
+# Find and replace all rules in one pass over each file and output to
+# a new file, skipping files unchanged since they were last converted:
 def main():
     args = check_cli_args()
-    input_file_name, file_ext = os.path.splitext(args.file)
-    output_file_name = '{}_new{}'.format(input_file_name, file_ext)
-
-    with open(args.config) as infile, open(output_file_name, 'w') as outfile:
-        for line in infile:
-            for src, target in replacements.items():
-                line = line.replace(src, target)
-            outfile.write(line)
+    try:
+        rules = load_rules(args.rules)
+    except ValueError as error:
+        sys.exit(error)
+    digest = rules_digest(rules, args.word)
+    if args.scan:
+        scan(args, rules)
+        return
+    index = Index(args.index)
+
+    if args.apply:
+        paths = pending = []
+        files = apply(args, rules)
+    else:
+        paths = find_files(args)
+        pending = [path for path in paths
+                   if args.force or not index.unchanged(path, digest)]
+        files = convert_files(pending, rules, args.word, args.jobs)
+    converted = []
+    try:
+        for path, content in files:
+            index.record(path, digest, content)
+            converted.append(path)
+    finally:
+        index.save()
+
     print(('{0}' * 40).format('*'))
-    print('Converted Configuration output saved to {}'.format(output_file_name))
+    if args.file:
+        print('{} Configuration output saved to {}'.format(
+            'Converted' if converted else 'Unchanged', output_path(args.file)))
+    else:
+        print('Converted {} files, skipped {} unchanged'.format(
+            len(converted), len(paths) - len(pending)))
     print(('{0}' * 40).format('*'))
 
-main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+"""Per flow statistics for a pcap file, decoded in bulk with NumPy.
+
+The file is memory-mapped, and the records are found by walking every
+thousand or so of them at once, a record per step.  Every header field is then
+gathered for all packets at once into NumPy arrays, and each statistic
+is computed over whole arrays, grouped by flow.  A flow is one
+direction of a conversation, so a TCP connection is two flows.
+
+For TCP flows, a data segment whose sequence number was already seen in
+the flow is a retransmission.  One that starts below the highest byte
+seen so far but was not seen before arrived out of order, or was lost
+before the capture point and resent.  RTT is the time from a data
+segment to the first ACK from the other side that covers it, leaving
+out retransmitted segments (Karn's algorithm).  Windows are scaled by
+the window scale both sides sent in their SYNs, when both SYNs were
+captured.
+"""
+
+import csv
+import gzip
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from capture import (
+    PCAP_MAGIC, PCAP_HEADER_SIZE, RECORD_HEADER_SIZE, LINKTYPE_NULL,
+    LINKTYPE_ETHERNET, LINKTYPE_RAW, LINKTYPE_LINUX_SLL, LINKTYPE_LINUX_SLL2,
+    pair_key)
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+# Records are walked a record at a time for the first SAMPLE_SIZE bytes,
+# then in segments of about SEGMENT_RECORDS records, each from the first
+# of its first SEARCH_SIZE bytes where SEARCH_RECORDS records in a row
+# look right, looked for SEARCH_BATCH segments at a time
+SAMPLE_SIZE = 1 << 16
+SEGMENT_RECORDS = 1024
+SEARCH_SIZE = 4096
+SEARCH_RECORDS = 3
+SEARCH_BATCH = 1024
+# Keeps the sequence numbers of each flow apart when the flows are
+# laid end to end, so one cumulative max runs over all of them
+FLOW_SPAN = 1 << 40
+
+COUNTS = set([
+    'packets', 'bytes', 'data_packets', 'retransmissions', 'out_of_order',
+    'rtt_samples', 'window_scale', 'window_min', 'window_max',
+])
+
+COLUMNS = [
+    'src', 'dst', 'sport', 'dport', 'proto', 'packets', 'bytes', 'start',
+    'end', 'duration', 'throughput_bps', 'peak_bps', 'data_packets',
+    'retransmissions', 'out_of_order', 'rtt_samples', 'rtt_min_ms',
+    'rtt_median_ms', 'rtt_p95_ms', 'rtt_max_ms', 'window_scale',
+    'window_min', 'window_mean', 'window_max',
+]
+
+
+def load(path):
+    """The bytes of a pcap file, memory-mapped unless it is gzipped"""
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as raw:
+            return np.frombuffer(raw.read(), dtype=np.uint8)
+    with open(path, 'rb') as raw:
+        data = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def walk_records(buffer, byte_order, position, stop):
+    """Offsets of the complete records from position, one at a time, up
+    to stop.  Also returns where the walk left off, the start of the
+    first record at or after stop, or the end of buffer once the
+    records run out."""
+    length = struct.Struct(byte_order + 'I').unpack_from
+    data = buffer.data
+    size = len(buffer)
+    position, stop = int(position), int(stop)
+    offsets = []
+    append = offsets.append
+    while position < stop:
+        if position + RECORD_HEADER_SIZE > size:
+            position = size
+            break
+        end = position + RECORD_HEADER_SIZE + length(data, position + 8)[0]
+        if end > size:
+            position = size
+            break
+        append(position)
+        position = end
+    return np.array(offsets, dtype=np.int64), position
+
+
+def plausible(buffer, positions, little, snaplen, resolution):
+    """Which of positions hold something that could be a record header"""
+    fraction = field(buffer, positions + 4, 4, little)
+    captured = field(buffer, positions + 8, 4, little)
+    length = field(buffer, positions + 12, 4, little)
+    return ((positions + RECORD_HEADER_SIZE + captured <= len(buffer)) &
+            (captured > 0) & (captured <= length) & (captured <= snaplen) &
+            (fraction < resolution))
+
+
+def first_records(buffer, starts, window, little, snaplen, resolution):
+    """Where SEARCH_RECORDS plausible records in a row first start within
+    window bytes of each of starts, or starts itself where they do not"""
+    found = starts.copy()
+    for first in range(0, len(starts), SEARCH_BATCH):
+        candidates = (starts[first:first + SEARCH_BATCH, None] +
+                      np.arange(window)).ravel()
+        candidates = candidates[plausible(
+            buffer, candidates, little, snaplen, resolution)]
+        ahead = candidates
+        for step in range(SEARCH_RECORDS - 1):
+            ahead = ahead + RECORD_HEADER_SIZE + field(
+                buffer, ahead + 8, 4, little)
+            keep = plausible(buffer, ahead, little, snaplen, resolution)
+            candidates, ahead = candidates[keep], ahead[keep]
+        segments, index = np.unique(
+            np.searchsorted(starts, candidates, 'right') - 1,
+            return_index=True)
+        found[segments] = candidates[index]
+    return found
+
+
+def record_offsets(buffer, byte_order):
+    """Offset of every complete record.
+
+    Each record only says where the next one starts, so past the first
+    SAMPLE_SIZE bytes the file is cut into segments of about
+    SEGMENT_RECORDS records, each walked from the first place in it
+    that looks like a run of records, a record per step for all of them
+    at once.  A walk is kept from where the one before it left off, if
+    it passed there, otherwise that segment is walked again a record at
+    a time.
+    """
+    size = len(buffer)
+    sample, position = walk_records(
+        buffer, byte_order, PCAP_HEADER_SIZE, PCAP_HEADER_SIZE + SAMPLE_SIZE)
+    if len(sample) < 2:
+        return np.concatenate([sample, walk_records(
+            buffer, byte_order, position, size)[0]])
+    spans = np.diff(np.append(sample, position))
+    segment_size = int(spans.mean() * SEGMENT_RECORDS)
+    count = (size - position) // segment_size
+    if count < 2:
+        return np.concatenate([sample, walk_records(
+            buffer, byte_order, position, size)[0]])
+    little = byte_order == '<'
+    resolution = PCAP_MAGIC[bytes(buffer[:4])][1]
+    snaplen = int(field(buffer, np.array([16]), 4, little)[0]) or 1 << 32
+    bounds = position + segment_size * np.arange(count + 1, dtype=np.int64)
+    bounds[-1] = size
+    window = int(min(2 * spans.max(), SEARCH_SIZE, segment_size))
+    starts = first_records(
+        buffer, bounds[:-1], window, little, snaplen, resolution)
+    starts[0] = position
+
+    # Every walk stays within its segment, so sorting what they found
+    # also sorts it by segment
+    walker = np.arange(count)
+    left_off = np.full(count, size, dtype=np.int64)
+    found = []
+    position = starts
+    while walker.size:
+        end = position + RECORD_HEADER_SIZE + field(
+            buffer, position + 8, 4, little)
+        whole = (position + RECORD_HEADER_SIZE <= size) & (end <= size)
+        found.append(position[whole])
+        position, walker = end[whole], walker[whole]
+        out = position >= bounds[walker + 1]
+        left_off[walker[out]] = position[out]
+        position, walker = position[~out], walker[~out]
+
+    found = np.sort(np.concatenate(found))
+    first = np.searchsorted(found, bounds)
+    pieces = [sample]
+    position = bounds[0]
+    for segment in range(count):
+        if position >= bounds[segment + 1]:
+            continue
+        walked = found[first[segment]:first[segment + 1]]
+        at = np.searchsorted(walked, position)
+        if at < len(walked) and walked[at] == position:
+            pieces.append(walked[at:])
+            position = left_off[segment]
+        else:
+            piece, position = walk_records(
+                buffer, byte_order, position, bounds[segment + 1])
+            pieces.append(piece)
+    return np.concatenate(pieces)
+
+
+def field(buffer, positions, size, little=False):
+    """Unsigned integers of size bytes at each of positions.
+
+    Gathered through a view of buffer with an integer starting at every
+    byte, so each field takes a single pass however wide it is.
+    """
+    dtype = np.dtype('{}u{}'.format('<' if little else '>', size))
+    view = np.ndarray((len(buffer) - size + 1,), dtype, buffer, strides=(1,))
+    return view[np.minimum(positions, len(view) - 1)].astype(np.int64)
+
+
+def decode(buffer):
+    """Arrays of the IPv4 header fields of every IPv4 packet in buffer,
+    and of the TCP or UDP fields where there are any"""
+    magic = bytes(buffer[:4])
+    if len(buffer) < PCAP_HEADER_SIZE or magic not in PCAP_MAGIC:
+        raise ValueError('Not a PCAP file')
+    byte_order, resolution = PCAP_MAGIC[magic]
+    little = byte_order == '<'
+    linktype = int(field(buffer, np.array([20]), 4, little)[0]) & 0xffff
+
+    # Neighbouring fields are gathered together and split afterwards
+    offsets = record_offsets(buffer, byte_order)
+    stamp = field(buffer, offsets, 8, little)
+    lengths = field(buffer, offsets + 8, 8, little)
+    if little:
+        seconds, fraction = stamp & 0xffffffff, stamp >> 32 & 0xffffffff
+        captured, length = lengths & 0xffffffff, lengths >> 32 & 0xffffffff
+    else:
+        seconds, fraction = stamp >> 32 & 0xffffffff, stamp & 0xffffffff
+        captured, length = lengths >> 32 & 0xffffffff, lengths & 0xffffffff
+    time = seconds + fraction / resolution
+    data = offsets + RECORD_HEADER_SIZE
+    end = data + captured
+
+    if linktype == LINKTYPE_ETHERNET:
+        ip = data + 14
+        ethertype = field(buffer, data + 12, 2)
+        for tag in range(2):
+            vlan = np.isin(ethertype, (0x8100, 0x88a8, 0x9100))
+            ethertype = np.where(vlan, field(buffer, ip + 2, 2), ethertype)
+            ip = np.where(vlan, ip + 4, ip)
+        is_ip = ethertype == 0x0800
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ip = data + 16
+        is_ip = field(buffer, data + 14, 2) == 0x0800
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ip = data + 20
+        is_ip = field(buffer, data, 2) == 0x0800
+    elif linktype in LINKTYPE_RAW or linktype == LINKTYPE_NULL:
+        ip = data + (4 if linktype == LINKTYPE_NULL else 0)
+        is_ip = field(buffer, ip, 1) >> 4 == 4
+    else:
+        raise ValueError('Unsupported link type {}'.format(linktype))
+    is_ip &= ip + 20 <= end
+
+    ip, end = ip[is_ip], end[is_ip]
+    packets = dict(time=time[is_ip], length=length[is_ip])
+    first = field(buffer, ip, 4)
+    header_length = (first >> 24 & 0x0f) * 4
+    total_length = first & 0xffff
+    packets['proto'] = proto = field(buffer, ip + 9, 1)
+    addresses = field(buffer, ip + 12, 8)
+    packets['src'] = addresses >> 32 & 0xffffffff
+    packets['dst'] = addresses & 0xffffffff
+
+    transport = ip + header_length
+    ports = field(buffer, transport, 4)
+    has_ports = np.isin(proto, (6, 17)) & (transport + 4 <= end)
+    packets['sport'] = np.where(has_ports, ports >> 16, 0)
+    packets['dport'] = np.where(has_ports, ports & 0xffff, 0)
+    packets['tcp'] = tcp = (proto == 6) & (transport + 20 <= end)
+    numbers = field(buffer, transport + 4, 8)
+    packets['seq'] = numbers >> 32 & 0xffffffff
+    packets['ack'] = numbers & 0xffffffff
+    control = field(buffer, transport + 12, 4)
+    tcp_length = (control >> 28 & 0x0f) * 4
+    packets['flags'] = np.where(tcp, control >> 16 & 0xff, 0)
+    packets['window'] = control & 0xffff
+    packets['payload'] = np.where(
+        tcp, np.maximum(total_length - header_length - tcp_length, 0), 0)
+    # Only SYNs carry a window scale, and there are few enough of them
+    # to read their options one at a time
+    packets['window_scale'] = np.full(len(ip), -1, dtype=np.int64)
+    for number in np.flatnonzero(tcp & (packets['flags'] & TCP_SYN > 0)):
+        start = transport[number] + 20
+        scale = window_scale(bytes(buffer[
+            start:min(transport[number] + tcp_length[number], end[number])]))
+        if scale is not None:
+            packets['window_scale'][number] = scale
+    return packets
+
+
+def select_pairs(packets, pairs):
+    """Only the packets between one of pairs of addresses"""
+    wanted = [int.from_bytes(low + high, 'big')
+              for low, high in (pair_key(*pair) for pair in pairs)]
+    key = (np.minimum(packets['src'], packets['dst']).astype(np.uint64)
+           << np.uint64(32)) | np.maximum(packets['src'],
+                                          packets['dst']).astype(np.uint64)
+    keep = np.isin(key, np.array(wanted, dtype=np.uint64))
+    return dict((name, values[keep]) for name, values in packets.items())
+
+
+def window_scale(options):
+    """The window scale in a SYN's TCP options, or None"""
+    index = 0
+    while index < len(options):
+        kind = options[index]
+        if kind == 0:
+            break
+        if kind == 1:
+            index += 1
+            continue
+        if index + 1 >= len(options) or options[index + 1] < 2:
+            break
+        if kind == 3 and options[index + 1] == 3 and index + 2 < len(options):
+            return min(options[index + 2], 14)
+        index += options[index + 1]
+    return None
+
+
+def group_quantiles(groups, values, count, quantiles):
+    """Nearest rank quantiles of values for each of count groups, NaN
+    for groups without any values.  The q quantile of n values is the
+    ceil(q * n)'th smallest, as metrics.quantile_of in run_cli has it.
+
+    >>> median, p95 = group_quantiles(np.array([0, 0, 0, 2]),
+    ...     np.array([30.0, 10.0, 20.0, 5.0]), 3, [0.5, 0.95])
+    >>> [float(value) for value in median], [float(value) for value in p95]
+    ([20.0, nan, 5.0], [30.0, nan, 5.0])
+    """
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    starts = np.searchsorted(groups, np.arange(count))
+    sizes = np.bincount(groups, minlength=count)
+    results = []
+    for quantile in quantiles:
+        rank = np.ceil(quantile * sizes).astype(np.int64) - 1
+        index = starts + np.clip(rank, 0, np.maximum(sizes - 1, 0))
+        index = np.minimum(index, max(len(values) - 1, 0))
+        results.append(np.where(sizes > 0, values[index] if len(values)
+                                else np.nan, np.nan))
+    return results
+
+
+def by_flow(flow, time):
+    """Order of packets by flow, and by time within each flow.  A stable
+    sort on flow is enough when the capture is in time order."""
+    if np.all(time[1:] >= time[:-1]):
+        return np.argsort(flow, kind='stable')
+    return np.lexsort((time, flow))
+
+
+def relative(numbers, base):
+    """32 bit sequence numbers relative to base, negative if before it"""
+    offset = (numbers - base) % (1 << 32)
+    return np.where(offset >= 1 << 31, offset - (1 << 32), offset)
+
+
+def analyze(packets, interval=1.0):
+    """Statistics for every flow in packets, a dict per flow"""
+    count = len(packets['time'])
+    if not count:
+        return []
+    # Number the flows by their addresses, then by ports and protocol
+    addresses = np.unique(packets['src'] << 32 | packets['dst'],
+                          return_inverse=True)[1].reshape(-1)
+    ports = np.unique(packets['sport'] << 24 | packets['dport'] << 8
+                      | packets['proto'], return_inverse=True)[1].reshape(-1)
+    first, flow = np.unique(addresses * (ports.max() + 1) + ports,
+                            return_index=True, return_inverse=True)[1:]
+    flow = flow.reshape(-1)
+    flows = len(first)
+    src, dst = packets['src'][first], packets['dst'][first]
+    sport, dport = packets['sport'][first], packets['dport'][first]
+    proto = packets['proto'][first]
+    index = dict(((int(src[number]), int(dst[number]), sport[number],
+                   dport[number], proto[number]), number)
+                 for number in range(flows))
+    reverse = np.array([
+        index.get((int(dst[number]), int(src[number]), dport[number],
+                   sport[number], proto[number]), -1)
+        for number in range(flows)], dtype=np.int64)
+
+    time, length = packets['time'], packets['length']
+    stats = dict(
+        packets=np.bincount(flow, minlength=flows),
+        bytes=np.bincount(flow, weights=length, minlength=flows),
+        start=np.full(flows, np.inf), end=np.full(flows, -np.inf))
+    np.minimum.at(stats['start'], flow, time)
+    np.maximum.at(stats['end'], flow, time)
+    stats['duration'] = stats['end'] - stats['start']
+    stats['throughput_bps'] = np.where(
+        stats['duration'] > 0,
+        stats['bytes'] * 8 / np.maximum(stats['duration'], 1e-9), 0)
+
+    # Throughput over time, in bits per second per interval
+    first = time.min()
+    bins = ((time - first) // interval).astype(np.int64)
+    width = int(bins.max()) + 1
+    series = np.bincount(flow * width + bins, weights=length,
+                         minlength=flows * width).reshape(flows, width)
+    series *= 8 / interval
+    stats['peak_bps'] = series.max(axis=1)
+
+    stats.update(tcp_stats(packets, flow, flows, reverse))
+    records = []
+    for number in range(flows):
+        record = dict(
+            src=str_ip(src[number]), dst=str_ip(dst[number]),
+            sport=int(sport[number]), dport=int(dport[number]),
+            proto=int(proto[number]))
+        for name, values in stats.items():
+            value = values[number].item()
+            if value != value:
+                value = None
+            elif name in COUNTS:
+                value = int(value)
+            record[name] = value
+        start = int((stats['start'][number] - first) // interval)
+        end = int((stats['end'][number] - first) // interval)
+        record['series'] = dict(
+            start=first + start * interval, interval=interval,
+            bps=series[number, start:end + 1].tolist())
+        records.append(record)
+    return records
+
+
+def tcp_stats(packets, flow, flows, reverse):
+    """Retransmissions, out of order segments, RTT and windows per flow"""
+    tcp = packets['tcp']
+    time = packets['time'][tcp]
+    flow = flow[tcp]
+    seq, ack = packets['seq'][tcp], packets['ack'][tcp]
+    flags, payload = packets['flags'][tcp], packets['payload'][tcp]
+    order = by_flow(flow, time)
+    time, flow, seq, ack = time[order], flow[order], seq[order], ack[order]
+    flags, payload = flags[order], payload[order]
+    window = packets['window'][tcp][order]
+
+    # Sequence numbers relative to the first one seen in each flow
+    starts = np.ones(len(flow), dtype=bool)
+    starts[1:] = flow[1:] != flow[:-1]
+    base = np.zeros(flows, dtype=np.int64)
+    base[flow[starts]] = seq[starts]
+    seq = relative(seq, base[flow])
+    seq_end = seq + payload + (flags & (TCP_SYN | TCP_FIN) > 0)
+    data = payload > 0
+
+    # Highest byte seen in the flow before each packet
+    spread = seq_end + (1 << 32) + flow * FLOW_SPAN
+    highest = np.maximum.accumulate(spread)
+    expected = np.empty_like(highest)
+    expected[1:] = highest[:-1]
+    expected[starts] = flow[starts] * FLOW_SPAN
+    expected -= (1 << 32) + flow * FLOW_SPAN
+
+    # Data segments whose sequence number was seen before
+    by_seq = np.argsort(seq + (1 << 32) + flow * FLOW_SPAN, kind='stable')
+    same = np.zeros(len(flow), dtype=bool)
+    same[1:] = (flow[by_seq][1:] == flow[by_seq][:-1]) \
+        & (seq[by_seq][1:] == seq[by_seq][:-1]) \
+        & data[by_seq][1:] & data[by_seq][:-1]
+    repeated = np.zeros(len(flow), dtype=bool)
+    repeated[by_seq] = same
+    resent = np.zeros(len(flow), dtype=bool)
+    resent[by_seq[1:][same[1:]]] = True
+    resent[by_seq[:-1][same[1:]]] = True
+    out_of_order = data & ~repeated & (seq < expected) \
+        & (expected > -(1 << 32))
+
+    # RTT from each data segment to the first ACK that covers it
+    acked = reverse[flow]
+    acks = (flags & TCP_ACK > 0) & (acked >= 0)
+    ack_flow = acked[acks]
+    ack_time = time[acks]
+    ack_seq = relative(ack[acks], base[ack_flow])
+    by_ack = np.argsort(ack_flow, kind='stable')
+    ack_flow, ack_time = ack_flow[by_ack], ack_time[by_ack]
+    covered = np.maximum.accumulate(
+        ack_seq[by_ack] + (1 << 32) + ack_flow * FLOW_SPAN)
+    samples = data & ~resent
+    wanted = seq_end[samples] + (1 << 32) + flow[samples] * FLOW_SPAN
+    found = np.searchsorted(covered, wanted)
+    valid = found < len(covered)
+    found = np.minimum(found, max(len(covered) - 1, 0))
+    if len(covered):
+        valid &= (ack_flow[found] == flow[samples]) \
+            & (ack_time[found] >= time[samples])
+        rtt = (ack_time[found] - time[samples])[valid] * 1000
+    else:
+        rtt = np.zeros(0)
+    rtt_flow = flow[samples][valid]
+
+    # Window scale applies when both SYNs carried one
+    scale = np.full(flows, -1, dtype=np.int64)
+    np.maximum.at(scale, flow, packets['window_scale'][tcp][order])
+    both = (scale >= 0) & (reverse >= 0) & (scale[reverse] >= 0)
+    scale = np.where(both, scale, 0)
+    window = np.where(flags & TCP_SYN > 0, window, window << scale[flow])
+
+    stats = dict(
+        data_packets=np.bincount(flow, weights=data, minlength=flows),
+        retransmissions=np.bincount(flow, weights=repeated,
+                                    minlength=flows),
+        out_of_order=np.bincount(flow, weights=out_of_order,
+                                 minlength=flows),
+        rtt_samples=np.bincount(rtt_flow, minlength=flows),
+        window_scale=np.where(both, scale, np.nan),
+    )
+    (stats['rtt_min_ms'], stats['rtt_median_ms'], stats['rtt_p95_ms'],
+     stats['rtt_max_ms']) = group_quantiles(
+         rtt_flow, rtt, flows, (0, 0.5, 0.95, 1))
+    packets_in = np.bincount(flow, minlength=flows)
+    stats['window_min'], stats['window_max'] = group_quantiles(
+        flow, window, flows, (0, 1))
+    stats['window_mean'] = np.where(
+        packets_in > 0, np.bincount(flow, weights=window, minlength=flows)
+        / np.maximum(packets_in, 1), np.nan)
+    is_tcp = np.zeros(flows, dtype=bool)
+    is_tcp[flow] = True
+    for name, values in stats.items():
+        stats[name] = np.where(is_tcp, values, np.nan)
+    return stats
+
+
+def str_ip(address):
+    return '.'.join(str(int(address) >> shift & 0xff)
+                    for shift in (24, 16, 8, 0))
+
+
+def write_report(records, output, format='json', path=None):
+    """Write the flow records to output as JSON, or CSV without the
+    throughput series"""
+    if format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(COLUMNS)
+        for record in records:
+            writer.writerow(['' if record[column] is None else record[column]
+                             for column in COLUMNS])
+    else:
+        json.dump(dict(file=path, flows=records), output, indent=2)
+        output.write('\n')
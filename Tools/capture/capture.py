@@ -1,8 +1,35 @@
 #!/usr/bin/env python3
 
 import argparse
-import os
 import datetime
+import gzip
+import ipaddress
+import os
+import queue
+import re
+import shutil
+import struct
+import subprocess
+import threading
+
+# pcap magic numbers as they appear on disk, and the byte order and
+# timestamp resolution they stand for
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1000000000),
+    b'\xa1\xb2\x3c\x4d': ('>', 1000000000),
+}
+PCAP_HEADER_SIZE = 24
+RECORD_HEADER_SIZE = 16
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101, 228)
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+ETHERTYPE_IPV4 = b'\x08\x00'
+ETHERTYPE_VLAN = (b'\x81\x00', b'\x88\xa8', b'\x91\x00')
 
 
 def get_cli_args():
@@ -10,52 +37,443 @@ def get_cli_args():
         description="Creates a bi-directional TCP dump for 2 addresses for a specified number of packets"
     )
     parser.add_argument(
-        '-1', '--ip1', type=str, help='First IP address to capture', required=True
+        '-1', '--ip1', type=str, help='First IP address to capture', required=False
     )
     parser.add_argument(
-        '-2', '--ip2', type=str, help='Second IP address to capture', required=True
+        '-2', '--ip2', type=str, help='Second IP address to capture', required=False
     )
     parser.add_argument(
-        '-c', '--count', type=int, help='Number of Packets to capture', required=True
+        '-p', '--pair', type=str, action='append', default=[],
+        help='Pair of IP addresses to capture as ip1,ip2, may be repeated'
+    )
+    parser.add_argument(
+        '-P', '--pair_file', type=str,
+        help='File with a pair of IP addresses to capture on each line'
+    )
+    parser.add_argument(
+        '-c', '--count', type=int, help='Number of Packets to capture', required=False
     )
     parser.add_argument(
         '-f', '--file', action='store_true', help='Outputs to PCAP File', required=False
     )
+    parser.add_argument(
+        '-i', '--interface', type=str, default='eth0', help='Interface to capture on'
+    )
+    parser.add_argument(
+        '-r', '--ring', type=str,
+        help='Directory to write a rotating ring of PCAP files to, until stopped'
+    )
+    parser.add_argument(
+        '--read', type=str,
+        help='Feed this recorded PCAP file through the ring, or -f, instead of capturing'
+    )
+    parser.add_argument(
+        '--size', type=float, default=100,
+        help='Megabytes per PCAP file in the ring before starting the next one'
+    )
+    parser.add_argument(
+        '--seconds', type=float, default=0,
+        help='Seconds of packets per PCAP file in the ring, 0 for no limit'
+    )
+    parser.add_argument(
+        '--files', type=int, default=10,
+        help='PCAP files kept in the ring, the oldest are deleted, 0 keeps all'
+    )
+    parser.add_argument(
+        '--no_compress', action='store_true',
+        help='Leave rotated PCAP files in the ring uncompressed'
+    )
+    parser.add_argument(
+        '-a', '--analyze', type=str,
+        help='Summarize the flows in this PCAP file, between the pairs if given'
+    )
+    parser.add_argument(
+        '--interval', type=float, default=1.0,
+        help='Seconds per throughput sample when analyzing'
+    )
+    parser.add_argument(
+        '--format', type=str, choices=['json', 'csv'], default='json',
+        help='Format of the analysis, CSV leaves out throughput over time'
+    )
+    parser.add_argument(
+        '-o', '--output', type=str,
+        help='File to write the analysis to, instead of the screen'
+    )
     args = parser.parse_args()
-    if not (args.ip1 and args.ip2 and args.count):
+    try:
+        args.pairs = read_pairs(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.read and (args.analyze or not (args.ring or args.file)):
+        parser.error('--read needs --ring or -f to write the pairs to, '
+                     'and can not be used with --analyze')
+    if not (args.analyze or args.pairs and (args.count or args.ring or args.read)):
         print(('{0}' * 50).format('*'))
-        print('Must specify First IP, Second IP, and Packet Count')
+        print('Must specify First IP and Second IP or pairs of IPs, and Packet Count')
         print(('{0}' * 50).format('*'))
         parser.print_help()
         os.sys.exit(1)
     return args
 
 
+def read_pairs(args):
+    """(ip1, ip2) pairs from --ip1/--ip2, --pair and --pair_file"""
+    entries = list(args.pair)
+    if args.ip1 or args.ip2:
+        entries.insert(0, '{},{}'.format(args.ip1, args.ip2))
+    if args.pair_file:
+        with open(args.pair_file) as raw:
+            entries.extend(line for line in raw
+                           if line.strip() and not line.startswith('#'))
+    pairs = {}
+    for entry in entries:
+        addresses = re.split(r'[\s,]+', entry.strip())
+        if len(addresses) != 2:
+            raise ValueError('Expected a pair of IPs: {}'.format(entry.strip()))
+        for address in addresses:
+            ipaddress.IPv4Address(address)
+        pairs.setdefault(pair_key(*addresses), tuple(addresses))
+    return list(pairs.values())
+
+
+def pair_key(ip1, ip2):
+    """The two addresses packed, lowest first, either way round"""
+    return tuple(sorted([ipaddress.IPv4Address(ip1).packed,
+                         ipaddress.IPv4Address(ip2).packed]))
+
+
+def capture_filter(args):
+    """One filter matching every pair, so a single tcpdump captures all"""
+    if len(args.pairs) == 1:
+        return 'ip host {} and ip host {}'.format(*args.pairs[0])
+    return ' or '.join('(ip host {} and ip host {})'.format(ip1, ip2)
+                       for ip1, ip2 in args.pairs)
+
+
+def ipv4_offset(linktype, record):
+    """Offset of the IPv4 header in a packet record, None if not IPv4"""
+    base = RECORD_HEADER_SIZE
+    if linktype == LINKTYPE_ETHERNET:
+        offset, ethertype = base + 14, record[base + 12:base + 14]
+        while ethertype in ETHERTYPE_VLAN:
+            ethertype = record[offset + 2:offset + 4]
+            offset += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        offset, ethertype = base + 16, record[base + 14:base + 16]
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        offset, ethertype = base + 20, record[base:base + 2]
+    elif linktype in LINKTYPE_RAW or linktype == LINKTYPE_NULL:
+        offset = base + (4 if linktype == LINKTYPE_NULL else 0)
+        is_ipv4 = len(record) > offset and record[offset] >> 4 == 4
+        return offset if is_ipv4 else None
+    else:
+        return None
+    return offset if ethertype == ETHERTYPE_IPV4 else None
+
+
+def read_exactly(stream, size):
+    """size bytes from stream, fewer only at the end of the stream"""
+    data = stream.read(size)
+    while data and len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+class PcapReader:
+    """Packets from a pcap stream, as they arrive.
+
+    Yields (timestamp, record) for each packet, where record is the
+    packet's header and data exactly as they were read, so they can be
+    written to another pcap file with the same header untouched.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.header = read_exactly(stream, PCAP_HEADER_SIZE)
+        if len(self.header) < PCAP_HEADER_SIZE \
+                or self.header[:4] not in PCAP_MAGIC:
+            raise ValueError('Not a PCAP stream')
+        byte_order, self.resolution = PCAP_MAGIC[self.header[:4]]
+        self.record_header = struct.Struct(byte_order + 'IIII')
+        self.linktype = struct.unpack(
+            byte_order + 'I', self.header[20:24])[0] & 0xffff
+
+    def __iter__(self):
+        while True:
+            header = read_exactly(self.stream, RECORD_HEADER_SIZE)
+            if len(header) < RECORD_HEADER_SIZE:
+                return
+            seconds, fraction, length, original = \
+                self.record_header.unpack(header)
+            data = read_exactly(self.stream, length)
+            if len(data) < length:
+                return
+            yield seconds + fraction / self.resolution, header + data
+
+
+class Compressor:
+    """Background thread that finishes the files rotated out of any
+    number of rings, so capturing never waits on them"""
+    def __init__(self):
+        self.rotated = queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, ring, path, keep):
+        self.rotated.put((ring, path, keep))
+
+    def run(self):
+        while True:
+            ring, path, keep = self.rotated.get()
+            if ring is None:
+                return
+            ring.finish(path, keep)
+
+    def close(self):
+        """Wait for every file put so far to be finished"""
+        self.rotated.put((None, None, None))
+        self.thread.join()
+
+
+class RingWriter:
+    """Writes packets to a ring of pcap files in directory.
+
+    A new file is started once the current one would grow past
+    max_bytes, or holds packets spanning more than max_seconds.  Files
+    are named after the time of their first packet.  Finished files are
+    gzipped by compressor, which rings can share, and once there are
+    more than max_files the oldest are deleted.
+    """
+    def __init__(self, directory, header, max_bytes, max_seconds=0,
+                 max_files=0, compress=True, prefix='TCPDUMP',
+                 compressor=None):
+        self.directory = directory
+        self.header = header
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.max_files = max_files
+        self.compress = compress
+        self.prefix = prefix
+        self.current = None
+        self.number = 0
+        self.packets = 0
+        self.bytes = 0
+        self.finished = []
+        self.own_compressor = compressor is None
+        self.compressor = compressor or Compressor()
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, timestamp, record):
+        if self.current and (
+                self.size + len(record) > self.max_bytes
+                or self.max_seconds
+                and timestamp - self.started >= self.max_seconds):
+            self.rotate()
+        if not self.current:
+            self.open(timestamp)
+        self.current.write(record)
+        self.size += len(record)
+        self.packets += 1
+        self.bytes += len(record)
+
+    def open(self, timestamp):
+        self.number += 1
+        self.started = timestamp
+        name = '{}_{}_{:05d}.pcap'.format(
+            self.prefix, datetime.datetime.fromtimestamp(timestamp).strftime(
+                '%Y-%m-%d-%H%M%S'), self.number)
+        self.path = os.path.join(self.directory, name)
+        self.current = open(self.path, 'wb')
+        self.current.write(self.header)
+        self.size = len(self.header)
+
+    def rotate(self, closing=False):
+        self.current.close()
+        self.current = None
+        # The next file to be written counts towards max_files
+        keep = self.max_files - (0 if closing else 1)
+        self.compressor.put(self, self.path, keep)
+
+    def finish(self, path, keep):
+        """Compress a rotated file and delete the oldest beyond keep"""
+        if self.compress:
+            with open(path, 'rb') as raw, \
+                    gzip.open(path + '.gz', 'wb') as compressed:
+                shutil.copyfileobj(raw, compressed)
+            os.remove(path)
+            path += '.gz'
+        self.finished.append(path)
+        while self.max_files and len(self.finished) > keep:
+            os.remove(self.finished.pop(0))
+
+    def close(self):
+        """Finish the current file, and wait for every file to be
+        compressed unless the compressor is shared"""
+        if self.current:
+            self.rotate(closing=True)
+        if self.own_compressor:
+            self.compressor.close()
+
+
+class Demultiplexer:
+    """Hands each packet to the output for its pair of addresses.
+
+    Costs one dict lookup per packet however many pairs there are, and
+    packets of no pair are dropped.
+    """
+    def __init__(self, linktype, outputs):
+        self.linktype = linktype
+        self.outputs = outputs
+
+    def write(self, timestamp, record):
+        offset = ipv4_offset(self.linktype, record)
+        if offset is None:
+            return
+        source = record[offset + 12:offset + 16]
+        destination = record[offset + 16:offset + 20]
+        output = self.outputs.get((source, destination)
+                                  if source < destination
+                                  else (destination, source))
+        if output:
+            output.write(timestamp, record)
+
+
+def pair_outputs(args, header, compressor):
+    """A RingWriter for each pair, a ring of its own under --ring or a
+    single file per pair with -f"""
+    outputs = {}
+    for ip1, ip2 in args.pairs:
+        if args.ring:
+            directory = args.ring
+            if len(args.pairs) > 1:
+                directory = os.path.join(args.ring, '{}_{}'.format(ip1, ip2))
+            output = RingWriter(
+                directory, header, int(args.size * 1000000), args.seconds,
+                args.files, not args.no_compress, compressor=compressor)
+        else:
+            output = RingWriter(
+                '.', header, float('inf'), compress=False,
+                prefix='TCPDUMP_{}_{}'.format(ip1, ip2), compressor=compressor)
+        outputs[pair_key(ip1, ip2)] = output
+    return outputs
+
+
+def stream_capture(args):
+    """Capture every pair with one tcpdump, splitting the packets into
+    pcap files per pair, until stopped or count is reached"""
+    if args.read:
+        tcpdump = None
+        stream = open(args.read, 'rb')
+    else:
+        command = ['tcpdump', '-i', args.interface, '-n', '-U', '-w', '-']
+        if args.count:
+            command += ['-c', str(args.count)]
+        tcpdump = subprocess.Popen(command + [capture_filter(args)],
+                                   stdout=subprocess.PIPE)
+        stream = tcpdump.stdout
+
+    compressor = Compressor()
+    outputs = {}
+    try:
+        try:
+            reader = PcapReader(stream)
+        except ValueError:
+            if tcpdump:
+                raise ValueError('TCPDUMP stopped before any packets were captured.')
+            raise ValueError('{} is not a PCAP file.'.format(args.read))
+        outputs = pair_outputs(args, reader.header, compressor)
+        demultiplexer = Demultiplexer(reader.linktype, outputs)
+        for timestamp, record in reader:
+            demultiplexer.write(timestamp, record)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if tcpdump:
+            tcpdump.terminate()
+            tcpdump.wait()
+        stream.close()
+        for output in outputs.values():
+            output.close()
+        compressor.close()
+    return list(outputs.values())
+
+
+def analyze_capture(args):
+    """Write per flow statistics of the --analyze PCAP file"""
+    import analyze
+    packets = analyze.decode(analyze.load(args.analyze))
+    if args.pairs:
+        packets = analyze.select_pairs(packets, args.pairs)
+    flows = analyze.analyze(packets, args.interval)
+    if args.output:
+        with open(args.output, 'w', newline='') as output:
+            analyze.write_report(flows, output, args.format, args.analyze)
+    else:
+        analyze.write_report(flows, os.sys.stdout, args.format, args.analyze)
+    return flows
+
+
 def main():
     cli_args = get_cli_args()
-    if not cli_args.file:
+    if cli_args.analyze:
+        flows = analyze_capture(cli_args)
+        if cli_args.output:
+            print(('{0}' * 50).format('*'))
+            print('Analysis of {} flows saved to {}'.format(
+                len(flows), cli_args.output))
+            print(('{0}' * 50).format('*'))
+    elif cli_args.ring or cli_args.read or cli_args.file and len(cli_args.pairs) > 1:
+        print(('{0}' * 50).format('*'))
+        print('Collecting TCPDUMP between {} into {}.''\n''Please initiate traffic between'
+              ' these addresses.''\n''Press Ctrl C to Terminate'.format(
+                  ', '.join('{} and {}'.format(*pair) for pair in cli_args.pairs),
+                  cli_args.ring or 'a PCAP file per pair'))
+        print(('{0}' * 50).format('*'))
+        try:
+            outputs = stream_capture(cli_args)
+        except ValueError as e:
+            print(('{0}' * 50).format('*'))
+            print(e)
+            print(('{0}' * 50).format('*'))
+            os.sys.exit(1)
+        print(('{0}' * 50).format('*'))
+        print('TCPDUMP Complete! {} packets, {} bytes, PCAP files kept:'.format(
+            sum(output.packets for output in outputs),
+            sum(output.bytes for output in outputs)))
+        for output in outputs:
+            for path in output.finished:
+                print(path)
+        print(('{0}' * 50).format('*'))
+    elif not cli_args.file:
         print(('{0}' * 50).format('*'))
-        print('Collecting TCPDUMP between {ip1} and {ip2} for {count} packets.''\n''Please initiate traffic between'
+        print('Collecting TCPDUMP between {} for {} packets.''\n''Please initiate traffic between'
               ' these addresses.''\n''This will automatically close when the specified packet count is reached''\n'
-              'Press Ctrl C to Terminate'.format(**cli_args.__dict__))
+              'Press Ctrl C to Terminate'.format(
+                  ', '.join('{} and {}'.format(*pair) for pair in cli_args.pairs), cli_args.count))
         print(('{0}' * 50).format('*'))
-        os.system('tcpdump -i eth0 -nc {count} "ip host {ip1} and ip host {ip2}"'.format(**cli_args.__dict__))
+        os.system('tcpdump -i {} -nc {} "{}"'.format(
+            cli_args.interface, cli_args.count, capture_filter(cli_args)))
         print(('{0}' * 50).format('*'))
         print('TCPDUMP Complete.')
         print(('{0}' * 50).format('*'))
     elif cli_args.file:
         timestamp = str(datetime.datetime.now().strftime('%Y-%m-%d-%H%M'))
         print(('{0}' * 50).format('*'))
-        print('Collecting TCPDUMP between {ip1} and {ip2} for {count} packets.''\n''Please initiate traffic between'
+        ip1, ip2 = cli_args.pairs[0]
+        print('Collecting TCPDUMP between {} and {} for {} packets.''\n''Please initiate traffic between'
               ' these addresses.''\n''This will automatically close when the specified packet count is reached''\n'
-              'Press Ctrl C to Terminate'.format(**cli_args.__dict__))
+              'Press Ctrl C to Terminate'.format(ip1, ip2, cli_args.count))
         print(('{0}' * 50).format('*'))
         filename = 'TCPDUMP_{}.pcap'.format(timestamp)
-        os.system('tcpdump -i eth0 -nc {count} "ip host {ip1} and ip host {ip2}" -w {filename}'
-                  .format(filename=filename, **cli_args.__dict__))
+        os.system('tcpdump -i {} -nc {} "{}" -w {}'.format(
+            cli_args.interface, cli_args.count, capture_filter(cli_args), filename))
         print(('{0}' * 50).format('*'))
         print('TCPDUMP Complete! PCAP file Exported as:''\n''{}'.format(filename))
         print(('{0}' * 50).format('*'))
 
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""Simulated fleet of NX-OS switches for exercising rolling_maint.py
+without switches.
+
+Used as the --cli module of rolling_maint.py:
+
+    rolling_maint.py -f fleet.txt --cli fake_cli --settle 5 --interval 0.1
+
+Every switch is simulated in memory the first time it is sent a command,
+and answers the commands rolling_maint.py sends the way NX-API would.
+Switches sharing a site, role and instance are vPC peers, and switches
+of a role that is not in vPC pairs, such as spines, are BGP neighbours
+of the other switches at their site.  Putting a switch into maintenance
+while another of its vPC pair, or of its role at its site when it has
+no vPC pairs, is still in maintenance or has not come back from it
+raises FleetError, as that is when traffic is cut off.
+
+Run on its own, it rolls maintenance through the hostnames given, or
+through a file of them, and exits 1 unless every wave went through and
+every switch ended up back in production:
+
+    fake_cli.py DC1-SPN-1A DC1-SPN-2A DC1-HLF-1A DC1-HLF-1B
+
+Each switch behaves as described in the JSON file named by $FAKE_FLEET,
+with the "*" entry as the default for switches not listed:
+
+    {"*": {"latency": 0.01, "recovery": 1},
+     "DC1-HLF-1B": {"fail": "maintenance"}}
+
+Settings:
+    latency     seconds before each reply
+    recovery    seconds a switch put back into production takes to bring
+                its BGP sessions up and be seen out of maintenance
+    fail        maintenance or production, the change the switch rejects
+    peer_down   its vPC peer keep-alive is down
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from maint_mode import (BGP_DOWN_CHECK, BGP_MAINTENANCE_CHECK,
+                        KEEP_ALIVE_CHECK, PEER_MAINTENANCE_CHECK, ROLES,
+                        STATES, parse_hostname, route_map_config)
+
+defaults = dict(
+    latency=0,
+    recovery=0,
+    fail=None,
+    peer_down=False,
+)
+
+
+class FleetError(Exception):
+    pass
+
+
+class Switch(object):
+    def __init__(self, name, settings):
+        device = parse_hostname(name)
+        self.hostname = device['hostname']
+        self.site = device['site']
+        self.role = device['role']
+        self.instance = device['instance']
+        self.vpc = ROLES[self.role].get('vpc', True)
+        self.group = (device['site'], device['role'])
+        if self.vpc:
+            self.group += (device['instance'],)
+        self.settings = settings
+        self.state = 'production'
+        self.back = 0
+
+    def recovering(self, now):
+        return now < self.back
+
+    def draining(self, now):
+        """Whether the rest of the fleet still sees it in maintenance"""
+        return self.state == 'maintenance' or self.recovering(now)
+
+
+class Fleet(object):
+    def __init__(self, settings=None):
+        self.settings = settings or {}
+        self.switches = {}
+        self.commands = 0
+        self.lock = threading.Lock()
+
+    def switch(self, host):
+        hostname = parse_hostname(host)['hostname']
+        if hostname not in self.switches:
+            settings = dict(defaults)
+            settings.update(self.settings.get('*', {}))
+            settings.update(self.settings.get(hostname, {}))
+            self.switches[hostname] = Switch(hostname, settings)
+        return self.switches[hostname]
+
+    def cli(self, host, command):
+        with self.lock:
+            switch = self.switch(host)
+        time.sleep(switch.settings['latency'])
+        with self.lock:
+            self.commands += 1
+            return self.run(switch, command.strip(), time.time())
+
+    def peers(self, switch):
+        return [other for other in self.switches.values()
+                if other is not switch and other.group == switch.group]
+
+    def neighbors(self, switch):
+        return [other for other in self.switches.values()
+                if other.site == switch.site and other.vpc != switch.vpc]
+
+    def run(self, switch, command, now):
+        if command == PEER_MAINTENANCE_CHECK:
+            return ''.join('*>i1.1.1.%s/32 %s\n' % (peer.instance, peer.hostname)
+                           for peer in self.peers(switch) if peer.draining(now))
+        if command == KEEP_ALIVE_CHECK:
+            return 'vPC keep-alive status : %s\n' % (
+                'peer is not reachable' if switch.settings['peer_down']
+                else 'peer is alive')
+        if command == BGP_MAINTENANCE_CHECK:
+            return ''.join('*>e10.%s.0.0/16 %s\n' % (
+                neighbor.instance, neighbor.hostname)
+                for neighbor in self.neighbors(switch)
+                if neighbor.draining(now))
+        if command == BGP_DOWN_CHECK:
+            return ''.join('%s 4 Active\n' % neighbor.hostname
+                           for neighbor in self.neighbors(switch)
+                           if switch.recovering(now) or
+                           neighbor.recovering(now))
+        if command.startswith('copy run'):
+            return ''
+        for state in STATES:
+            if command == route_map_config(switch.role, switch.instance,
+                                           STATES[state][0]):
+                return self.set_state(switch, state, now)
+        raise FleetError('%s: unknown command %s' % (switch.hostname, command))
+
+    def set_state(self, switch, state, now):
+        if switch.settings['fail'] == state:
+            raise FleetError('%s rejected the change to %s' % (
+                switch.hostname, STATES[state][1]))
+        if state == 'maintenance':
+            drained = [peer.hostname for peer in self.peers(switch)
+                       if peer.draining(now)]
+            if drained:
+                raise FleetError('%s put into Maintenance while %s is not '
+                                 'back' % (switch.hostname, ', '.join(drained)))
+        elif switch.state == 'maintenance':
+            switch.back = now + switch.settings['recovery']
+        switch.state = state
+        return ''
+
+
+def load_settings():
+    path = os.environ.get('FAKE_FLEET')
+    if not path:
+        return {}
+    with open(path) as raw:
+        return json.load(raw)
+
+
+fleet = Fleet(load_settings())
+
+
+def cli(host, command):
+    return fleet.cli(host, command)
+
+
+def main():
+    import rolling_maint
+    parser = argparse.ArgumentParser(
+        description='Roll maintenance through a simulated fleet')
+    parser.add_argument(
+        'switches', nargs='+',
+        help='Hostnames, or a file with one on each line')
+    parser.add_argument(
+        '-n', '--max_parallel', type=int, default=0,
+        help='Most switches in one wave, 0 for no limit')
+    parser.add_argument(
+        '--hold', type=float, default=0,
+        help='Seconds to keep each wave in Maintenance')
+    parser.add_argument(
+        '--settle', type=float, default=30,
+        help='Seconds to wait for the peers of a wave to be ready')
+    parser.add_argument(
+        '--interval', type=float, default=0.1,
+        help='Seconds between peer checks while waiting')
+    args = parser.parse_args()
+
+    if len(args.switches) == 1 and os.path.isfile(args.switches[0]):
+        switches, unsupported = rolling_maint.load_fleet(args.switches[0], cli)
+    else:
+        switches = [rolling_maint.Switch(name, cli) for name in args.switches]
+    waves = rolling_maint.plan_waves(switches, args.max_parallel)
+    done = rolling_maint.rollout(waves, hold=args.hold, settle=args.settle,
+                                 interval=args.interval)
+    left = sorted(switch.hostname for switch in fleet.switches.values()
+                  if switch.state != 'production')
+    print('%s waves, %s commands, left in Maintenance: %s' % (
+        len(waves), fleet.commands, ', '.join(left) or 'none'))
+    if not done or left:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
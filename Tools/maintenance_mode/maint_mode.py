@@ -1,7 +1,29 @@
 #!/usr/bin/env python
 
 import argparse
-from cli import *
+try:
+    from cli import *
+except ImportError:
+    # Off the switch, imported by rolling_maint.py which brings its own
+    cli = None
+
+# BGP ASN of each role, whether the switch's instance number is added to
+# it, the template peers whose outbound route-map is swapped between
+# <TEMPLATE>_V4_OUT and <TEMPLATE>_V4_MAINT_OUT, and whether the role's
+# switches are vPC pairs
+ROLES = {
+    'SPN': dict(asn=64600, templates=['SPN_HLF', 'SPN_ELF'], vpc=False),
+    'ELF': dict(asn=64590, templates=['ELF_CFW', 'ELF_ELF', 'ELF_SPN']),
+    'BLF': dict(asn=64684, templates=['BLF_BLF', 'BLF_SPN']),
+    'SVC': dict(asn=64685, templates=['SVC_SVC', 'SVC_SPN']),
+    'HLF': dict(asn=64670, per_instance=True, templates=['HLF_HLF', 'HLF_SPN']),
+}
+
+# Route-map suffix and name of each mode
+STATES = {
+    'maintenance': ('MAINT_OUT', 'Maintenance'),
+    'production': ('OUT', 'Production'),
+}
 
 
 # Obtain User Arguments for either 'maintenance' or 'production'
@@ -21,99 +43,113 @@ def get_cli_args():
     return args
 
 
+# Split a SITE-ROLE-<instance><side> hostname into its parts
+def parse_hostname(name):
+    fqdn = name.strip().split('-')
+    hostname = '%s-%s-%s' % (fqdn[0], fqdn[1], fqdn[2])
+    inst_side = fqdn[2]
+    return dict(hostname=hostname, site=fqdn[0], role=fqdn[1],
+                instance=int(inst_side[0:-1]), side=inst_side[-1])
+
+
+# Every route-map change for a role as a single configuration command
+def route_map_config(role, instance, route_map_state):
+    settings = ROLES[role]
+    asn = settings['asn'] + (instance if settings.get('per_instance') else 0)
+    commands = ['configure', 'router bgp %s' % asn]
+    for template in settings['templates']:
+        commands += ['template peer %s_UNDERLAY_V4' % template,
+                     'address-family ipv4 unicast',
+                     'route-map %s_V4_%s out' % (template, route_map_state),
+                     'exit', 'exit']
+    return ' ;'.join(commands)
+
+
+PEER_MAINTENANCE_CHECK = 'show ip bgp community ".*.10101" | grep 1.1.1'
+KEEP_ALIVE_CHECK = 'show vpc brief | grep keep-alive'
+
+
+# vPC peer checks, each only queried once the one before it has passed.
+# run defaults to this switch's cli
+def vpc_peer_in_maintenance(run=None):
+    return (run or cli)(PEER_MAINTENANCE_CHECK) != ''
+
+
+def vpc_peer_alive(run=None):
+    return 'peer is alive' in (run or cli)(KEEP_ALIVE_CHECK)
+
+
+BGP_MAINTENANCE_CHECK = 'show ip bgp community ".*.10101" | grep "/"'
+BGP_DOWN_CHECK = 'show ip bgp summary | egrep "Idle|Active|Connect|Open"'
+
+
+# BGP checks for switches that are not vPC peers, whose neighbours are
+# what carries their traffic while they are in maintenance
+def bgp_neighbor_in_maintenance(run=None):
+    return (run or cli)(BGP_MAINTENANCE_CHECK) != ''
+
+
+def bgp_neighbors_up(run=None):
+    return (run or cli)(BGP_DOWN_CHECK) == ''
+
+
 def main():
-    # Define/Generate Variables based on user input and device querying
+    # Only query the device for what the chosen mode needs
     args = get_cli_args()
     save_config = 'copy run start'
-    fqdn = cli('show hostname').split('-')
-    hostname = '%s-%s-%s' % (fqdn[0], fqdn[1], fqdn[2])
-    site = fqdn[0]
-    role = fqdn[1]
-    inst_side = fqdn[2]
-    instance = int(inst_side[0:-1])
-    user = cli('show users | grep *').split(' ')
-    vpc_peer_status = cli('show ip bgp community ".*.10101" | grep 1.1.1')
-    keep_alive_status = cli('show vpc brief | grep keep-alive')
-    # Format ROUTE-MAP naming Suffix based on user input
     if args.maintenance:
-        route_map_state = 'MAINT_OUT'
-        status = 'Maintenance'
+        route_map_state, status = STATES['maintenance']
     elif args.production:
-        route_map_state = 'OUT'
-        status = 'Production'
+        route_map_state, status = STATES['production']
     else:
         print('*' * 100)
         print('Must specify State as either maintenance or production. Use --help for assistance.')
         print('*' * 100)
         exit()
 
-    if args.maintenance:
+    device = parse_hostname(cli('show hostname'))
+    hostname, role = device['hostname'], device['role']
+    if role not in ROLES:
+        print('*' * 50)
+        print('THIS DEVICE DOES NOT SUPPORT MAINT MODE!')
+        print('*' * 50)
+        exit()
+
+    if args.maintenance and ROLES[role].get('vpc', True):
         print('Since %s mode was selected, checking if the vPC peer is in %s mode' % (status,status))
         # Determine if vPC Peer is in Maintenance Mode (If placing switch in Maintenance Mode)
-        if vpc_peer_status != '':
+        if vpc_peer_in_maintenance():
             print('vPC Peer is in currently in Maintenance mode!  Aborting Script!')
             exit()
         else:
             print('vPC Peer is not in Maintenance Mode, Verifying status of vPC Peer')
         # Verify vPC Peer is alive to ensure peer switch is online (If placing switch in Maintenance Mode)
-        if 'peer is alive' in keep_alive_status:
+        if vpc_peer_alive():
             print('vPC Peer is Alive.  Ready to place switch into %s Mode' % (status))
         else:
             print('vPC Peer is not currently alive!  Aborting Script!')
+            exit()
+    elif args.maintenance:
+        print('Since %s mode was selected, checking if any BGP neighbor is in %s mode' % (status,status))
+        # Without a vPC peer, its BGP neighbors carry the traffic instead
+        if bgp_neighbor_in_maintenance():
+            print('A BGP neighbor is currently in Maintenance mode!  Aborting Script!')
+            exit()
+        else:
+            print('No BGP neighbor is in Maintenance Mode, Verifying status of BGP neighbors')
+        if bgp_neighbors_up():
+            print('All BGP neighbors are Established.  Ready to place switch into %s Mode' % (status))
+        else:
+            print('Not all BGP neighbors are Established!  Aborting Script!')
+            exit()
     else:
         print('Skipping vPC Peer Sanity Checks since %s was selected instead of Maintenance' % (status))
 
+    user = cli('show users | grep *').split(' ')
     print('%s is being put into %s by user %s from IP address: %s.' % (hostname,status,user[0],user[-3]))
 
-    # Determine Configuration Criteria based on role/instance and make configuration changes
-    if role == 'SPN':
-        asn = 64600
-        cli('configure ;router bgp %s ;template peer SPN_HLF_UNDERLAY_V4 '
-            ';address-family ipv4 unicast ;route-map SPN_HLF_V4_%s out'
-            % (asn, route_map_state))
-        cli('configure ;router bgp %s ;template peer SPN_ELF_UNDERLAY_V4 '
-            ';address-family ipv4 unicast ;route-map SPN_ELF_V4_%s out'
-            % (asn, route_map_state))
-    elif role == 'ELF':
-        asn = 64590
-        cli('configure ;router bgp %s ;template peer ELF_CFW_UNDERLAY_V4 '
-            ';address-family ipv4 unicast ;route-map ELF_CFW_V4_%s out'
-            % (asn, route_map_state))
-        cli('configure ;router bgp %s ;template peer ELF_ELF_UNDERLAY_V4 '
-            ';address-family ipv4 unicast ;route-map ELF_ELF_V4_%s out'
-            % (asn, route_map_state))
-        cli('configure ;router bgp %s ;template peer ELF_SPN_UNDERLAY_V4 '
-            ';address-family ipv4 unicast ;route-map ELF_SPN_V4_%s out'
-            % (asn, route_map_state))
-    elif role == 'BLF':
-        asn = 64684
-        cli('configure ;router bgp %s ;template peer BLF_BLF_UNDERLAY_V4 '
-            ';address-family ipv4 unicast ;route-map BLF_BLF_V4_%s out'
-            % (asn, route_map_state))
-        cli('configure ;router bgp %s ;template peer BLF_SPN_UNDERLAY_V4 '
-            ';address-family ipv4 unicast ;route-map BLF_SPN_V4_%s out'
-            % (asn, route_map_state))
-    elif role == 'SVC':
-        asn = 64685
-        cli('configure ;router bgp %s ;template peer SVC_SVC_UNDERLAY_V4 '
-            ';address-family ipv4 unicast ;route-map SVC_SVC_V4_%s out'
-            % (asn, route_map_state))
-        cli('configure ;router bgp %s ;template peer SVC_SPN_UNDERLAY_V4 '
-            ';address-family ipv4 unicast ;route-map SVC_SPN_V4_%s out'
-            % (asn, route_map_state))
-    elif role == 'HLF':
-        asn = 64670 + instance
-        cli('configure ;router bgp %s ;template peer HLF_HLF_UNDERLAY_V4 '
-            ';address-family ipv4 unicast ;route-map HLF_HLF_V4_%s out'
-            % (asn, route_map_state))
-        cli('configure ;router bgp %s ;template peer HLF_SPN_UNDERLAY_V4 '
-            ';address-family ipv4 unicast ;route-map HLF_SPN_V4_%s out'
-            % (asn, route_map_state))
-    else:
-        print('*' * 50)
-        print('THIS DEVICE DOES NOT SUPPORT MAINT MODE!')
-        print('*' * 50)
-        exit()
+    # Make every route-map change for the role in one configuration call
+    cli(route_map_config(role, device['instance'], route_map_state))
 
     print('%s has been put into %s by user %s from IP address %s using the %s template.\nSaving Configuration!\n\n\n'
         % (hostname, status, user[0],user[-3],role))
@@ -121,4 +157,6 @@ def main():
     print('Script Completed Successfully!\n')
     exit()
 
-main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""Rolling maintenance of a fleet of NX-OS switches, run off the box.
+
+Hostnames are parsed as SITE-ROLE-<instance><side> the way maint_mode.py
+does, and switches sharing a site, role and instance are vPC peers.
+Switches of a role that is not in vPC pairs, such as spines, are all
+peers of each other within a site.  The fleet is split into as few
+waves as possible where no wave holds two peers, so one switch of every
+pair, and all but one spine of every site, keep forwarding.  Each wave
+in turn:
+
+  1. waits until every switch in it can be drained: its vPC peer is
+     alive and not in maintenance or, for a switch that is not in a vPC
+     pair, all its BGP neighbours are up and none is in maintenance
+  2. puts every switch in it into maintenance at once
+  3. runs --action for each switch, and waits --hold seconds
+  4. puts every switch in it back into production at once
+  5. waits until it has come back, as seen by the vPC peers of its
+     switches, or by the BGP checks of step 1 on the others
+
+Any failure, or Ctrl-C, puts the wave back into production and stops
+the rollout.
+
+Commands are sent over NX-API, or through the cli(host, command)
+function of the module given with --cli, such as a stand-in for tests.
+
+Usage:
+    rolling_maint.py -f fleet.txt -u admin [--dry_run] [--action CMD]
+"""
+
+import argparse
+import base64
+import getpass
+import importlib
+import json
+import ssl
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+from maint_mode import (ROLES, STATES, bgp_neighbor_in_maintenance,
+                        bgp_neighbors_up, parse_hostname, route_map_config,
+                        vpc_peer_alive, vpc_peer_in_maintenance)
+
+SAVE_CONFIG = 'copy run start'
+
+
+class CliError(Exception):
+    pass
+
+
+class Nxapi(object):
+    """cli(host, command) over NX-API, the off box counterpart of the
+    cli module on the switch.  Commands separated by ' ;' are sent in
+    one request."""
+    def __init__(self, user, password, verify=True, timeout=60):
+        self.auth = 'Basic %s' % base64.b64encode(
+            ('%s:%s' % (user, password)).encode('utf-8')).decode('ascii')
+        self.context = None if verify else ssl._create_unverified_context()
+        self.timeout = timeout
+
+    def cli(self, host, command):
+        batch = [dict(jsonrpc='2.0', method='cli_ascii', id=number + 1,
+                      params=dict(cmd=line.strip(), version=1))
+                 for number, line in enumerate(command.split(';'))]
+        request = Request('https://%s/ins' % host,
+                          json.dumps(batch).encode('utf-8'),
+                          {'Content-Type': 'application/json-rpc',
+                           'Authorization': self.auth})
+        reply = json.loads(urlopen(request, timeout=self.timeout,
+                                   context=self.context).read().decode('utf-8'))
+        if isinstance(reply, dict):
+            reply = [reply]
+        output = []
+        for result in reply:
+            if 'error' in result:
+                raise CliError('%s: %s' % (host, result['error'].get(
+                    'data', {}).get('msg', result['error'].get('message'))))
+            output.append((result.get('result') or {}).get('msg', ''))
+        return ''.join(output)
+
+
+class Switch(object):
+    def __init__(self, name, run):
+        self.name = name
+        self.run = run
+        device = parse_hostname(name)
+        self.hostname = device['hostname']
+        self.role = device['role']
+        self.instance = device['instance']
+        self.side = device['side']
+        self.vpc = ROLES[self.role].get('vpc', True)
+        # Switches that must not be in maintenance together: a vPC pair,
+        # or every switch of a role without vPC pairs at a site
+        self.group = (device['site'], device['role'])
+        if self.vpc:
+            self.group += (device['instance'],)
+
+    def cli(self, command):
+        return self.run(self.name, command)
+
+    def __repr__(self):
+        return self.hostname
+
+
+def load_fleet(path, run):
+    """Switches from a file of hostnames, one per line"""
+    switches = []
+    unsupported = []
+    with open(path) as fleet:
+        for line in fleet:
+            name = line.split('#')[0].strip()
+            if not name:
+                continue
+            try:
+                if parse_hostname(name)['role'] not in ROLES:
+                    raise ValueError(name)
+            except (IndexError, ValueError):
+                unsupported.append(name)
+                continue
+            switches.append(Switch(name, run))
+    return switches, unsupported
+
+
+def plan_waves(switches, max_parallel=0):
+    """Waves of switches where no wave holds two of the same group.
+
+    The n'th switch of every group, by instance and side, goes in the
+    n'th wave, so there are only as many waves as the largest group has
+    switches: two for vPC pairs, one per spine for the spines of a site.
+    Waves bigger than max_parallel are split up.
+    """
+    groups = {}
+    for switch in sorted(switches, key=lambda switch: (
+            switch.group, switch.instance, switch.side)):
+        groups.setdefault(switch.group, []).append(switch)
+    waves = []
+    for group in sorted(groups):
+        for number, switch in enumerate(groups[group]):
+            if len(waves) <= number:
+                waves.append([])
+            waves[number].append(switch)
+    if max_parallel:
+        waves = [wave[start:start + max_parallel] for wave in waves
+                 for start in range(0, len(wave), max_parallel)]
+    return waves
+
+
+def concurrently(function, switches):
+    """Run function on every switch at once, returning the errors by
+    switch name"""
+    errors = {}
+
+    def run(switch):
+        try:
+            function(switch)
+        except Exception as e:
+            errors[switch.name] = e
+
+    threads = [threading.Thread(target=run, args=(switch,))
+               for switch in switches]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        # Let the commands already sent finish, so whatever runs next
+        # finds the switches as they were left
+        for thread in threads:
+            thread.join()
+        raise
+    return errors
+
+
+def wait_for_peer(switch, settle, interval):
+    """Wait until switch's vPC peer is alive and out of maintenance or,
+    for a switch that is not in a vPC pair, until all its BGP neighbours
+    are up and out of maintenance"""
+    deadline = time.time() + settle
+    while True:
+        if switch.vpc:
+            if not vpc_peer_in_maintenance(switch.cli) \
+                    and vpc_peer_alive(switch.cli):
+                return
+        elif not bgp_neighbor_in_maintenance(switch.cli) \
+                and bgp_neighbors_up(switch.cli):
+            return
+        if time.time() >= deadline:
+            if switch.vpc:
+                raise CliError('vPC peer of %s is not alive or is still in '
+                               'maintenance' % switch.hostname)
+            raise CliError('BGP neighbours of %s are not up or are still in '
+                           'maintenance' % switch.hostname)
+        time.sleep(interval)
+
+
+def witnesses(wave, switches):
+    """Switches to run wait_for_peer on to see that wave has come back:
+    the vPC peers of its switches, or the switch itself when it is not
+    in a vPC pair or its peer is not in switches"""
+    checks = []
+    for switch in wave:
+        peers = [peer for peer in switches if peer.vpc and
+                 peer.group == switch.group and peer is not switch]
+        checks.extend(peers or [switch])
+    return checks
+
+
+def set_state(switch, state):
+    switch.cli(route_map_config(switch.role, switch.instance,
+                                STATES[state][0]))
+    switch.cli(SAVE_CONFIG)
+
+
+def run_action(action, switch):
+    command = action.format(host=switch.name, hostname=switch.hostname)
+    status = subprocess.call(command, shell=True)
+    if status:
+        raise CliError('%s exited with %s' % (command, status))
+
+
+def report(stage, errors):
+    for name in sorted(errors):
+        print('%s failed on %s: %s' % (stage, name, errors[name]))
+    return not errors
+
+
+def rollout(waves, action=None, hold=0, settle=300, interval=10):
+    """Run every wave in turn, returning False at the first failure"""
+    switches = [switch for wave in waves for switch in wave]
+    for number, wave in enumerate(waves):
+        names = ', '.join(switch.hostname for switch in wave)
+        print('*' * 50)
+        print('Wave %s of %s: %s' % (number + 1, len(waves), names))
+        print('*' * 50)
+        if not report('Peer check', concurrently(
+                lambda switch: wait_for_peer(switch, settle, interval),
+                wave)):
+            print('Aborting before wave %s, nothing was changed' %
+                  (number + 1))
+            return False
+
+        print('Putting wave %s into Maintenance' % (number + 1))
+        try:
+            ok = report('Maintenance', concurrently(
+                lambda switch: set_state(switch, 'maintenance'), wave))
+            if ok and action:
+                ok = report('Action', concurrently(
+                    lambda switch: run_action(action, switch), wave))
+            if ok and hold:
+                print('Holding wave %s in Maintenance for %s seconds' %
+                      (number + 1, hold))
+                time.sleep(hold)
+        finally:
+            print('Putting wave %s back into Production' % (number + 1))
+            restored = report('Production', concurrently(
+                lambda switch: set_state(switch, 'production'), wave))
+            if not restored:
+                print('Aborting! Some switches in wave %s may still be in '
+                      'Maintenance' % (number + 1))
+        if not restored:
+            return False
+        if not ok:
+            print('Aborting after wave %s' % (number + 1))
+            return False
+
+        print('Waiting for wave %s to come back' % (number + 1))
+        if not report('Recovery check', concurrently(
+                lambda switch: wait_for_peer(switch, settle, interval),
+                witnesses(wave, switches))):
+            print('Aborting after wave %s, it has not come back' %
+                  (number + 1))
+            return False
+    return True
+
+
+def get_cli_args():
+    parser = argparse.ArgumentParser(
+        description='Rolling maintenance of a fleet of NXOS switches, a wave at a time')
+    parser.add_argument(
+        '-f', '--fleet', type=str, required=True,
+        help='File with the hostname of a switch on each line')
+    parser.add_argument(
+        '-u', '--user', type=str,
+        help='NX-API user, the password is prompted for')
+    parser.add_argument(
+        '--cli', type=str,
+        help='Module with a cli(host, command) function to use instead of NX-API')
+    parser.add_argument(
+        '--insecure', action='store_true',
+        help='Do not verify the NX-API certificates of the switches')
+    parser.add_argument(
+        '-n', '--max_parallel', type=int, default=0,
+        help='Most switches in one wave, 0 for no limit')
+    parser.add_argument(
+        '-a', '--action', type=str,
+        help='Shell command run for each switch while it is in Maintenance, '
+             '{host} and {hostname} are filled in')
+    parser.add_argument(
+        '--hold', type=float, default=0,
+        help='Seconds to keep each wave in Maintenance')
+    parser.add_argument(
+        '--settle', type=float, default=300,
+        help='Seconds to wait for the peers of a wave to be ready, and '
+             'for the wave to come back')
+    parser.add_argument(
+        '--interval', type=float, default=10,
+        help='Seconds between peer checks while waiting')
+    parser.add_argument(
+        '--dry_run', action='store_true',
+        help='Only print the waves')
+    args = parser.parse_args()
+    if not (args.cli or args.user or args.dry_run):
+        parser.error('Either --user or --cli is needed')
+    return args
+
+
+def main():
+    args = get_cli_args()
+    if args.cli:
+        run = importlib.import_module(args.cli).cli
+    elif args.user:
+        run = Nxapi(args.user, getpass.getpass('Enter password: '),
+                    verify=not args.insecure).cli
+    else:
+        run = None
+    switches, unsupported = load_fleet(args.fleet, run)
+    for name in unsupported:
+        print('Skipping %s, it does not support Maintenance Mode' % name)
+    waves = plan_waves(switches, args.max_parallel)
+
+    for number, wave in enumerate(waves):
+        print('Wave %s: %s' % (number + 1, ', '.join(
+            switch.hostname for switch in wave)))
+    if args.dry_run:
+        return
+    try:
+        done = rollout(waves, args.action, args.hold, args.settle,
+                       args.interval)
+    except KeyboardInterrupt:
+        print('Interrupted! Stopping the rollout')
+        sys.exit(1)
+    if done:
+        print('Rolling Maintenance Completed Successfully!')
+    else:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python2.7
+"""Single file, append-only store for the output of a run_cli run.
+
+Every command's output is appended to <name>.archive as one record,
+zlib compressed if asked, and a line is added to <name>.idx with the
+host, command, timestamp, offset and length of the record.  Looking up
+one output only reads the index and seeks straight to the record.
+
+Output of a command that never finished, because it timed out or the
+session failed, is still archived but marked partial in the index.
+
+Usage:
+    archive.py <archive> [-H host] [-c command] [-l]
+"""
+
+import argparse
+import errno
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import zlib
+
+from collections import namedtuple
+from datetime import datetime
+
+from sinks import Sink
+
+Entry = namedtuple(
+    'Entry', ['host', 'command', 'timestamp', 'offset', 'length', 'codec',
+              'partial'])
+
+class Archive(object):
+    def __init__(self, path, compress=False):
+        if path.endswith('.archive'):
+            path = path[:-len('.archive')]
+        self.data_path = '%s.archive' % path
+        self.index_path = '%s.idx' % path
+        self.compress = compress
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.lock = threading.Lock()
+        self.entries = None
+        self.by_host = None
+
+    def sink(self, host):
+        """Sink that appends the output of each command run on host"""
+        return ArchiveSink(self, host)
+
+    def append(self, host, command, spool, codec, partial=False):
+        """Copy a spooled record onto the end of the archive"""
+        timestamp = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        spool.seek(0)
+        with self.lock:
+            with open(self.data_path, 'ab') as data:
+                data.seek(0, os.SEEK_END)
+                offset = data.tell()
+                shutil.copyfileobj(spool, data)
+                length = data.tell() - offset
+            fields = [escape(host), escape(command), timestamp,
+                      str(offset), str(length), codec]
+            if partial:
+                fields.append('partial')
+            with open(self.index_path, 'a') as index:
+                index.write('\t'.join(fields) + '\n')
+
+    def index(self):
+        """Every entry in the archive, in the order they were written"""
+        if self.entries is None:
+            self.entries = []
+            self.by_host = {}
+            with open(self.index_path) as index:
+                for line in index:
+                    fields = line.rstrip('\n').split('\t')
+                    host, command, timestamp, offset, length, codec = \
+                        fields[:6]
+                    entry = Entry(
+                        unescape(host), unescape(command), timestamp,
+                        int(offset), int(length), codec,
+                        fields[6:] == ['partial'])
+                    self.entries.append(entry)
+                    self.by_host.setdefault(entry.host, []).append(entry)
+        return self.entries
+
+    def lookup(self, host=None, command=None):
+        entries = self.index()
+        if host is not None:
+            entries = self.by_host.get(host, [])
+        return [entry for entry in entries
+                if command is None or entry.command == command]
+
+    def read(self, entry):
+        with open(self.data_path, 'rb') as data:
+            data.seek(entry.offset)
+            record = data.read(entry.length)
+        if entry.codec == 'zlib':
+            record = zlib.decompress(record)
+        return record.decode('utf-8', 'replace')
+
+class ArchiveSink(Sink):
+    """Spools each command's output and appends it to the archive once
+    the command finishes, so concurrent hosts never interleave records.
+    Spools over 1MB go to a temporary file rather than memory.
+    """
+    def __init__(self, archive, host):
+        self.archive = archive
+        self.host = host
+        self.command = None
+
+    def begin(self, command):
+        self.command = command
+        self.spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        self.compressor = zlib.compressobj() if self.archive.compress else None
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.spool.write(data)
+
+    def end(self, partial=False):
+        codec = 'raw'
+        if self.compressor:
+            self.spool.write(self.compressor.flush())
+            codec = 'zlib'
+        self.archive.append(self.host, self.command, self.spool, codec,
+                            partial)
+        self.spool.close()
+        self.command = None
+
+    def close(self):
+        # Keep what a command that never finished printed, marked partial
+        if self.command is not None:
+            self.end(partial=True)
+
+def escape(field):
+    return field.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+def unescape(field):
+    return re.sub(r'\\(.)', lambda match: {'n': '\n', 't': '\t'}.get(
+        match.group(1), match.group(1)), field)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Look up command output in a run_cli archive")
+    parser.add_argument('archive', type=str, help='Archive to read')
+    parser.add_argument(
+        '-H', '--host', type=str, help='Only show output from this host')
+    parser.add_argument(
+        '-c', '--command', type=str, help='Only show output of this command')
+    parser.add_argument(
+        '-l', '--list', action='store_true',
+        help='List matching entries instead of printing their output')
+    args = parser.parse_args()
+
+    archive = Archive(args.archive)
+    for entry in archive.lookup(args.host, args.command):
+        if args.list:
+            sys.stdout.write('%s\t%s\t%s%s\n' % (
+                entry.timestamp, entry.host, entry.command,
+                '\tpartial' if entry.partial else ''))
+        else:
+            sys.stdout.write('### %s: %s (%s%s)\n' % (
+                entry.host, entry.command, entry.timestamp,
+                ', partial' if entry.partial else ''))
+            sys.stdout.write(archive.read(entry) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python2.7
+"""Benchmark run_cli against simulated devices.
+
+Builds a fleet of fake_device.py hosts in a scratch directory, points
+run_cli's ssh at them through PATH and HOME, runs run_cli over the whole
+fleet and reports hosts/sec, commands/sec, per command latency and the
+peak RSS of the run_cli process.  Each result can be appended as a JSON
+line to a file so throughput can be tracked from one change to the next.
+
+Usage:
+    benchmark.py [-H hosts] [-c commands] [--latency s] [-- run_cli args]
+
+Anything after -- is passed on to run_cli, for example:
+    benchmark.py -H 500 -- -n 50 -e event
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import pexpect
+
+from datetime import datetime
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+DEV_TYPES = ['arista', 'force10', 'hp_apm', 'junos', 'cisco']
+
+def check_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark run_cli against simulated devices")
+    parser.add_argument(
+        '-H', '--hosts', type=int, default=200,
+        help='Number of simulated devices')
+    parser.add_argument(
+        '-t', '--types', type=str, default=','.join(DEV_TYPES),
+        help='Comma separated device types, assigned round robin')
+    parser.add_argument(
+        '-c', '--commands', type=int, default=5,
+        help='Commands run on each device')
+    parser.add_argument(
+        '--login_latency', type=float, default=0.05,
+        help='Seconds each device takes to show its first prompt')
+    parser.add_argument(
+        '--latency', type=float, default=0.02,
+        help='Seconds each command takes before its output')
+    parser.add_argument(
+        '--jitter', type=float, default=0.0,
+        help='Up to this many extra seconds per command')
+    parser.add_argument(
+        '--lines', type=int, default=50,
+        help='Lines of output per command')
+    parser.add_argument(
+        '--width', type=int, default=80,
+        help='Characters per line of output')
+    parser.add_argument(
+        '--newkey', type=float, default=0.0,
+        help='Fraction of devices whose host key is not yet known')
+    parser.add_argument(
+        '--changed_key', type=float, default=0.0,
+        help='Fraction of devices whose host key changed, these fail')
+    parser.add_argument(
+        '--bad_password', type=float, default=0.0,
+        help='Fraction of devices that reject the password, these fail')
+    parser.add_argument(
+        '--python', type=str, default=sys.executable,
+        help='Interpreter to run run_cli and the devices with')
+    parser.add_argument(
+        '-r', '--results', type=str, default=None,
+        help='Append the result as a JSON line to this file')
+    parser.add_argument(
+        '--keep', action='store_true',
+        help='Keep the scratch directory with the logs of the run')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed for assigning flows to devices')
+    if '--' in sys.argv:
+        split = sys.argv.index('--')
+        args = parser.parse_args(sys.argv[1:split])
+        args.run_cli = sys.argv[split + 1:]
+    else:
+        args = parser.parse_args()
+        args.run_cli = []
+    return args
+
+def build_fleet(args, scratch):
+    """Write the device settings, the device list and the ssh shim.
+
+    Returns the hosts expected to fail.
+    """
+    rand = random.Random(args.seed)
+    types = [dev_type.strip() for dev_type in args.types.split(',')]
+    devices = {'*': dict(
+        login_latency=args.login_latency, latency=args.latency,
+        jitter=args.jitter, lines=args.lines, width=args.width)}
+    failing = set()
+    with open(os.path.join(scratch, 'devices.csv'), 'w') as device_list:
+        for number in range(args.hosts):
+            dev_type = types[number % len(types)]
+            host = '%s-%05d' % (dev_type, number)
+            settings = dict(dev_type=dev_type)
+            draw = rand.random()
+            if draw < args.changed_key:
+                settings['flow'] = 'changed_key'
+            elif draw < args.changed_key + args.bad_password:
+                settings['password'] = 'not the password'
+            elif draw < args.changed_key + args.bad_password + args.newkey:
+                settings['flow'] = 'newkey'
+            if settings.get('flow') == 'changed_key' or 'password' in settings:
+                failing.add(host)
+            devices[host] = settings
+            device_list.write('%s,%s,%s\n' % (host, host, dev_type))
+    with open(os.path.join(scratch, 'devices.json'), 'w') as raw:
+        json.dump(devices, raw)
+
+    bin_dir = os.path.join(scratch, 'bin')
+    os.makedirs(bin_dir)
+    shim = os.path.join(bin_dir, 'ssh')
+    with open(shim, 'w') as raw:
+        raw.write('#!/bin/sh\nexec %s %s "$@"\n' % (
+            args.python, os.path.join(here, 'fake_device.py')))
+    os.chmod(shim, 0o755)
+    return failing
+
+def peak_rss(pid):
+    """Peak resident set size of a running process in KB, or None"""
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def run(args, scratch):
+    commands = ';'.join('show bench %d' % number
+                        for number in range(args.commands))
+    metrics = os.path.join(scratch, 'metrics')
+    env = dict(os.environ)
+    env.update(
+        HOME=scratch,
+        PATH=os.pathsep.join([os.path.join(scratch, 'bin'), env['PATH']]),
+        FAKE_DEVICES=os.path.join(scratch, 'devices.json'))
+    command = [os.path.join(here, 'run_cli.py'),
+               '-l', os.path.join(scratch, 'devices.csv'),
+               '-c', commands, '-u', 'bench', '-t', 'cisco',
+               '--metrics', metrics] + args.run_cli
+
+    log = open(os.path.join(scratch, 'run_cli.log'), 'wb')
+    started = time.time()
+    child = pexpect.spawn(args.python, command, env=env, timeout=None)
+    child.logfile_read = log
+    child.expect('Enter password: ')
+    child.sendline('password')
+    rss = None
+    while child.isalive():
+        rss = peak_rss(child.pid) or rss
+        try:
+            child.expect(pexpect.EOF, timeout=0.2)
+        except pexpect.TIMEOUT:
+            pass
+    elapsed = time.time() - started
+    child.close()
+    log.close()
+    if rss is None:
+        rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    failed = []
+    with open(os.path.join(scratch, 'run_cli.log')) as raw:
+        for line in raw:
+            if 'Could not connect to' in line:
+                failed.append(line.rsplit(None, 1)[-1])
+    try:
+        with open('%s.json' % metrics) as raw:
+            report = json.load(raw)
+    except (IOError, ValueError):
+        report = None
+    return elapsed, rss, failed, report, child.exitstatus
+
+def main():
+    args = check_args()
+    scratch = tempfile.mkdtemp(prefix='run_cli_bench_')
+    try:
+        failing = build_fleet(args, scratch)
+        elapsed, rss, failed, report, status = run(args, scratch)
+    finally:
+        if not args.keep:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    succeeded = args.hosts - len(failed)
+    result = dict(
+        date=datetime.now().isoformat(),
+        hosts=args.hosts,
+        commands=args.commands,
+        run_cli_args=args.run_cli,
+        seconds=round(elapsed, 3),
+        hosts_per_second=round(succeeded / elapsed, 2),
+        commands_per_second=round(succeeded * args.commands / elapsed, 2),
+        failed=len(failed),
+        unexpected_failures=sorted(set(failed) - failing),
+        peak_rss_kb=rss,
+        exit_status=status,
+    )
+    if report:
+        for phase in ('login', 'command'):
+            stats = report['phases'][phase]
+            for quantile in ('p50', 'p95', 'p99'):
+                result['%s_%s' % (phase, quantile)] = stats[quantile]
+        result['bytes_received'] = report['bytes_received']
+
+    for key in sorted(result):
+        sys.stdout.write('%-22s %s\n' % (key, result[key]))
+    if args.keep:
+        sys.stdout.write('%-22s %s\n' % ('scratch', scratch))
+    if args.results:
+        with open(args.results, 'a') as results:
+            results.write(json.dumps(result, sort_keys=True) + '\n')
+    if result['unexpected_failures']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
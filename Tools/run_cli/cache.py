@@ -0,0 +1,204 @@
+#!/usr/bin/env python2.7
+"""On-disk TTL cache of read-only command output for run_cli.
+
+Only commands classified as read-only for a dev_type are cached, keyed
+on host, dev_type and command.  Each entry is a compressed file whose
+mtime is when it was stored and whose atime is when it was last used,
+so the least recently used entries are evicted first once the cache
+grows past max_bytes.
+"""
+
+import errno
+import hashlib
+import os
+import re
+import tempfile
+import time
+import zlib
+
+from sinks import Sink
+
+# Commands that only read state, per dev_type
+read_only_by_dev_type = dict(
+    arista=r'^sh(ow)?\s',
+    force10=r'^sh(ow)?\s',
+    hp_apm=r'^(show|display)\s',
+    root_unix=r'^(cat|df|hostname|ip\s+(addr|route|link)|uname)\b',
+    junos=r'^show\s',
+    cisco=r'^sh(ow)?\s',
+)
+
+# Output redirected to the device changes state even under show
+writes = re.compile(r'\|\s*(append|redirect|tee|save)\b')
+
+# Shell commands can also redirect or chain through these
+shell_writes = re.compile(r'[>;&`$]')
+
+# Commands that only set up the session, they are re-run on every login
+# and never stop a host from being served from the cache
+session_commands = re.compile(
+    r'^(term(inal)?\s+(length|width|len)|set\s+cli\s+screen-|'
+    r'no\s+page|screen-length)')
+
+# Seconds a command's output stays fresh, first match wins
+ttls = [
+    (re.compile(r'^sh(ow)?\s+(ver|inv|module|license)'), 3600),
+    (re.compile(r'^sh(ow)?\s+(run|start|conf)'), 300),
+    (re.compile(r'.'), 60),
+]
+
+class ResultCache(object):
+    def __init__(self, directory=None, max_bytes=256 * 1024 * 1024,
+                 max_age=None):
+        self.directory = directory or os.path.join(
+            os.path.expanduser('~'), 'logs', 'cache')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def cacheable(self, dev_type, command):
+        dev_type = dev_type.lower()
+        pattern = read_only_by_dev_type.get(dev_type)
+        if dev_type == 'root_unix' and shell_writes.search(command):
+            return False
+        return bool(pattern and re.match(pattern, command.strip())
+                    and not writes.search(command))
+
+    def ttl(self, command):
+        """How long output of command stays fresh, capped by max_age"""
+        for pattern, seconds in ttls:
+            if pattern.match(command.strip()):
+                break
+        if self.max_age is not None:
+            seconds = min(seconds, self.max_age)
+        return seconds
+
+    def path(self, host, dev_type, command):
+        key = '\0'.join([host, dev_type.lower(), command.strip()])
+        return os.path.join(
+            self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, host, dev_type, command):
+        """Cached output of command, or None if missing or stale"""
+        if not self.cacheable(dev_type, command):
+            return None
+        path = self.path(host, dev_type, command)
+        try:
+            stored = os.stat(path).st_mtime
+            if time.time() - stored > self.ttl(command):
+                return None
+            with open(path, 'rb') as handle:
+                output = zlib.decompress(handle.read()).decode('utf-8')
+            # Mark as used for LRU eviction, keeping the stored time
+            os.utime(path, (time.time(), stored))
+        except (IOError, OSError, zlib.error):
+            return None
+        return output
+
+    def lookup(self, host, dev_type, commands):
+        """(hits, remaining): the (command, output) pairs served from
+        the cache and the commands that still have to run on the host.
+
+        Session set up commands are only kept in remaining when other
+        commands are too.  Once a command that is not read-only comes
+        up, it and every command after it run, since it may change what
+        they show.  Nothing is served when no command is cached, so a
+        host is only skipped when remaining is empty.
+        """
+        hits = []
+        remaining = []
+        session = []
+        changed = False
+        for command in commands:
+            if not command:
+                continue
+            if session_commands.match(command.strip()):
+                session.append(len(remaining))
+                remaining.append(command)
+                continue
+            changed = changed or not self.cacheable(dev_type, command)
+            output = None if changed else self.get(host, dev_type, command)
+            if output is None:
+                remaining.append(command)
+            else:
+                hits.append((command, output))
+        if hits and len(remaining) == len(session):
+            remaining = []
+        return hits, remaining
+
+    def sink(self, host, dev_type):
+        return CacheSink(self, host, dev_type)
+
+    def store(self, host, dev_type, command, spool):
+        path = self.path(host, dev_type, command)
+        spool.seek(0)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        compressor = zlib.compressobj()
+        with os.fdopen(fd, 'wb') as handle:
+            for data in iter(lambda: spool.read(65536), b''):
+                handle.write(compressor.compress(data))
+            handle.write(compressor.flush())
+        os.rename(tmp, path)
+
+    def prune(self):
+        """Evict least recently used entries until under max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+            total += stat.st_size
+        for atime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+class CacheSink(Sink):
+    """Spools the output of cacheable commands and stores it once the
+    command finishes.  Spools over 1MB go to a temporary file.
+    """
+    def __init__(self, cache, host, dev_type):
+        self.cache = cache
+        self.host = host
+        self.dev_type = dev_type
+        self.command = None
+        self.spool = None
+
+    def begin(self, command):
+        self.command = command
+        if self.cache.cacheable(self.dev_type, command):
+            self.spool = tempfile.SpooledTemporaryFile(
+                max_size=1024 * 1024)
+
+    def write(self, data):
+        if self.spool is not None:
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            self.spool.write(data)
+
+    def end(self):
+        if self.spool is not None:
+            self.cache.store(self.host, self.dev_type, self.command,
+                             self.spool)
+            self.spool.close()
+            self.spool = None
+        self.command = None
+
+    def close(self):
+        # Output of a command that never finished is not cached
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        self.command = None
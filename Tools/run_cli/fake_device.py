@@ -0,0 +1,233 @@
+#!/usr/bin/env python2.7
+"""Simulated network device for exercising run_cli without switches.
+
+Runs in place of ssh: put a directory holding an ``ssh`` script that
+execs this one at the front of PATH and every session run_cli starts
+logs into a simulated device on the pty pexpect gave it instead.  Each
+host behaves as described in the JSON file named by $FAKE_DEVICES, with
+the "*" entry as the default for hosts not listed:
+
+    {"*": {"dev_type": "cisco"},
+     "sw1": {"dev_type": "force10", "flow": "newkey", "latency": 0.05}}
+
+Settings:
+    dev_type        prompt style, one of the params_by_dev_type keys
+    flow            password, newkey, changed_key or key
+    password        password the device accepts
+    login_latency   seconds before the first prompt after the password
+    latency         seconds before each command's output
+    jitter          up to this many extra seconds on top of latency
+    lines, width    size of each command's output
+
+force10 only runs a command on a carriage return, which is what its
+extra_return in run_cli is for.
+"""
+
+import json
+import os
+import random
+import sys
+import time
+import tty
+
+prompts = dict(
+    arista='%(host)s#',
+    force10='%(host)s#',
+    hp_apm='%(host)s> ',
+    root_unix='[root@%(host)s ~]# ',
+    junos='%(user)s@%(host)s> ',
+    cisco='%(host)s# ',
+)
+
+config_prompts = dict(
+    arista='%(host)s(config)#',
+    force10='%(host)s(conf)#',
+    junos='[edit]\r\n%(user)s@%(host)s# ',
+    cisco='%(host)s(config)# ',
+)
+
+# What starts a line the CLI ignores
+comments = dict(
+    arista='!',
+    force10='!',
+    root_unix='#',
+    junos='#',
+    cisco='!',
+)
+
+defaults = dict(
+    dev_type='cisco',
+    flow='password',
+    password='password',
+    login_latency=0.0,
+    latency=0.0,
+    jitter=0.0,
+    lines=10,
+    width=80,
+)
+
+NEWKEY = (
+    "The authenticity of host '%(host)s (%(host)s)' can't be established.\r\n"
+    "RSA key fingerprint is SHA256:bench.\r\n"
+    "Are you sure you want to continue connecting (yes/no)? ")
+
+CHANGED_KEY = (
+    "@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@\r\n"
+    "@    WARNING: REMOTE HOST IDENTIFICATION HAS CHANGED!     @\r\n"
+    "@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@\r\n"
+    "Host key for %(host)s has changed and you have requested strict "
+    "checking.\r\nHost key verification failed.\r\n")
+
+# ssh options that take a value
+valued_options = set('bcDEeFIiJLlmOoPpQRSWw')
+
+class Device(object):
+    def __init__(self, host, user, settings):
+        self.host = host
+        self.user = user
+        self.settings = settings
+        self.dev_type = settings['dev_type']
+        self.names = dict(host=host, user=user)
+        self.prompt = prompts[self.dev_type] % self.names
+        self.pending = b''
+        self.after_cr = False
+        self.random = random.Random(host)
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        while data:
+            data = data[os.write(1, data):]
+
+    def readline(self, echo=True, cli=False):
+        """A line typed at the device.
+
+        On the CLI of a force10 only a carriage return ends a line.
+        """
+        ends = b'\r' if cli and self.dev_type == 'force10' else b'\r\n'
+        while True:
+            for index in range(len(self.pending)):
+                end = self.pending[index:index + 1]
+                if end not in ends:
+                    continue
+                line = self.pending[:index]
+                self.pending = self.pending[index + 1:]
+                # The \n of a \r\n pair may arrive in a later read
+                if line == b'' and end == b'\n' and self.after_cr:
+                    self.after_cr = False
+                    return self.readline(echo, cli)
+                self.after_cr = end == b'\r'
+                line = line.replace(b'\r', b'').replace(b'\n', b'')
+                line = line.decode('utf-8', 'replace')
+                if echo:
+                    self.write(line + '\r\n')
+                return line
+            data = os.read(0, 4096)
+            if not data:
+                sys.exit(0)
+            self.pending += data
+
+    def login(self):
+        flow = self.settings['flow']
+        if flow == 'changed_key':
+            self.write(CHANGED_KEY % self.names)
+            sys.exit(255)
+        if flow == 'newkey':
+            self.write(NEWKEY % self.names)
+            if self.readline() != 'yes':
+                self.write('Host key verification failed.\r\n')
+                sys.exit(255)
+            self.write("Warning: Permanently added '%s' (RSA) to the list "
+                       "of known hosts.\r\n" % self.host)
+        if flow != 'key':
+            while True:
+                self.write('%s@%s\'s password: ' % (self.user, self.host))
+                if self.readline(echo=False) == self.settings['password']:
+                    self.write('\r\n')
+                    break
+                self.write('\r\nPermission denied, please try again.\r\n')
+        time.sleep(self.settings['login_latency'])
+        self.write('\r\nWelcome to the simulated %s %s\r\n%s' % (
+            self.dev_type, self.host, self.prompt))
+
+    def output(self, command):
+        """Canned output for command, the same every time it is run"""
+        width = self.settings['width']
+        lines = []
+        for number in range(self.settings['lines']):
+            line = '%s %s %05d ' % (self.host, command, number)
+            lines.append((line * (width // len(line) + 1))[:width])
+        return '\r\n'.join(lines)
+
+    def run(self):
+        self.login()
+        base = self.prompt
+        while True:
+            command = self.readline(cli=True).strip()
+            if command in ('exit', 'quit', 'logout'):
+                if self.prompt == base:
+                    return
+                self.prompt = base
+                self.write(self.prompt)
+                continue
+            if not command or command.startswith(
+                    comments.get(self.dev_type, '\0')):
+                self.write(self.prompt)
+                continue
+            time.sleep(self.settings['latency'] +
+                       self.random.uniform(0, self.settings['jitter']))
+            words = command.split()
+            if words[0] in ('conf', 'config', 'configure') \
+            and self.dev_type in config_prompts:
+                self.prompt = config_prompts[self.dev_type] % self.names
+                self.write(self.prompt)
+            elif words[0] == 'end':
+                self.prompt = base
+                self.write(self.prompt)
+            else:
+                self.write('%s\r\n%s' % (self.output(command), self.prompt))
+
+def parse_ssh_args(argv):
+    """(user, host, control) from an ssh command line"""
+    user = os.environ.get('USER', 'root')
+    host = None
+    control = False
+    args = iter(argv)
+    for arg in args:
+        if arg.startswith('-') and len(arg) > 1:
+            option = arg[1]
+            value = arg[2:] or (next(args, '') if option in valued_options
+                                else '')
+            if option == 'l':
+                user = value
+            elif option == 'O':
+                control = True
+        elif host is None:
+            host = arg
+    if host and '@' in host:
+        user, host = host.split('@', 1)
+    return user, host, control
+
+def settings_for(host):
+    settings = dict(defaults)
+    path = os.environ.get('FAKE_DEVICES')
+    if path:
+        with open(path) as raw:
+            devices = json.load(raw)
+        settings.update(devices.get('*', {}))
+        settings.update(devices.get(host, {}))
+    return settings
+
+def main():
+    user, host, control = parse_ssh_args(sys.argv[1:])
+    if control:
+        # ssh -O check/exit for a pooled master, there is none to talk to
+        sys.exit(0)
+    if not host:
+        sys.stderr.write('usage: fake_device.py [-l user] host\n')
+        sys.exit(255)
+    if os.isatty(0):
+        tty.setraw(0)
+    Device(host, user, settings_for(host)).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python2.7
+"""Content addressed, de-duplicated history of run_cli output.
+
+Output is cut into blocks of lines at content defined boundaries, so an
+insertion only changes the blocks around it.  Each block is stored once
+under its SHA-1 in objects/, and each output is stored as a manifest
+listing its block hashes, itself addressed by hash.  A run is a file in
+runs/ mapping host and command to the manifest of its output.  Output
+of a command that never finished is not recorded.
+
+Comparing two runs only compares manifest hashes, and diffs only read
+the blocks that differ, so both scale with how much changed rather than
+with how much was collected.
+
+Usage:
+    history.py [-r run] [-s since] [-H host] [-d]
+"""
+
+import argparse
+import errno
+import hashlib
+import os
+import sys
+import threading
+import zlib
+
+from datetime import datetime
+from difflib import SequenceMatcher, unified_diff
+
+from sinks import Sink
+
+# A block ends after a line whose hash is 0 mod BOUNDARY, or at MAX_LINES
+BOUNDARY = 16
+MAX_LINES = 256
+
+class History(object):
+    def __init__(self, directory=None, run=None):
+        self.directory = directory or os.path.join(
+            os.path.expanduser('~'), 'logs', 'history')
+        # Microseconds keep runs started in the same second apart
+        self.run = run or datetime.now().strftime('%Y-%m-%d-%H%M%S-%f')
+        self.lock = threading.Lock()
+        for name in ('objects', 'runs'):
+            try:
+                os.makedirs(os.path.join(self.directory, name))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def sink(self, host):
+        """Sink that records the output of each command run on host"""
+        return HistorySink(self, host)
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest[2:])
+
+    def put(self, data):
+        """Store data unless an object with the same hash exists"""
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # Write then rename so readers never see half an object
+            tmp = '%s.%s.tmp' % (path, threading.current_thread().ident)
+            with open(tmp, 'wb') as handle:
+                handle.write(zlib.compress(data))
+            os.rename(tmp, path)
+        return digest
+
+    def get(self, digest):
+        with open(self.object_path(digest), 'rb') as handle:
+            return zlib.decompress(handle.read())
+
+    def record(self, host, command, manifest):
+        with self.lock:
+            with open(self.run_path(self.run), 'a') as run:
+                run.write('%s\t%s\t%s\n' % (
+                    manifest, host, command.replace('\n', ' ')))
+
+    def run_path(self, run):
+        return os.path.join(self.directory, 'runs', '%s.tsv' % run)
+
+    def runs(self):
+        return sorted(name[:-len('.tsv')] for name in os.listdir(
+            os.path.join(self.directory, 'runs')) if name.endswith('.tsv'))
+
+    def load(self, run):
+        """Map (host, command) to output manifest for a run"""
+        outputs = {}
+        if run is None or not os.path.exists(self.run_path(run)):
+            return outputs
+        with open(self.run_path(run)) as handle:
+            for line in handle:
+                manifest, host, command = line.rstrip('\n').split('\t', 2)
+                outputs[(host, command)] = manifest
+        return outputs
+
+    def changes(self, run=None, since=None):
+        """Yield (status, host, command, old, new) for every output of
+        run (default: the latest run) that differs from the last time
+        that host ran that command, in since or a run before it
+        (default: any run before run).  status is added or changed.
+
+        Runs over different inventories or command sets only compare
+        what they have in common, a host or command left out of run is
+        not reported.
+        """
+        runs = self.runs()
+        run = run or (runs[-1] if runs else None)
+        new = self.load(run)
+        old = self.last_seen(
+            new, [name for name in runs if name < run and
+                  (since is None or name <= since)])
+        for key in sorted(new):
+            if key not in old:
+                yield ('added', key[0], key[1], None, new[key])
+            elif old[key] != new[key]:
+                yield ('changed', key[0], key[1], old[key], new[key])
+
+    def last_seen(self, keys, runs):
+        """Map each (host, command) in keys to its manifest in the latest
+        of runs that recorded it"""
+        seen = {}
+        for name in reversed(runs):
+            if len(seen) == len(keys):
+                break
+            for key, manifest in self.load(name).items():
+                if key in keys and key not in seen:
+                    seen[key] = manifest
+        return seen
+
+    def blocks(self, manifest):
+        if manifest is None:
+            return []
+        return self.get(manifest).decode('ascii').split()
+
+    def diff(self, old, new, label=''):
+        """Unified diff of two outputs that only reads differing blocks"""
+        old_blocks, new_blocks = self.blocks(old), self.blocks(new)
+        lines = []
+        matcher = SequenceMatcher(None, old_blocks, new_blocks, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+            before = ''.join(self.get(digest).decode('utf-8', 'replace')
+                             for digest in old_blocks[i1:i2])
+            after = ''.join(self.get(digest).decode('utf-8', 'replace')
+                            for digest in new_blocks[j1:j2])
+            lines.extend(unified_diff(
+                before.splitlines(True), after.splitlines(True),
+                '%s (block %d)' % (label, i1), '%s (block %d)' % (label, j1)))
+        return ''.join(lines)
+
+class HistorySink(Sink):
+    """Cuts each command's output into blocks as it streams in.
+
+    Only the current block is held in memory.
+    """
+    def __init__(self, history, host):
+        self.history = history
+        self.host = host
+        self.command = None
+
+    def begin(self, command):
+        self.command = command
+        self.partial = b''
+        self.lines = []
+        self.digests = []
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.partial += data
+        lines = self.partial.split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            line += b'\n'
+            self.lines.append(line)
+            if len(self.lines) >= MAX_LINES or \
+                    int(hashlib.md5(line).hexdigest()[:8], 16) % BOUNDARY == 0:
+                self.cut()
+
+    def cut(self):
+        if self.lines:
+            self.digests.append(self.history.put(b''.join(self.lines)))
+            self.lines = []
+
+    def end(self):
+        if self.partial:
+            self.lines.append(self.partial)
+            self.partial = b''
+        self.cut()
+        manifest = self.history.put('\n'.join(self.digests).encode('ascii'))
+        self.history.record(self.host, self.command, manifest)
+        self.command = None
+
+    def close(self):
+        # Output of a command that never finished is not recorded
+        self.command = None
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report what changed in run_cli output between runs")
+    parser.add_argument(
+        '-r', '--run', type=str, help='Run to report on, default latest')
+    parser.add_argument(
+        '-s', '--since', type=str,
+        help='Run to compare against, default the one before --run')
+    parser.add_argument(
+        '-H', '--host', type=str, help='Only report on this host')
+    parser.add_argument(
+        '-d', '--diff', action='store_true',
+        help='Show a diff of each changed output')
+    parser.add_argument(
+        '--directory', type=str, help='History directory', default=None)
+    args = parser.parse_args()
+
+    history = History(args.directory)
+    for status, host, command, old, new in history.changes(
+            args.run, args.since):
+        if args.host and host != args.host:
+            continue
+        sys.stdout.write('%-8s %s: %s\n' % (status, host, command))
+        if args.diff:
+            sys.stdout.write(history.diff(
+                old, new, '%s: %s' % (host, command)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python2.7
+"""Compiled device inventories for run_cli.
+
+YAML inventories are parsed with the C loader when PyYAML has one, the
+anchors and global_commands merges are resolved once, and the result is
+pickled under ~/.cache/run_cli.  The pickle is reused for as long as
+the source file's mtime and size are unchanged, or its content hash
+still matches when they are not.  CSV device lists are streamed a row at
+a time and compiled the same way.
+
+Hosts are indexed by type, so selecting a subset by type or hostname
+pattern works on the compiled inventory instead of re-reading the file.
+"""
+
+import csv
+import errno
+import fnmatch
+import hashlib
+import logging
+import os
+import yaml
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
+# Bump when the compiled form changes so old caches are rebuilt
+VERSION = 1
+
+class Inventory(object):
+    """Hosts in inventory order, each with a name, type and commands.
+
+    Hosts from a CSV list have no commands of their own (None), they
+    take the commands given on the command line.
+    """
+    def __init__(self):
+        self.hosts = []
+        self.devices = {}
+        self.by_type = {}
+        self.errors = []
+
+    def add(self, host, name, dev_type, commands):
+        if host in self.devices:
+            return
+        self.hosts.append(host)
+        self.devices[host] = (name, dev_type, commands)
+        self.by_type.setdefault(
+            dev_type.lower() if dev_type else None, []).append(host)
+
+    def select(self, types=None, pattern=None, default_type=None):
+        """(host, dev_type, commands) for hosts of one of types whose
+        address or name matches the shell style pattern.  Hosts without
+        a type of their own count as default_type.
+        """
+        if types:
+            types = [dev_type.lower() for dev_type in types]
+            if default_type and default_type.lower() in types:
+                types.append(None)
+            wanted = set()
+            for dev_type in types:
+                wanted.update(self.by_type.get(dev_type, []))
+            hosts = [host for host in self.hosts if host in wanted]
+        else:
+            hosts = self.hosts
+        for host in hosts:
+            name, dev_type, commands = self.devices[host]
+            if pattern and not fnmatch.fnmatch(host, pattern) \
+            and not (name and fnmatch.fnmatch(name, pattern)):
+                continue
+            yield host, dev_type, commands
+
+def compile_yaml(path):
+    inventory = Inventory()
+    with open(path) as raw:
+        devices = yaml.load(raw, Loader=Loader) or {}
+    for host, raw_commands in devices.items():
+        host = str(host) if host is not None else host
+        if not host or host.lower() == 'default':
+            continue
+        raw_commands = raw_commands or {}
+        # global_commands usually arrive through a merge of the default
+        # anchor, they run ahead of the host's own commands
+        commands = list(raw_commands.get('global_commands') or []) + \
+            list(raw_commands.get('commands') or [])
+        if 'commands' not in raw_commands \
+        and 'global_commands' not in raw_commands:
+            inventory.errors.append(
+                'YAML file must define commands for %s '
+                'or global_commands for default' % host)
+            continue
+        inventory.add(host, host, raw_commands.get('type'), commands)
+    return inventory
+
+def compile_csv(path):
+    """<ip>,<hostname>,<device_type> per line, only the ip is required"""
+    inventory = Inventory()
+    with open(path) as raw:
+        for row in csv.reader(raw):
+            if not row or not row[0].strip() \
+            or row[0].strip().startswith('#'):
+                continue
+            row = [field.strip() for field in row]
+            name = row[1] if len(row) > 1 and row[1] else None
+            dev_type = row[2] if len(row) > 2 and row[2] else None
+            inventory.add(row[0], name, dev_type, None)
+    return inventory
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as raw:
+        for block in iter(lambda: raw.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load(path, compiler, cache_dir=None):
+    """Compiled inventory for path, rebuilt only when the file changed"""
+    logger = logging.getLogger(__name__)
+    cache_dir = cache_dir or os.path.join(
+        os.path.expanduser('~'), '.cache', 'run_cli')
+    cache_path = os.path.join(cache_dir, '%s.pickle' % hashlib.sha1(
+        ('%s:%s' % (compiler.__name__, os.path.abspath(path)))
+        .encode('utf-8')).hexdigest())
+    stat = os.stat(path)
+    signature = (VERSION, stat.st_mtime, stat.st_size)
+
+    digest = None
+    try:
+        with open(cache_path, 'rb') as cached:
+            cached_signature, cached_digest, inventory = pickle.load(cached)
+        if cached_signature == signature:
+            return inventory
+        # Touched but maybe not changed, fall back to the content hash
+        digest = file_hash(path)
+        if cached_signature[0] == VERSION and cached_digest == digest:
+            save(cache_path, signature, digest, inventory)
+            return inventory
+    except (IOError, OSError, EOFError, ValueError, TypeError,
+            pickle.UnpicklingError):
+        pass
+
+    logger.debug('Compiling inventory %s' % path)
+    inventory = compiler(path)
+    save(cache_path, signature, digest or file_hash(path), inventory)
+    return inventory
+
+def save(cache_path, signature, digest, inventory):
+    try:
+        os.makedirs(os.path.dirname(cache_path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    tmp = '%s.%d.tmp' % (cache_path, os.getpid())
+    with open(tmp, 'wb') as cached:
+        pickle.dump((signature, digest, inventory), cached,
+                    pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, cache_path)
+
+def load_yaml(path, cache_dir=None):
+    return load(path, compile_yaml, cache_dir)
+
+def load_csv(path, cache_dir=None):
+    return load(path, compile_csv, cache_dir)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python2.7
+"""Checkpoint journal for resuming interrupted run_cli runs.
+
+Every command that finishes on a host, and every host that finishes all
+of its commands, is appended to the journal.  Appends are handed to a
+background thread that writes them in batches with one fsync per batch,
+so workers never wait on the disk.  A line is only trusted once its
+newline is on disk, so a crash mid-write loses at most the last batch.
+A run that finishes ends its journal with an E line; a journal without
+one is only started over when asked to.
+"""
+
+import errno
+import os
+import re
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from cache import session_commands
+from sinks import Sink
+
+# Entering and leaving configuration mode, for resuming mid-block
+config_enter = re.compile(r'^(conf(ig(ure)?)?|edit)\b')
+config_leave = re.compile(r'^(end|commit(\s+and-quit)?)\s*$')
+
+class Journal(object):
+    def __init__(self, path, resume=False, overwrite=False,
+                 flush_interval=0.5, batch=1000):
+        if not (resume or overwrite) and interrupted(path):
+            raise ValueError('%s is the journal of an interrupted run' % path)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch = batch
+        self.hosts = set()
+        self.commands = {}
+        self.plans = {}
+        if resume:
+            self.load()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.handle = open(path, 'a' if resume else 'w')
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_batches)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def load(self):
+        good = 0
+        try:
+            with open(self.path, 'rb') as raw:
+                for line in raw:
+                    if not line.endswith(b'\n'):
+                        # Torn write from a crash, nothing after it counts
+                        break
+                    good += len(line)
+                    fields = line.decode('utf-8').rstrip('\n').split('\t')
+                    if fields[0] == 'H':
+                        self.hosts.add(fields[1])
+                    elif fields[0] == 'C':
+                        self.commands.setdefault(fields[1], {})[
+                            int(fields[2])] = fields[3]
+            if os.path.getsize(self.path) > good:
+                with open(self.path, 'r+b') as raw:
+                    raw.truncate(good)
+        except (IOError, OSError):
+            pass
+
+    def sink(self, host):
+        """Sink that journals each command on host as it completes"""
+        return JournalSink(self, host, self.plans.get(host, []))
+
+    def command_done(self, host, index, command):
+        self.queue.put('C\t%s\t%d\t%s\n' % (host, index, clean(command)))
+
+    def host_done(self, host):
+        self.queue.put('H\t%s\n' % host)
+
+    def finish(self):
+        """Mark the run as finished, so the journal can be started over"""
+        self.queue.put('E\n')
+
+    def pending(self, jobs):
+        """The (host, dev_type, commands) jobs still to run, each with
+        only the commands it has left.
+
+        Commands are numbered by position in the host's command list, so
+        a host resumes at its first unfinished command.  Session set up
+        commands before that point are run again, and a host that
+        stopped inside a configuration block starts again at the command
+        that entered it so the rest of the block is not sent outside
+        configuration mode.
+        """
+        for host, dev_type, commands in jobs:
+            commands = [command for command in commands or [] if command]
+            if host in self.hosts:
+                continue
+            done = self.commands.get(host, {})
+            start = 0
+            while start < len(commands) and \
+                    done.get(start) == clean(commands[start]):
+                start += 1
+            if commands and start == len(commands):
+                continue
+            block = None
+            for index, command in enumerate(commands[:start]):
+                if config_enter.match(command.strip()):
+                    block = index if block is None else block
+                elif config_leave.match(command.strip()):
+                    block = None
+            if block is not None:
+                start = block
+            plan = [(index, command) for index, command
+                    in enumerate(commands[:start])
+                    if session_commands.match(command.strip())]
+            plan.extend(enumerate(commands[start:], start))
+            self.plans[host] = plan
+            yield host, dev_type, [command for index, command in plan]
+
+    def write_batches(self):
+        """Gather lines for up to flush_interval after the first one
+        arrives, then write and fsync them together.
+        """
+        while True:
+            lines = [self.queue.get()]
+            flush_at = time.time() + self.flush_interval
+            while lines[-1] is not None and len(lines) < self.batch:
+                try:
+                    lines.append(self.queue.get(
+                        timeout=max(0, flush_at - time.time())))
+                except queue.Empty:
+                    break
+            stopping = lines[-1] is None
+            if stopping:
+                lines.pop()
+            if lines:
+                self.handle.write(''.join(lines))
+                self.handle.flush()
+                os.fsync(self.handle.fileno())
+            if stopping:
+                return
+
+    def close(self):
+        """Write out anything still queued and stop the writer"""
+        self.queue.put(None)
+        self.writer.join()
+        self.handle.close()
+
+class JournalSink(Sink):
+    """Matches each command run on host against its plan, commands the
+    cache leaves out are simply never matched.
+    """
+    def __init__(self, journal, host, plan):
+        self.journal = journal
+        self.host = host
+        self.plan = plan
+        self.position = 0
+        self.index = None
+
+    def begin(self, command):
+        self.index = None
+        for position in range(self.position, len(self.plan)):
+            if self.plan[position][1] == command:
+                self.index = self.plan[position][0]
+                self.position = position + 1
+                break
+
+    def end(self):
+        if self.index is not None:
+            self.journal.command_done(
+                self.host, self.index, self.plan[self.position - 1][1])
+        self.index = None
+
+def interrupted(path):
+    """Whether path holds the journal of a run that never finished"""
+    try:
+        with open(path, 'rb') as raw:
+            raw.seek(0, os.SEEK_END)
+            size = raw.tell()
+            raw.seek(max(0, size - 3))
+            tail = raw.read()
+    except (IOError, OSError):
+        return False
+    return size > 0 and not (tail == b'E\n' or tail.endswith(b'\nE\n'))
+
+def clean(command):
+    return re.sub(r'[\t\r\n]+', ' ', command.strip())
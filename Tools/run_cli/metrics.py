@@ -0,0 +1,204 @@
+#!/usr/bin/env python2.7
+"""Per phase timing of run_cli sessions.
+
+Each session reports how long it spent in every phase:
+
+    spawn       starting the ssh child
+    login       from the child starting to the first prompt
+    command     from sending a command to its prompt coming back
+    write       writing a command's output to its sinks
+    transcript  writing the session transcript
+
+along with how many bytes of command output each host sent.  Timings
+are kept per phase and per command and reported as p50/p95/p99, as JSON
+or as Prometheus text format for the node exporter's textfile collector.
+Write and transcript time is spent while a command is being read, so it
+is also part of that command's time.
+
+When metrics are off nothing here is created and the sessions skip all
+of it.
+"""
+
+import json
+import math
+import threading
+import time
+
+from sinks import Sink
+
+PHASES = ('spawn', 'login', 'command', 'write', 'transcript')
+QUANTILES = (0.5, 0.95, 0.99)
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = dict((phase, []) for phase in PHASES)
+        self.commands = {}
+        self.hosts = {}
+
+    def now(self):
+        return time.time()
+
+    def host(self, host):
+        entry = self.hosts.get(host)
+        if entry is None:
+            entry = self.hosts[host] = dict(
+                (phase, 0.0) for phase in PHASES)
+            entry['bytes_received'] = 0
+            entry['commands'] = 0
+        return entry
+
+    def observe(self, phase, host, seconds, command=None):
+        with self.lock:
+            self.phases[phase].append(seconds)
+            entry = self.host(host)
+            entry[phase] += seconds
+            if command is not None:
+                self.commands.setdefault(command, []).append(seconds)
+                entry['commands'] += 1
+
+    def received(self, host, count):
+        with self.lock:
+            self.host(host)['bytes_received'] += count
+
+    def sink(self, host, sink):
+        """sink, timing how long it takes to write each command"""
+        return TimedSink(self, host, sink)
+
+    def logfile(self, host, handle):
+        """handle, timing how long writes to it take in total"""
+        return TimedFile(self, host, handle)
+
+    def report(self):
+        with self.lock:
+            return dict(
+                phases=dict((phase, summary(samples))
+                            for phase, samples in self.phases.items()),
+                commands=dict((command, summary(samples))
+                              for command, samples in self.commands.items()),
+                hosts=dict((host, dict(entry))
+                           for host, entry in self.hosts.items()),
+                bytes_received=sum(entry['bytes_received']
+                                   for entry in self.hosts.values()))
+
+    def prometheus(self):
+        report = self.report()
+        lines = [
+            '# HELP run_cli_phase_seconds Time spent in each session phase',
+            '# TYPE run_cli_phase_seconds summary',
+        ]
+        for phase in PHASES:
+            stats = report['phases'][phase]
+            for quantile in QUANTILES:
+                lines.append(
+                    'run_cli_phase_seconds{phase="%s",quantile="%s"} %s' % (
+                        phase, quantile, sample(stats, quantile)))
+            lines.append('run_cli_phase_seconds_sum{phase="%s"} %s' % (
+                phase, stats['sum']))
+            lines.append('run_cli_phase_seconds_count{phase="%s"} %d' % (
+                phase, stats['count']))
+        lines.extend([
+            '# HELP run_cli_command_seconds Time from sending each command '
+            'to its prompt',
+            '# TYPE run_cli_command_seconds summary',
+        ])
+        for command in sorted(report['commands']):
+            stats = report['commands'][command]
+            label = escape(command)
+            for quantile in QUANTILES:
+                lines.append('run_cli_command_seconds{command="%s",'
+                             'quantile="%s"} %s' % (
+                                 label, quantile, sample(stats, quantile)))
+            lines.append('run_cli_command_seconds_sum{command="%s"} %s' % (
+                label, stats['sum']))
+            lines.append('run_cli_command_seconds_count{command="%s"} %d' % (
+                label, stats['count']))
+        lines.extend([
+            '# HELP run_cli_bytes_received_total Bytes of command output '
+            'received',
+            '# TYPE run_cli_bytes_received_total counter',
+        ])
+        for host in sorted(report['hosts']):
+            lines.append('run_cli_bytes_received_total{host="%s"} %d' % (
+                escape(host), report['hosts'][host]['bytes_received']))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, prefix):
+        """Write <prefix>.json and <prefix>.prom"""
+        with open('%s.json' % prefix, 'w') as handle:
+            json.dump(self.report(), handle, indent=2, sort_keys=True)
+        with open('%s.prom' % prefix, 'w') as handle:
+            handle.write(self.prometheus())
+
+class TimedSink(Sink):
+    def __init__(self, metrics, host, sink):
+        self.metrics = metrics
+        self.host = host
+        self.sink = sink
+        self.spent = 0.0
+
+    def begin(self, command):
+        started = time.time()
+        self.sink.begin(command)
+        self.spent = time.time() - started
+
+    def write(self, data):
+        started = time.time()
+        self.sink.write(data)
+        self.spent += time.time() - started
+
+    def end(self):
+        started = time.time()
+        self.sink.end()
+        self.spent += time.time() - started
+        self.metrics.observe('write', self.host, self.spent)
+
+    def close(self):
+        self.sink.close()
+
+    def getvalue(self):
+        return self.sink.getvalue()
+
+class TimedFile(object):
+    def __init__(self, metrics, host, handle):
+        self.metrics = metrics
+        self.host = host
+        self.handle = handle
+        self.spent = 0.0
+
+    def write(self, data):
+        started = time.time()
+        self.handle.write(data)
+        self.spent += time.time() - started
+
+    def flush(self):
+        started = time.time()
+        self.handle.flush()
+        self.spent += time.time() - started
+
+    def close(self):
+        self.handle.close()
+        self.metrics.observe('transcript', self.host, self.spent)
+
+def summary(samples):
+    samples = sorted(samples)
+    stats = dict(count=len(samples), sum=round(sum(samples), 6),
+                 max=round(samples[-1], 6) if samples else None)
+    for quantile in QUANTILES:
+        stats['p%d' % round(quantile * 100)] = quantile_of(samples, quantile)
+    return stats
+
+def quantile_of(samples, quantile):
+    """Nearest rank quantile of sorted samples"""
+    if not samples:
+        return None
+    rank = int(math.ceil(quantile * len(samples))) - 1
+    return round(samples[max(0, min(rank, len(samples) - 1))], 6)
+
+def sample(stats, quantile):
+    value = stats['p%d' % round(quantile * 100)]
+    return 'NaN' if value is None else value
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
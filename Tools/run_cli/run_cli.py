@@ -1,71 +1,117 @@
 #!/usr/bin/env python2.7
 
 import argparse
+import binascii
 import itertools
 import logging
 import os
 import pexpect
 import re
 import sys
-import yaml
 import errno
+import hashlib
 
 from collections import namedtuple
 from datetime import *
 from getpass import getpass
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from inventory import Inventory, load_csv, load_yaml
+from scheduler import Deadline, LatencyHistory, LoginTimeout, retry
+from sinks import CommandFileSink, FileSink, RingSink, TeeSink
+
+# comment starts a line the CLI ignores, --pipeline needs one
+params_by_dev_type = dict(
+    arista={'prompt': "#$", 'comment': "!"},
+    force10={'prompt': "#$", 'extra_return': "\r", 'comment': "!"},
+    hp_apm={'prompt': "> $"},
+    root_unix={'prompt': "# $", 'comment': "#"},
+    junos={'prompt': "[>%#] $", 'comment': "#"},
+    cisco={'prompt': "# $", 'comment': "!"},
+)
 
 class Connect(object):
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         self.host, self.dev_type, self.dev_method, self.username, \
         self.password, self.ssh_key, self.timeout = args
 
         if self.dev_method == 'ssh':
-            self.connect = SSH(self.host, self.dev_type, self.username, self.password, self.ssh_key, self.timeout)
+            self.connect = SSH(self.host, self.dev_type, self.username, self.password, self.ssh_key, self.timeout, **kwargs)
         else:
             raise ValueError("%s is not supported" % self.dev_method)
 
     def close(self):
         """Close method for session"""
-        self.connect.device.close()
+        self.connect.close()
 
 class SSH(object):
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         self.stdout = True
         self.host, self.dev_type, self.username, self.password, self.ssh_key, self.timeout = args
+        self.pool = kwargs.get('pool')
+        self.transcript = kwargs.get('transcript', True)
+        self.deadline = kwargs.get('deadline')
+        self.pipeline = kwargs.get('pipeline', 0)
+        self.metrics = kwargs.get('metrics')
+        # Output is streamed into sinks as it arrives; only the last
+        # ring_bytes of it stay in memory for self.output
+        self.sink = kwargs.get('sink')
+        self.ring_bytes = kwargs.get('ring_bytes', 1024 * 1024)
+        self.ring = RingSink(self.ring_bytes)
+        self.pending = ''
         self.logger = logging.getLogger(__name__)
         self.dev_type = self.dev_type.lower()
 
-        params_by_dev_type = dict(
-            arista={'prompt': "#$"},
-            force10={'prompt': "#$", 'extra_return': "\r"},
-            hp_apm={'prompt': "> $"},
-            root_unix={'prompt': "# $"},
-            junos={'prompt': "[>%#] $"},
-            cisco={'prompt': "# $"},
-        )
-
         if self.dev_type not in params_by_dev_type.keys():
             raise ValueError("%s not yet supported" % self.dev_type)
         expect_params = params_by_dev_type.get(self.dev_type)
 
         self.prompt = expect_params.get('prompt')
         self.extra_return = expect_params.get('extra_return', "")
+        self.comment = expect_params.get('comment')
+
+        try:
+            self.login()
+        except Exception:
+            # Nothing else gets hold of a session that failed to log in,
+            # so hang up before it is retried or given up on
+            self.close()
+            raise
 
-        self.login()
+    def close(self):
+        """Hang up and close the transcript"""
+        device = getattr(self, 'device', None)
+        if device is None:
+            return
+        device.close()
+        if device.logfile_read:
+            device.logfile_read.close()
 
     def login(self):
         ''' Logs into a device or reports a failure '''
         ssh_newkey = 'Are you sure you want to continue connecting'
 
         self.logger.info('Connecting to %s' % self.host)
+        # Reuse a pooled master connection when one is available
+        ssh = 'ssh'
+        if self.pool:
+            ssh = 'ssh %s' % self.pool.lease(self.host, self.username)
+        if self.metrics:
+            started = self.metrics.now()
         if self.ssh_key:
             self.device = pexpect.spawn(
-                'ssh -i %s -l %s %s' % (
-                    self.ssh_key, self.username, self.host))
+                '%s -i %s -l %s %s' % (
+                    ssh, self.ssh_key, self.username, self.host))
         else:
             self.device = pexpect.spawn(
-                'ssh -l %s %s' % (self.username, self.host), maxread=100000)
+                '%s -l %s %s' % (ssh, self.username, self.host),
+                maxread=100000)
         self.device.delaybeforesend = .0250
+        if self.metrics:
+            spawned = self.metrics.now()
+            self.metrics.observe('spawn', self.host, spawned - started)
+        if self.deadline:
+            self.device.timeout = self.deadline.cap(self.device.timeout)
         def mkdirp(path):
             """Make the directories in a path if they don't exist."""
             try:
@@ -75,12 +121,16 @@ class SSH(object):
                 if e.errno != errno.EEXIST:
                     raise
         mkdirp(os.path.join(os.path.expanduser('~'), 'logs'))
+        self.date = datetime.now().strftime('%Y-%m-%d-%H%M')
         try:
-            self.date = datetime.now().strftime('%Y-%m-%d-%H%M')
-            self.device.logfile_read = open(
-                '%s/logs/%s_%s.txt' % (
-                    os.path.expanduser('~'), self.host, self.date),
-                'w')
+            if self.transcript:
+                self.device.logfile_read = open(
+                    '%s/logs/%s_%s.txt' % (
+                        os.path.expanduser('~'), self.host, self.date),
+                    'w')
+                if self.metrics:
+                    self.device.logfile_read = self.metrics.logfile(
+                        self.host, self.device.logfile_read)
         except IOError as e:
             self.logger.critical('Could not open logfile for writing')
             self.logger.critical('Continuing to execute without log')
@@ -91,7 +141,7 @@ class SSH(object):
         if i == 0: # Timeout
             self.logger.error('ERROR!')
             self.logger.error('SSH could not login. Here is what SSH said:')
-            raise ValueError('Device timed out')
+            raise LoginTimeout('Device timed out')
 
         elif i == 1: # SSH does not have the public key. Just accept it.
             self.device.sendline ('yes')
@@ -100,7 +150,7 @@ class SSH(object):
                 self.logger.error('ERROR!')
                 self.logger.error('SSH could not login. Here is what SSH said:')
                 self.logger.error(self.device.before, self.device.after)
-                return None
+                raise LoginTimeout('Device timed out')
             if conn == 1: # password
                 self.device.sendline(self.password)
                 last_check = self.device.expect([self.prompt, 'assword:'])
@@ -117,7 +167,7 @@ class SSH(object):
                     self.logger.error(self.device.before)
                 if self.device.after:
                     self.logger.error(self.device.after)
-                return None
+                raise LoginTimeout('Device timed out')
             elif conn == 1:
                 # do nothing, this is what we want
                 pass
@@ -129,27 +179,157 @@ class SSH(object):
             self.logger.error(self.device.before)
             raise ValueError('SSH key changed...exiting')
         elif i == 4: # Hop box
-            pass
+            # Its prompt is not the device's, so never pipeline
+            self.comment = None
         elif i == 5: # ssh-key authentication
             pass
 
+        if self.metrics:
+            self.metrics.observe(
+                'login', self.host, self.metrics.now() - spawned)
         self.logger.info("Connected to %s" % self.host)
 
 
+    @property
+    def output(self):
+        """The tail of the output from the last call to send()"""
+        return self.ring.getvalue()
+
+    def read_until(self, pattern, sink, window=4096, chunk=65536):
+        """Stream device output into sink until pattern matches.
+
+        Unlike expect(), only the last window characters are held back
+        to search for the prompt; everything older goes to the sink as
+        soon as it arrives.  The start of the output is kept in
+        self.head and anything read past the match is kept for the next
+        call.  Returns the match.
+        """
+        data, self.pending = self.pending, ''
+        self.head = ''
+        timeout = self.timeout
+        if self.deadline:
+            timeout = self.deadline.cap(timeout)
+        deadline = datetime.now() + timedelta(seconds=timeout)
+        while True:
+            match = pattern.search(data)
+            if match:
+                flushed, self.pending = data[:match.start()], data[match.end():]
+            elif len(data) > window:
+                flushed, data = data[:-window], data[-window:]
+            else:
+                flushed = ''
+            if flushed:
+                if len(self.head) < window:
+                    self.head += flushed[:window - len(self.head)]
+                sink.write(flushed)
+            if match:
+                return match
+            remaining = (deadline - datetime.now()).total_seconds()
+            if remaining <= 0:
+                raise pexpect.TIMEOUT('Timeout exceeded.')
+            received = self.device.read_nonblocking(chunk, timeout=remaining)
+            if self.metrics:
+                self.metrics.received(self.host, len(received))
+            data += received
+
     def send(self, output_file=None, *lines):
-        self.output = ""
-        for line in lines:
-            if not line:
-                continue
-            self.logger.info("Executing: %s" % line)
-            self.device.sendline('{0}{1}'.format(line, self.extra_return))
-            self.device.expect(self.prompt, timeout=self.timeout)
-            self.output += self.device.before
+        self.ring = RingSink(self.ring_bytes)
+        sinks = []
+        if self.sink:
+            sinks.append(self.sink)
         if output_file:
-            log_filename = '%s/logs/%s_%s_%s.txt' % (
-                os.path.expanduser('~'), self.host, output_file, self.date)
-            with open(log_filename, 'w+') as cli_results:
-                cli_results.write(self.output + "\n")
+            file_sink = FileSink(
+                output_path(self.host, output_file, self.date))
+            sinks.append(file_sink)
+        if self.metrics and sinks:
+            sinks = [self.metrics.sink(self.host, TeeSink(*sinks))]
+        sink = TeeSink(self.ring, *sinks)
+
+        lines = [line for line in lines if line]
+        try:
+            if self.pipeline and self.comment:
+                lines = self.send_pipelined(sink, lines)
+            prompt = re.compile(self.prompt, re.DOTALL)
+            for line in lines:
+                self.logger.info("Executing on %s: %s" % (self.host, line))
+                if self.metrics:
+                    started = self.metrics.now()
+                self.device.sendline('{0}{1}'.format(line, self.extra_return))
+                sink.begin(line)
+                self.read_until(prompt, sink)
+                sink.end()
+                if self.metrics:
+                    self.metrics.observe('command', self.host,
+                                         self.metrics.now() - started, line)
+        finally:
+            if output_file:
+                file_sink.close()
+
+    def send_pipelined(self, sink, lines):
+        """Write commands in windows of self.pipeline without waiting
+        for the prompt between them, then split the returned stream on
+        prompt boundaries.
+
+        The prompt patterns in params_by_dev_type are anchored to the end
+        of the buffer, which never happens while typed-ahead commands are
+        being echoed, and prompt-like text can turn up in any output.  So
+        each command is followed by a comment line holding a marker made
+        up for the batch, and the stream is split on the prompt the
+        device echoes that marker at.  Every chunk must start with the
+        echo of its command.  If one does not, the rest of the window is
+        drained and the remaining lines are returned to be run in
+        lock-step; nothing is ever sent twice.
+        """
+        prompt = self.prompt.rstrip('$')
+        # Start with a single command to check the echo can be parsed
+        window = 1
+        while lines:
+            batch, lines = lines[:window], lines[window:]
+            window = self.pipeline
+            token = binascii.hexlify(os.urandom(8))
+            markers = ['%s run_cli %s %d' % (self.comment, token, number)
+                       for number in range(len(batch))]
+            for line in batch:
+                self.logger.info("Executing on %s: %s" % (self.host, line))
+            if self.metrics:
+                started = self.metrics.now()
+            self.device.send(''.join(
+                '{0}{2}\n{1}{2}\n'.format(line, marker, self.extra_return)
+                for line, marker in zip(batch, markers)))
+            parsed = True
+            for line, marker in zip(batch, markers):
+                # The prompt in front of the marker ends the command's
+                # output, the one after it is where the next is typed
+                separator = re.compile('([^\r\n]*?)%s%s.*?%s' % (
+                    prompt, re.escape(marker), prompt), re.DOTALL)
+                sink.begin(line)
+                match = self.read_until(separator, sink)
+                sink.write(match.group(1))
+                sink.end()
+                # Commands in a window overlap, each is timed from the
+                # end of the one before it
+                if self.metrics:
+                    finished = self.metrics.now()
+                    self.metrics.observe('command', self.host,
+                                         finished - started, line)
+                    started = finished
+                if not (self.head + match.group(1)).lstrip().startswith(line):
+                    parsed = False
+            if not parsed:
+                self.logger.warning(
+                    'Could not parse command echo from %s, '
+                    'falling back to lock-step' % self.host)
+                break
+        return lines
+
+def output_filename(command):
+    """Turn a command into something safe to use in a filename"""
+    filename = re.sub(r'\s+|/', '_', command)
+    return re.sub(r'\|', 'pipe', filename)
+
+def output_path(host, output_file, date):
+    return '%s/logs/%s_%s_%s.txt' % (
+        os.path.expanduser('~'), host, output_file, date)
 
 def check_cli_args():
     logger = logging.getLogger(__name__)
@@ -185,6 +365,14 @@ def check_cli_args():
         '-t', '--type', type=str, help='device type arista', required=True,
         choices=['arista', 'force10', 'hp_apm', 'junos', 'yaml', 'cisco'])
 
+    parser.add_argument(
+        '--only_type', type=str,
+        help='Only run against devices of these types, comma separated')
+    parser.add_argument(
+        '-m', '--match', type=str,
+        help='Only run against devices whose address or hostname matches '
+             'this shell style pattern')
+
     parser.add_argument(
         '-i', '--debug', type=int, default=20,
         help='10 = Debug, 20 = Info, 30 = Warning, 40 = Error, 50 = Critical')
@@ -192,25 +380,112 @@ def check_cli_args():
         '-w', '--write_cli', action='store_true',
         help='Create individual files with command outout')
 
+    parser.add_argument(
+        '-a', '--archive', action='store_true',
+        help='Store command output in a single indexed archive per run '
+             'instead of a file per command')
+    parser.add_argument(
+        '-z', '--compress', action='store_true',
+        help='Compress the output stored with --archive')
+    parser.add_argument(
+        '-r', '--history', action='store_true',
+        help='Record de-duplicated output history, see history.py for '
+             'what changed between runs')
+    parser.add_argument(
+        '--cache', action='store_true',
+        help='Reuse recent output of read-only commands, hosts with '
+             'every command cached are not logged into')
+    parser.add_argument(
+        '--no_cache', action='store_true',
+        help='Ignore --cache for this run')
+    parser.add_argument(
+        '--max_age', type=int, default=None,
+        help='Only reuse cached output younger than this many seconds')
+    parser.add_argument(
+        '--cache_size', type=int, default=256,
+        help='Size in MB the cache is trimmed to after a run')
+    parser.add_argument(
+        '--no_transcript', action='store_true',
+        help='Do not write a full session transcript per device')
+
     parser.add_argument(
         '-s', '--ssh_key', type=str,
         help='Private key to use for authentication', default=None)
     parser.add_argument(
         '--timeout', type=int,
         help='CLI timeout for expect in seconds', default=180)
+    parser.add_argument(
+        '-n', '--workers', type=int, default=1,
+        help='Number of devices to run against concurrently')
+    parser.add_argument(
+        '-S', '--schedule', action='store_true',
+        help='Record per host latency and start the slowest hosts first')
+    parser.add_argument(
+        '--retries', type=int, default=0,
+        help='Times to retry a login that timed out or was dropped')
+    parser.add_argument(
+        '--deadline', type=int, default=None,
+        help='Seconds the whole run may take, waits are cut short and no '
+             'new hosts are started after it')
+    parser.add_argument(
+        '--parse', action='store_true',
+        help='Parse output with the templates for each dev_type into '
+             'tables under ~/logs/parsed_<date>')
+    parser.add_argument(
+        '--parse_format', type=str, default='jsonl', choices=['jsonl', 'csv'],
+        help='Format of the parsed tables')
+    parser.add_argument(
+        '--templates', type=str, default=None,
+        help='YAML file of extra parsing templates per dev_type')
+    parser.add_argument(
+        '--metrics', type=str, default=None,
+        help='Time each session phase and write the results to '
+             '<METRICS>.json and Prometheus text <METRICS>.prom')
+    parser.add_argument(
+        '--journal', type=str, default=None,
+        help='Journal each finished command and host to this file, '
+             'default one per device list and command set')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Skip the hosts and commands the journal shows finished')
+    parser.add_argument(
+        '--new_journal', action='store_true',
+        help='Start the journal over even if its run was interrupted')
+    parser.add_argument(
+        '-p', '--pool', action='store_true',
+        help='Keep SSH sessions open between runs and reuse them')
+    parser.add_argument(
+        '--pool_idle', type=int, default=600,
+        help='Seconds a pooled session may sit idle before it is closed')
+    parser.add_argument(
+        '--pool_max', type=int, default=512,
+        help='Maximum number of pooled sessions kept open')
+    parser.add_argument(
+        '--pool_flush', action='store_true',
+        help='Close every pooled session before running')
+    parser.add_argument(
+        '--pipeline', type=int, default=0,
+        help='Send up to this many commands at a time without waiting '
+             'for the prompt in between, 0 waits after every command')
+    parser.add_argument(
+        '--output_buffer', type=int, default=1024 * 1024,
+        help='Bytes of output per device kept in memory, the rest is '
+             'only streamed to --write_cli files')
+    parser.add_argument(
+        '-e', '--engine', type=str, default='pexpect',
+        choices=['pexpect', 'event'],
+        help='pexpect runs one blocking session per worker, event drives '
+             'up to --workers sessions from a single event loop')
 
     args = parser.parse_args()
+    if args.pipeline and args.engine == 'event':
+        parser.error('--pipeline is not supported by --engine event')
 
     # Convert the ; delminated fields to list
     if args.device:
         tmp = args.device.split(';')
         args.device = [dev.strip() for dev in tmp]
 
-    elif args.device_list:
-        with open(args.device_list) as raw_file:
-            contents = (raw_file.read()).split('\n')
-            #args.device = (raw_file.read()).split('\n')
-        args.device = [host.split(',')[0] for host in contents]
     if args.commands:
         tmp = args.commands.split(';')
         args.commands = [cmd.strip() for cmd in tmp]
@@ -220,6 +495,227 @@ def check_cli_args():
             args.commands = (raw_file.read()).split('\n')
     return args
 
+def device_sink(args, host, date, stores, extra=()):
+    """Sink for a host's output given the output options in use.
+
+    stores are the run-wide output stores (archive, history) and each
+    provides its own sink for the host.  extra sinks are added as is.
+    """
+    sinks = [store.sink(host) for store in stores] + list(extra)
+    if args.write_cli and not args.archive:
+        # Stream each command's output straight into its own file
+        sinks.append(CommandFileSink(lambda command: output_path(
+            host, output_filename(command), date)))
+    if not sinks:
+        return None
+    return TeeSink(*sinks)
+
+def journal_path(args):
+    """Default journal for the device list and commands being run"""
+    source = args.yaml or args.device_list or ';'.join(args.device or [])
+    key = '\0'.join([os.path.abspath(source) if args.yaml or
+                     args.device_list else source] +
+                    [command for command in args.commands or [] if command])
+    return '%s/logs/journal/%s.journal' % (
+        os.path.expanduser('~'),
+        hashlib.sha1(key.encode('utf-8')).hexdigest()[:20])
+
+def typed_sinks(host, dev_type, cache=None, structured=None):
+    """Sinks that need the host's dev_type as well as its name"""
+    sinks = []
+    if cache:
+        sinks.append(cache.sink(host, dev_type))
+    if structured:
+        sinks.append(structured.sink(host, dev_type))
+    return sinks
+
+def replay_cached(args, host, outputs, stores, extra=()):
+    """Feed cached (command, output) pairs through the host's sinks as
+    if they had just been run.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('Serving %d cached outputs for %s' % (len(outputs), host))
+    sink = device_sink(
+        args, host, datetime.now().strftime('%Y-%m-%d-%H%M'), stores, extra)
+    for command, output in outputs:
+        logger.debug(output)
+        if sink:
+            sink.begin(command)
+            sink.write(output)
+            sink.end()
+    if sink:
+        sink.close()
+
+def transient(error):
+    """Whether a login failure is worth retrying: timeouts and dropped
+    connections are, bad credentials or a changed host key are not.
+    """
+    return isinstance(error, (pexpect.TIMEOUT, pexpect.EOF, LoginTimeout))
+
+def run_device(args, password, host, dev_type, commands, pool=None,
+               stores=(), cache=None, deadline=None, latency=None,
+               metrics=None, structured=None):
+    """Log into a single host and run its commands.
+
+    Returns a (host, error) tuple where error is None on success so
+    that one host failing never affects the others in a worker pool.
+    Commands fresh in the cache are served from it, and hosts with
+    nothing left to run are not logged into.
+    Only the login is retried; commands are never sent twice.
+    """
+    logger = logging.getLogger(__name__)
+    if cache:
+        outputs, commands = cache.lookup(host, dev_type, commands)
+        if outputs:
+            try:
+                replay_cached(args, host, outputs, stores, typed_sinks(
+                    host, dev_type, structured=structured))
+            except Exception as error:
+                logger.critical('%s: %s' % (host, error))
+                return host, error
+        if not commands:
+            return host, None
+    if deadline and deadline.expired:
+        error = pexpect.TIMEOUT('Run deadline reached before starting')
+        logger.critical('%s: %s' % (host, error))
+        return host, error
+
+    def connect():
+        return Connect(
+            host,
+            dev_type,
+            'ssh',
+            args.username,
+            password,
+            args.ssh_key,
+            args.timeout,
+            pool=pool,
+            pipeline=args.pipeline,
+            ring_bytes=args.output_buffer,
+            transcript=not args.no_transcript,
+            deadline=deadline,
+            metrics=metrics)
+
+    started = datetime.now()
+    try:
+        device = retry(connect, args.retries, transient, deadline, host,
+                       logger)
+    except Exception as error:
+        logger.critical('%s: %s' % (host, error))
+        if latency:
+            latency.record(host, (datetime.now() - started).total_seconds())
+        return host, error
+    login = (datetime.now() - started).total_seconds()
+
+    try:
+        device.connect.sink = device_sink(
+            args, host, device.connect.date, stores,
+            typed_sinks(host, dev_type, cache, structured))
+        started = datetime.now()
+        device.connect.send(None, *commands)
+        logger.debug(device.connect.output)
+        if latency:
+            sent = len([command for command in commands if command]) or 1
+            latency.record(host, login, (
+                datetime.now() - started).total_seconds() / sent)
+    except Exception as error:
+        logger.critical('%s: %s' % (host, error))
+        if latency:
+            latency.record(host, login)
+        return host, error
+    finally:
+        # Sinks are closed even when a command failed part way
+        try:
+            if device.connect.sink:
+                device.connect.sink.close()
+        finally:
+            device.close()
+            logger.info('Closing connection to %s' % host)
+    return host, None
+
+def collect(results):
+    """dict of the (host, error) pairs from a pool's imap iterator.
+
+    Waits with a timeout so Ctrl-C is not held off until every host
+    has finished.
+    """
+    collected = {}
+    while True:
+        try:
+            host, error = results.next(timeout=1)
+        except StopIteration:
+            return collected
+        except TimeoutError:
+            continue
+        collected[host] = error
+
+def run_event_engine(args, password, jobs, pool=None, stores=(), cache=None,
+                     deadline=None, latency=None, metrics=None,
+                     structured=None):
+    """Run every job from a single ssh_engine event loop.
+
+    Returns the same host to error mapping as the worker pool.
+    """
+    from ssh_engine import Engine, Session
+
+    logger = logging.getLogger(__name__)
+    engine = Engine(max_sessions=args.workers, logger=logger,
+                    deadline=deadline, retries=args.retries,
+                    transient=transient)
+    results = {}
+    for host, dev_type, commands in jobs:
+        expect_params = params_by_dev_type.get(dev_type.lower())
+        if expect_params is None:
+            error = ValueError("%s not yet supported" % dev_type)
+            logger.critical('%s: %s' % (host, error))
+            results[host] = error
+            continue
+        if cache:
+            outputs, commands = cache.lookup(host, dev_type, commands)
+            if outputs:
+                try:
+                    replay_cached(args, host, outputs, stores, typed_sinks(
+                        host, dev_type, structured=structured))
+                except Exception as error:
+                    logger.critical('%s: %s' % (host, error))
+                    results[host] = error
+                    continue
+            if not commands:
+                results[host] = None
+                continue
+        session = Session(
+            host,
+            args.username,
+            password,
+            args.ssh_key,
+            args.timeout,
+            commands,
+            expect_params.get('prompt'),
+            expect_params.get('extra_return', ""),
+            ssh_options=pool.lease(host, args.username) if pool else '',
+            ring_bytes=args.output_buffer,
+            transcript=not args.no_transcript,
+            run_deadline=deadline,
+            metrics=metrics,
+            logger=logger)
+        session.sink = device_sink(
+            args, host, session.date, stores,
+            typed_sinks(host, dev_type, cache, structured))
+        engine.add(session)
+
+    for session in engine.run():
+        logger.debug(session.output)
+        results[session.host] = session.error
+        if latency and session.started is not None:
+            if session.logged_in:
+                latency.record(session.host, session.login_seconds, (
+                    sum(session.command_seconds) /
+                    len(session.command_seconds)
+                    if session.command_seconds else None))
+            else:
+                latency.record(session.host, session.elapsed)
+    return results
+
 def main():
 
     # Check CLI arguments
@@ -254,78 +750,163 @@ def main():
     bad_devices = []
     # Loop through device list
 
+    # Inventories are compiled once and cached until the file changes
     if args.yaml:
-        with open(args.yaml) as raw:
-            devices = yaml.load(raw)
+        inventory = load_yaml(args.yaml)
+    elif args.device_list:
+        inventory = load_csv(args.device_list)
     else:
-        devices = args.device
-        commands = args.commands
-
-    for host in devices:
-
-        if not host or host.lower() == 'default':
-            continue
-
-        if args.yaml:
-            # Get the lists of commands
-            raw_commands = devices[host]
-
-            # Get the device_type
-            dev_type = devices[host]['type']
-
-            # Check to see if we have commands specified
-            if 'commands' not in raw_commands \
-            and 'global_commands' not in raw_commands:
-                # this would indicate that neither the commands
-                # nor global commands are present
-                logger.critical('YAML file must define commands'
-                                'for a host or global_commands for default')
-
-            elif 'commands' in raw_commands \
-            and 'global_commands' in raw_commands:
-                commands = raw_commands['global_commands'] + raw_commands['commands']
-
-            elif 'commands' in raw_commands:
-                commands = raw_commands['commands']
-
-            elif 'global_commands' in raw_commands:
-                commands = raw_commands['global_commands']
-
-        else:
-            dev_type = args.type
-            commands = args.commands
+        inventory = Inventory()
+        for host in args.device:
+            if host:
+                inventory.add(host, None, args.type, None)
+    for error in inventory.errors:
+        logger.critical(error)
+
+    types = args.only_type.split(',') if args.only_type else None
+    jobs = []
+    for host, dev_type, commands in inventory.select(
+            types, args.match, args.type):
+        # CSV and -d devices fall back to the command line type/commands
+        jobs.append((
+            host,
+            dev_type or args.type,
+            args.commands if commands is None else commands))
+
+    # Resumable runs journal every finished command, a resumed run only
+    # gets the hosts and commands the journal has not seen finish
+    journal = None
+    if args.journal or args.resume:
+        from journal import Journal
         try:
-            device = Connect(
-                host,
-                dev_type,
-                'ssh',
-                args.username,
-                password,
-                args.ssh_key,
-                args.timeout)
+            journal = Journal(args.journal or journal_path(args),
+                              resume=args.resume, overwrite=args.new_journal)
         except ValueError as error:
-            logger.critical(error)
-            bad_devices.append(host)
-            continue
-
-        if not args.write_cli:
-            device.connect.send(None, *commands)
-            logger.debug(device.connect.output)
+            logger.critical('%s, use --resume to continue it or '
+                            '--new_journal to start it over' % error)
+            sys.exit(1)
+        logger.info('Journalling to %s' % journal.path)
+        total = len(jobs)
+        jobs = list(journal.pending(jobs))
+        if args.resume:
+            logger.info('Resuming %d of %d hosts' % (len(jobs), total))
+
+    pool = None
+    if args.pool:
+        from session_pool import SessionPool
+        pool = SessionPool(idle_timeout=args.pool_idle,
+                           max_sessions=args.pool_max)
+        if args.pool_flush:
+            pool.flush()
+
+    stores = []
+    if args.archive:
+        from archive import Archive
+        archive = Archive(
+            '%s/logs/run_cli_%s' % (
+                os.path.expanduser('~'),
+                datetime.now().strftime('%Y-%m-%d-%H%M%S')),
+            compress=args.compress)
+        logger.info('Storing output in %s' % archive.data_path)
+        stores.append(archive)
+    if args.history:
+        from history import History
+        history = History()
+        logger.info('Recording output history as run %s' % history.run)
+        stores.append(history)
+    if journal:
+        stores.append(journal)
+
+    # Parse output into per template tables as it streams in
+    structured = None
+    if args.parse:
+        from structured import StructuredOutput, load_templates
+        structured = StructuredOutput(
+            '%s/logs/parsed_%s' % (
+                os.path.expanduser('~'),
+                datetime.now().strftime('%Y-%m-%d-%H%M%S')),
+            args.parse_format,
+            load_templates(args.templates) if args.templates else None)
+        logger.info('Writing parsed output to %s' % structured.directory)
+
+    cache = None
+    if args.cache and not args.no_cache:
+        from cache import ResultCache
+        cache = ResultCache(max_bytes=args.cache_size * 1024 * 1024,
+                            max_age=args.max_age)
+
+    # Start the historically slowest hosts first and stop starting new
+    # ones once the run deadline passes
+    deadline = Deadline(args.deadline)
+    latency = None
+    if args.schedule:
+        latency = LatencyHistory()
+        jobs = latency.order(jobs)
+
+    metrics = None
+    if args.metrics:
+        from metrics import Metrics
+        metrics = Metrics()
+
+    def run(job):
+        host, error = run_device(
+            args, password, *job, pool=pool, stores=stores, cache=cache,
+            deadline=deadline, latency=latency, metrics=metrics,
+            structured=structured)
+        if journal and error is None:
+            journal.host_done(host)
+        return host, error
+
+    try:
+        if args.engine == 'event':
+            results = run_event_engine(args, password, jobs, pool, stores,
+                                       cache, deadline, latency, metrics,
+                                       structured)
+            if journal:
+                for host, error in results.items():
+                    if error is None:
+                        journal.host_done(host)
+
+        # Fan out across a bounded pool of workers; each host runs
+        # independently and reports back its own result
+        elif args.workers > 1:
+            workers = ThreadPool(min(args.workers, len(jobs) or 1))
+            try:
+                results = collect(workers.imap_unordered(run, jobs))
+            except KeyboardInterrupt:
+                # Drop the queued hosts, only the running ones finish
+                workers.terminate()
+                raise
+            finally:
+                workers.close()
+                workers.join()
         else:
-            for command in commands:
-                if not command:
-                    continue
-                filename = re.sub(r'\s+|/', '_', command)
-                filename = re.sub(r'\|', 'pipe', filename)
-                device.connect.send(filename, command)
-                logger.debug(device.connect.output)
-
-        device.close()
-        logger.info('Closing connection to %s' % host)
+            results = dict(run(job) for job in jobs)
+        if journal:
+            journal.finish()
+    finally:
+        # Whatever finished before an interrupt is kept for --resume
+        if journal:
+            journal.close()
+        if structured:
+            structured.close()
+
+    for host, dev_type, commands in jobs:
+        if results[host] is not None:
+            bad_devices.append(host)
 
     for device in bad_devices:
         logger.critical("Could not connect to %s" % device)
 
+    if cache:
+        cache.prune()
+    if latency:
+        latency.save()
+    if metrics:
+        metrics.save(args.metrics)
+        logger.info('Wrote session metrics to %s.json and %s.prom' % (
+            args.metrics, args.metrics))
+
 if __name__ == '__main__':
     main()
     #try:
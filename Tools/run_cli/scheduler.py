@@ -0,0 +1,125 @@
+#!/usr/bin/env python2.7
+"""Scheduling helpers for run_cli fleet runs.
+
+LatencyHistory remembers how long each host took to log into and to
+run a command, smoothed across runs, so the slowest hosts can be started
+first (longest processing time first keeps one slow straggler from
+landing at the very end of a run).  Deadline caps every wait in a run
+so the whole run has a predictable worst case, and retry() retries
+transient failures with jittered exponential backoff.
+"""
+
+import errno
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+class Deadline(object):
+    """An absolute point in time the whole run has to finish by"""
+    def __init__(self, seconds=None):
+        self.end = time.time() + seconds if seconds is not None else None
+
+    def remaining(self):
+        if self.end is None:
+            return None
+        return max(0, self.end - time.time())
+
+    @property
+    def expired(self):
+        return self.end is not None and time.time() >= self.end
+
+    def cap(self, timeout):
+        """timeout, shortened if the deadline comes first"""
+        if self.end is None:
+            return timeout
+        return min(timeout, self.remaining())
+
+class LatencyHistory(object):
+    """Per host login and per command latency, as exponentially weighted
+    moving averages kept in a JSON file between runs.
+    """
+    def __init__(self, path=None, alpha=0.3):
+        self.path = path or os.path.join(
+            os.path.expanduser('~'), '.cache', 'run_cli', 'latency.json')
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as raw:
+                self.hosts = json.load(raw)
+        except (IOError, ValueError):
+            self.hosts = {}
+
+    def record(self, host, login, command=None):
+        """Fold one run's login and mean command seconds into history"""
+        with self.lock:
+            entry = self.hosts.setdefault(host, {})
+            for key, value in (('login', login), ('command', command)):
+                if value is None:
+                    continue
+                if key in entry:
+                    value = self.alpha * value + (1 - self.alpha) * entry[key]
+                entry[key] = round(value, 3)
+
+    def estimate(self, host, commands):
+        entry = self.hosts.get(host)
+        if entry is None:
+            return None
+        return entry.get('login', 0) + entry.get('command', 0) * len(
+            [command for command in commands if command])
+
+    def order(self, jobs):
+        """Jobs sorted slowest first.
+
+        Hosts with no history are assumed to take the median time.
+        """
+        estimates = [self.estimate(job[0], job[2] or []) for job in jobs]
+        known = sorted(estimate for estimate in estimates
+                       if estimate is not None)
+        median = known[len(known) // 2] if known else 0
+        ranked = sorted(
+            zip(estimates, range(len(jobs))),
+            key=lambda pair: (-(median if pair[0] is None else pair[0]),
+                              pair[1]))
+        return [jobs[index] for estimate, index in ranked]
+
+    def save(self):
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp, 'w') as raw:
+                json.dump(self.hosts, raw)
+            os.rename(tmp, self.path)
+
+class LoginTimeout(ValueError):
+    """A device never got as far as a prompt, worth retrying"""
+
+def backoff(attempt, base=1.0, cap=30.0):
+    """Seconds to wait before retry number attempt (from 0), full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def retry(func, retries, transient, deadline=None, label='', logger=None):
+    """Call func, retrying up to retries times when it raises an error
+    that transient(error) accepts and the deadline leaves time to wait.
+    """
+    logger = logger or logging.getLogger(__name__)
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as error:
+            if attempt >= retries or not transient(error):
+                raise
+            delay = backoff(attempt)
+            if deadline is not None and deadline.end is not None \
+            and delay >= deadline.remaining():
+                raise
+            logger.warning('%s: %s, retrying in %.1fs' % (label, error, delay))
+            time.sleep(delay)
+            attempt += 1
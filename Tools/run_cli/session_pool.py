@@ -0,0 +1,97 @@
+#!/usr/bin/env python2.7
+"""Persistent SSH master connections shared between run_cli invocations.
+
+The first session to a host becomes an OpenSSH ControlMaster that stays
+up in the background after run_cli exits.  Later sessions to the same
+host are multiplexed over it, so they skip the handshake and login
+entirely and go straight to the device prompt.
+
+Masters exit on their own once idle for idle_timeout seconds
+(ControlPersist).  The pool caps the number of live masters at
+max_sessions by shutting down the least recently leased ones.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+
+class SessionPool(object):
+    def __init__(self, directory=None, idle_timeout=600, max_sessions=512):
+        self.directory = directory or os.path.join(
+            os.path.expanduser('~'), '.ssh', 'run_cli')
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        # Masters this process has asked for that may not be up yet
+        self.leased = set()
+        try:
+            os.makedirs(self.directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def control_path(self, host, username):
+        # Hash the name, unix socket paths are limited to ~100 characters
+        key = hashlib.sha1(('%s@%s' % (username, host)).encode('utf-8'))
+        return os.path.join(self.directory, key.hexdigest()[:20])
+
+    def ssh_options(self, host, username):
+        """Options that make ssh reuse or start a master for this host"""
+        return ('-o ControlMaster=auto -o ControlPath=%s '
+                '-o ControlPersist=%d' % (
+                    self.control_path(host, username), self.idle_timeout))
+
+    def lease(self, host, username):
+        """Reserve a slot for host and return the ssh options to use it.
+
+        Leasing marks the master as recently used.  If the host has no
+        master yet and the pool is full, the least recently leased
+        masters are shut down to make room.
+        """
+        path = self.control_path(host, username)
+        with self.lock:
+            if os.path.exists(path):
+                os.utime(path, None)
+            elif path not in self.leased:
+                masters = self.masters()
+                live = len(self.leased.union(masters))
+                for stale in masters[:max(0, live - self.max_sessions + 1)]:
+                    self.stop(stale)
+            self.leased.add(path)
+        return self.ssh_options(host, username)
+
+    def masters(self):
+        """Control sockets in the pool, least recently leased first"""
+        masters = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path in self.leased:
+                continue
+            try:
+                masters.append((os.stat(path).st_mtime, path))
+            except OSError:
+                # Master exited between listdir and stat
+                continue
+        return [path for mtime, path in sorted(masters)]
+
+    def stop(self, path):
+        """Shut down the master listening on a control socket"""
+        self.logger.debug('Evicting pooled session %s' % path)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(
+                ['ssh', '-o', 'ControlPath=%s' % path, '-O', 'exit', 'pool'],
+                stdout=devnull, stderr=devnull)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def flush(self):
+        """Shut down every master in the pool"""
+        with self.lock:
+            for path in self.masters():
+                self.stop(path)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python2.7
+"""Destinations for command output as it streams in from a device.
+
+SSH.send() and the event engine hand each sink the output of a command
+in chunks as it arrives, bracketed by begin(command) and end(), instead
+of building the whole transcript up in memory.
+"""
+
+import collections
+
+class Sink(object):
+    """Discards everything; base class for the other sinks"""
+    def begin(self, command):
+        pass
+
+    def write(self, data):
+        pass
+
+    def end(self):
+        pass
+
+    def close(self):
+        pass
+
+    def getvalue(self):
+        return ''
+
+class RingSink(Sink):
+    """Keeps only the last max_bytes of output in memory"""
+    def __init__(self, max_bytes=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def write(self, data):
+        if not data:
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size - len(self.chunks[0]) >= self.max_bytes:
+            self.size -= len(self.chunks.popleft())
+
+    def getvalue(self):
+        return ''.join(self.chunks)[-self.max_bytes:]
+
+class FileSink(Sink):
+    """Writes all output to a single file"""
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+
+    def write(self, data):
+        if self.handle is None:
+            self.handle = open(self.path, 'w+')
+        self.handle.write(data)
+
+    def close(self):
+        if self.handle is None:
+            self.handle = open(self.path, 'w+')
+        self.handle.write("\n")
+        self.handle.close()
+        self.handle = None
+
+class CommandFileSink(Sink):
+    """Writes the output of each command to its own file.
+
+    path_for is called with the command to get the file name.
+    """
+    def __init__(self, path_for):
+        self.path_for = path_for
+        self.current = None
+
+    def begin(self, command):
+        self.current = FileSink(self.path_for(command))
+
+    def write(self, data):
+        self.current.write(data)
+
+    def end(self):
+        self.current.close()
+        self.current = None
+
+    def close(self):
+        if self.current is not None:
+            self.end()
+
+class CallbackSink(Sink):
+    """Calls callback(command, data) for every chunk of output"""
+    def __init__(self, callback):
+        self.callback = callback
+        self.command = None
+
+    def begin(self, command):
+        self.command = command
+
+    def write(self, data):
+        self.callback(self.command, data)
+
+class TeeSink(Sink):
+    """Passes output on to several sinks at once"""
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def begin(self, command):
+        for sink in self.sinks:
+            sink.begin(command)
+
+    def write(self, data):
+        for sink in self.sinks:
+            sink.write(data)
+
+    def end(self):
+        for sink in self.sinks:
+            sink.end()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
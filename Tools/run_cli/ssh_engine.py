@@ -0,0 +1,428 @@
+#!/usr/bin/env python2.7
+"""Single threaded event loop for driving many SSH sessions at once.
+
+The SSH class in run_cli blocks in expect() for every prompt, so each
+device needs its own thread.  The engine here keeps one non-blocking
+state machine per device and drives all of them from a single poll()
+loop, following the same login flow and prompt handling as SSH.login()
+and SSH.send().
+"""
+
+import errno
+import logging
+import os
+import re
+import select
+import signal
+import time
+
+import pexpect
+
+from datetime import datetime
+from scheduler import LoginTimeout, backoff
+from sinks import RingSink, TeeSink
+
+SSH_NEWKEY = 'Are you sure you want to continue connecting'
+
+# Session states
+LOGIN, NEWKEY, PASSWORD, READY, COMMAND, DONE, FAILED = range(7)
+
+class Session(object):
+    """Login and command state for a single device.
+
+    The session never blocks: the engine feeds it whatever the device
+    sent with feed() and calls check_timeout() as time passes.  Command
+    output is streamed into sink as it arrives, holding back only enough
+    to find the prompt.  Once the session reaches DONE or FAILED,
+    completed counts the commands that finished and error holds the
+    failure, if any.
+    """
+    def __init__(self, host, username, password, ssh_key, timeout,
+                 commands, prompt, extra_return='', login_timeout=30,
+                 spawn_command=None, delaybeforesend=.0250, ssh_options='',
+                 sink=None, ring_bytes=1024 * 1024, window=4096,
+                 transcript=True, run_deadline=None, metrics=None,
+                 logger=None):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.ssh_key = ssh_key
+        self.timeout = timeout
+        self.login_timeout = login_timeout
+        self.commands = [line for line in commands if line]
+        self.prompt = prompt
+        self.extra_return = extra_return
+        self.spawn_command = spawn_command
+        self.ssh_options = ssh_options
+        self.delaybeforesend = delaybeforesend
+        self.sink = sink
+        self.ring = RingSink(ring_bytes)
+        self.window = window
+        self.transcript = transcript
+        self.run_deadline = run_deadline
+        self.metrics = metrics
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.date = datetime.now().strftime('%Y-%m-%d-%H%M')
+        self.attempts = 0
+        self.reset()
+
+    def reset(self):
+        """Forget everything about the last attempt, ready to start again"""
+        self.state = None
+        self.device = None
+        self.logfile = None
+        self.buffer = ''
+        self.patterns = []
+        self.deadline = None
+        self.pending = []
+        self.completed = 0
+        self.error = None
+        self.started = None
+        self.spawn_seconds = 0
+        self.timed_sink = None
+        self.login_seconds = None
+        self.command_started = None
+        self.command_seconds = []
+
+    @property
+    def fd(self):
+        return self.device.child_fd
+
+    @property
+    def elapsed(self):
+        """Seconds since the current attempt was started"""
+        return time.time() - self.started
+
+    @property
+    def logged_in(self):
+        return self.login_seconds is not None
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED)
+
+    @property
+    def output(self):
+        """The tail of the output of every command run so far"""
+        return self.ring.getvalue()
+
+    @property
+    def output_sink(self):
+        if self.sink is None:
+            return self.ring
+        return TeeSink(self.ring, self.timed_sink or self.sink)
+
+    def start(self):
+        """Spawn the ssh child and wait for the first login prompt"""
+        ssh = ' '.join(['ssh', self.ssh_options]).strip()
+        if self.spawn_command:
+            command = self.spawn_command
+        elif self.ssh_key:
+            command = '%s -i %s -l %s %s' % (
+                ssh, self.ssh_key, self.username, self.host)
+        else:
+            command = '%s -l %s %s' % (ssh, self.username, self.host)
+
+        self.logger.info('Connecting to %s' % self.host)
+        self.started = time.time()
+        self.device = pexpect.spawn(command)
+        # sendline() would sleep for this in the middle of the event loop,
+        # flush() already waits it out without blocking
+        self.device.delaybeforesend = None
+        self.spawn_seconds = time.time() - self.started
+        if self.metrics:
+            self.metrics.observe('spawn', self.host, self.spawn_seconds)
+            if self.sink is not None:
+                self.timed_sink = self.metrics.sink(self.host, self.sink)
+        logs = os.path.join(os.path.expanduser('~'), 'logs')
+        try:
+            os.makedirs(logs)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            if self.transcript:
+                self.logfile = open(
+                    '%s/%s_%s.txt' % (logs, self.host, self.date), 'w')
+                if self.metrics:
+                    self.logfile = self.metrics.logfile(
+                        self.host, self.logfile)
+        except IOError:
+            self.logger.critical('Could not open logfile for writing')
+            self.logger.critical('Continuing to execute without log')
+
+        self.expect(LOGIN, [SSH_NEWKEY, 'assword:', 'verification failed.',
+                            r'\$ $', self.prompt], self.login_timeout)
+
+    def expect(self, state, patterns, timeout):
+        self.state = state
+        self.patterns = [re.compile(pattern, re.DOTALL)
+                         for pattern in patterns]
+        if self.run_deadline:
+            timeout = self.run_deadline.cap(timeout)
+        self.deadline = time.time() + timeout
+        # The device may already have sent what we are waiting for
+        self.match()
+
+    def sendline(self, line):
+        """Queue a line, honouring delaybeforesend without sleeping"""
+        self.pending.append((time.time() + self.delaybeforesend, line))
+
+    def flush(self, now):
+        while self.pending and self.pending[0][0] <= now:
+            self.device.sendline(self.pending.pop(0)[1])
+
+    def next_event(self):
+        """Earliest time the engine needs to wake up for this session"""
+        if self.pending:
+            return min(self.deadline, self.pending[0][0])
+        return self.deadline
+
+    def feed(self, data):
+        if not isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        if self.logfile:
+            self.logfile.write(data)
+        if self.metrics and self.state == COMMAND:
+            self.metrics.received(self.host, len(data))
+        self.buffer += data
+        self.match()
+        # Nothing but the tail can hold an end anchored prompt, so
+        # stream the rest out instead of holding it until the prompt
+        if self.state == COMMAND and len(self.buffer) > self.window:
+            self.output_sink.write(self.buffer[:-self.window])
+            self.buffer = self.buffer[-self.window:]
+
+    def match(self):
+        """Act on the earliest pattern match in the buffer, like expect()"""
+        while not self.finished and self.patterns:
+            best = None
+            for index, pattern in enumerate(self.patterns):
+                found = pattern.search(self.buffer)
+                if found and (best is None or found.start() < best[1].start()):
+                    best = (index, found)
+            if best is None:
+                return
+            index, found = best
+            before = self.buffer[:found.start()]
+            self.buffer = self.buffer[found.end():]
+            self.on_match(index, before)
+
+    def on_match(self, index, before):
+        if self.state == LOGIN:
+            if index == 0: # SSH does not have the public key. Just accept it.
+                self.sendline('yes')
+                self.expect(NEWKEY, ['assword:'], self.login_timeout)
+            elif index == 1: # Got the password field
+                self.sendline(self.password)
+                self.expect(PASSWORD, [self.prompt, 'assword:'],
+                            self.login_timeout)
+            elif index == 2: # SSH key has changed
+                self.logger.error(before)
+                self.fail(ValueError('SSH key changed...exiting'))
+            else: # Hop box or ssh-key authentication
+                self.ready()
+
+        elif self.state == NEWKEY:
+            self.sendline(self.password)
+            self.expect(PASSWORD, [self.prompt, 'assword:'],
+                        self.login_timeout)
+
+        elif self.state == PASSWORD:
+            if index == 1:
+                self.logger.error('Device credentials do not work')
+                self.fail(ValueError('Device credentials do not work'))
+            else:
+                self.ready()
+
+        elif self.state == COMMAND:
+            sink = self.output_sink
+            sink.write(before)
+            sink.end()
+            self.command_seconds.append(time.time() - self.command_started)
+            if self.metrics:
+                self.metrics.observe('command', self.host,
+                                     self.command_seconds[-1],
+                                     self.commands[self.completed])
+            self.completed += 1
+            self.run_next()
+
+    def ready(self):
+        self.logger.info("Connected to %s" % self.host)
+        self.login_seconds = time.time() - self.started
+        if self.metrics:
+            self.metrics.observe('login', self.host,
+                                 self.login_seconds - self.spawn_seconds)
+        self.state = READY
+        self.run_next()
+
+    def run_next(self):
+        if self.completed == len(self.commands):
+            self.state = DONE
+            self.patterns = []
+            return
+        line = self.commands[self.completed]
+        self.logger.info("Executing on %s: %s" % (self.host, line))
+        self.command_started = time.time()
+        self.sendline('{0}{1}'.format(line, self.extra_return))
+        self.output_sink.begin(line)
+        self.expect(COMMAND, [self.prompt], self.timeout)
+
+    def check_timeout(self, now):
+        if not self.finished and now >= self.deadline:
+            if self.state == COMMAND:
+                self.fail(pexpect.TIMEOUT(
+                    'Timeout exceeded waiting for prompt'))
+            else:
+                self.logger.error('SSH could not login. Here is what SSH said:')
+                if self.buffer:
+                    self.logger.error(self.buffer)
+                self.fail(LoginTimeout('Device timed out'))
+
+    def fail(self, error):
+        self.state = FAILED
+        self.patterns = []
+        self.error = error
+
+    def close(self):
+        """Close the sinks and hang up on the ssh child without waiting
+        for it to exit.  Returns the child so it can be reaped later.
+        """
+        if self.sink is not None:
+            self.sink.close()
+        if self.logfile:
+            self.logfile.close()
+            self.logfile = None
+        if self.device is not None and self.device.isalive():
+            self.device.kill(signal.SIGHUP)
+        return self.device
+
+
+class Engine(object):
+    """Drives a set of Sessions to completion from one thread.
+
+    At most max_sessions ssh children are alive at once; the rest wait
+    in a queue and are started as running sessions finish.  Sessions
+    that fail to log in with an error transient(error) accepts are
+    started again after a backoff, up to retries times.  Nothing is
+    started once the run deadline has passed.
+    """
+    def __init__(self, max_sessions=256, logger=None, deadline=None,
+                 retries=0, transient=None):
+        self.max_sessions = max_sessions
+        self.logger = logger or logging.getLogger(__name__)
+        self.deadline = deadline
+        self.retries = retries
+        self.transient = transient or (lambda error: False)
+        self.queue = []
+        self.delayed = []
+        self.active = {}
+        self.exiting = []
+
+    def add(self, session):
+        self.queue.append(session)
+
+    def start_sessions(self, poller):
+        # Retries whose backoff is over go ahead of anything not started
+        now = time.time()
+        ready = [entry for entry in self.delayed if entry[0] <= now]
+        if ready:
+            self.delayed = [entry for entry in self.delayed if entry[0] > now]
+            self.queue[0:0] = [session for when, session in sorted(
+                ready, key=lambda entry: entry[0])]
+
+        while self.queue and len(self.active) < self.max_sessions:
+            session = self.queue.pop(0)
+            if self.deadline and self.deadline.expired:
+                session.fail(pexpect.TIMEOUT(
+                    'Run deadline reached before starting'))
+                self.finish(session, poller)
+                continue
+            try:
+                session.start()
+            except (ValueError, OSError, pexpect.ExceptionPexpect) as error:
+                session.fail(error)
+            if session.finished:
+                self.finish(session, poller)
+            else:
+                self.active[session.fd] = session
+                poller.register(session.fd, select.POLLIN)
+
+    def finish(self, session, poller):
+        if session.device is not None and session.fd in self.active:
+            poller.unregister(session.fd)
+            del self.active[session.fd]
+        device = session.close()
+        if device is not None:
+            self.exiting.append((time.time() + 5, device))
+        self.logger.info('Closing connection to %s' % session.host)
+        if session.error is None:
+            return
+        if not session.logged_in and session.attempts < self.retries \
+        and self.transient(session.error):
+            delay = backoff(session.attempts)
+            if not self.deadline or self.deadline.end is None \
+            or delay < self.deadline.remaining():
+                self.logger.warning('%s: %s, retrying in %.1fs' % (
+                    session.host, session.error, delay))
+                session.attempts += 1
+                session.reset()
+                self.delayed.append((time.time() + delay, session))
+                return
+        self.logger.critical('%s: %s' % (session.host, session.error))
+
+    def reap(self, wait=False):
+        """Close the children of finished sessions once they have exited.
+
+        Children still running after 5 seconds, or all of them when
+        wait is set, are closed anyway, which kills them if need be.
+        """
+        now = time.time()
+        exiting = []
+        for give_up, device in self.exiting:
+            if not device.isalive():
+                # Nothing left to wait for, so close() need not sleep
+                device.ptyproc.delayafterclose = 0
+            elif not wait and now < give_up:
+                exiting.append((give_up, device))
+                continue
+            device.close(force=True)
+        self.exiting = exiting
+
+    def run(self):
+        """Run every queued session, returning them once all are done"""
+        sessions = list(self.queue)
+        poller = select.poll()
+        self.start_sessions(poller)
+        while self.active or self.delayed:
+            now = time.time()
+            wake = min([s.next_event() for s in self.active.values()] +
+                       [when for when, session in self.delayed] +
+                       [now + 0.1 for exiting in self.exiting[:1]])
+            events = poller.poll(max(0, (wake - now) * 1000))
+
+            for fd, event in events:
+                session = self.active[fd]
+                try:
+                    session.feed(session.device.read_nonblocking(65536, 0))
+                except pexpect.EOF as error:
+                    if not session.finished:
+                        session.fail(error)
+                except pexpect.TIMEOUT:
+                    pass
+
+            now = time.time()
+            for session in list(self.active.values()):
+                if not session.finished:
+                    try:
+                        session.flush(now)
+                    except OSError as error:
+                        session.fail(error)
+                    session.check_timeout(now)
+                if session.finished:
+                    self.finish(session, poller)
+            self.start_sessions(poller)
+            self.reap()
+        self.reap(wait=True)
+        return sessions
@@ -0,0 +1,353 @@
+#!/usr/bin/env python2.7
+"""Parse run_cli output into records as it streams in.
+
+Each dev_type has a list of templates, each matching some commands and
+holding precompiled line patterns with named groups.  Lines are parsed
+as they arrive, so only the current line and the current record are
+held in memory.  Each record is appended, as soon as it is complete, to
+one file per template in <directory>, either JSON lines or CSV with one
+column per field, along with the host and dev_type it came from, so a
+command that never finishes leaves the records it completed.  Queries
+then only read the parsed tables instead of scanning raw output again:
+
+    structured.py ~/logs/parsed_2024-01-01-120000 ip_interfaces \\
+        -w status='*down'
+
+A template either turns every matching line into a record, merges all
+its matches into one record for the whole output (single), or starts a
+new record on each match of a start rule and fills it in from the lines
+after it.  More templates can be loaded from a YAML file:
+
+    cisco:
+      - name: arp
+        command: '^sh(ow)?\\s+(ip\\s+)?arp'
+        rules:
+          - '^Internet\\s+(?P<address>\\S+)\\s+\\S+\\s+(?P<mac>\\S+)'
+
+A rule can also be written as {pattern: ..., start: true}, and a
+template given single: true.
+
+Usage:
+    structured.py <directory> <table> [-w field=pattern] [-f fields]
+"""
+
+import argparse
+import csv
+import errno
+import fnmatch
+import json
+import os
+import re
+import sys
+import threading
+
+from sinks import Sink
+
+class Rule(object):
+    def __init__(self, pattern, start=False):
+        self.regex = re.compile(pattern)
+        self.start = start
+
+class Template(object):
+    def __init__(self, name, command, rules, single=False):
+        self.name = name
+        self.command = re.compile(command)
+        self.rules = [rule if isinstance(rule, Rule) else Rule(rule)
+                      for rule in rules]
+        self.single = single
+        self.grouped = any(rule.start for rule in self.rules)
+        self.fields = []
+        for rule in self.rules:
+            for field in sorted(rule.regex.groupindex,
+                                key=rule.regex.groupindex.get):
+                if field not in self.fields:
+                    self.fields.append(field)
+
+    def parser(self):
+        return LineParser(self)
+
+class LineParser(object):
+    """Turns the lines of one command's output into records"""
+    def __init__(self, template):
+        self.template = template
+        self.record = {} if template.single else None
+
+    def feed(self, line):
+        """Records completed by line"""
+        template = self.template
+        for rule in template.rules:
+            match = rule.regex.match(line)
+            if not match:
+                continue
+            fields = dict((field, value) for field, value
+                          in match.groupdict().items() if value is not None)
+            if template.single:
+                self.record.update(fields)
+                return []
+            if not template.grouped:
+                return [fields]
+            done = []
+            if rule.start:
+                if self.record:
+                    done.append(self.record)
+                self.record = fields
+            elif self.record is not None:
+                self.record.update(fields)
+            return done
+        return []
+
+    def close(self):
+        record, self.record = self.record, None
+        return [record] if record else []
+
+IP_INTERFACE_BRIEF = (
+    r'^(?P<interface>\S+(?: \d+(?:/\d+)+)?)\s+(?P<address>\S+)\s+'
+    r'(?P<ok>YES|NO)\s+(?P<method>\S+)\s+'
+    r'(?P<status>up|down|administratively down|deleted)\s+'
+    r'(?P<protocol>up|down)\s*$')
+
+INTERFACES_STATUS = (
+    r'^(?P<port>\S+)\s+(?P<name>.*?)\s*'
+    r'(?P<status>connected|notconnect|disabled|err-?disabled|inactive|'
+    r'monitoring|sfpAbsent|xcvrAbsent|noOperMem|suspended)\s+'
+    r'(?P<vlan>\S+)\s+(?P<duplex>\S+)\s+(?P<speed>\S+)\s*(?P<type>.*?)\s*$')
+
+templates_by_dev_type = dict(
+    cisco=[
+        Template('ip_interfaces', r'^sh(ow)?\s+ip\s+int(erface)?\s+br',
+                 [IP_INTERFACE_BRIEF]),
+        Template('interfaces_status', r'^sh(ow)?\s+int(erfaces?)?\s+st',
+                 [INTERFACES_STATUS]),
+        Template('version', r'^sh(ow)?\s+ver', [
+            r'^Cisco .*Software.*Version (?P<version>[^,\s]+)',
+            r'^(?P<hostname>\S+) uptime is (?P<uptime>.+?)\s*$',
+            r'^[Ss]ystem image file is "(?P<image>[^"]+)"',
+            r'^[Pp]rocessor board ID (?P<serial>\S+)',
+        ], single=True),
+    ],
+    arista=[
+        Template('ip_interfaces', r'^sh(ow)?\s+ip\s+int(erface)?\s+br', [
+            r'^(?P<interface>\S+)\s+(?P<address>\S+)\s+'
+            r'(?P<status>up|down|adminDown|administratively down)\s+'
+            r'(?P<protocol>up|down|lowerLayerDown|notPresent)\s+'
+            r'(?P<mtu>\d+)']),
+        Template('interfaces_status', r'^sh(ow)?\s+int(erfaces?)?\s+st',
+                 [INTERFACES_STATUS]),
+        Template('version', r'^sh(ow)?\s+ver', [
+            r'^Arista (?P<model>\S+)',
+            r'^Software image version:\s*(?P<version>\S+)',
+            r'^Serial number:\s*(?P<serial>\S+)',
+            r'^Uptime:\s*(?P<uptime>.+?)\s*$',
+        ], single=True),
+    ],
+    force10=[
+        Template('ip_interfaces', r'^sh(ow)?\s+ip\s+int(erface)?\s+br',
+                 [IP_INTERFACE_BRIEF]),
+        Template('version', r'^sh(ow)?\s+ver', [
+            r'^Dell Application Software Version:\s*(?P<version>\S+)',
+            r'^System Type:\s*(?P<model>\S+)',
+            r'^(?P<hostname>\S+) uptime is (?P<uptime>.+?)\s*$',
+        ], single=True),
+    ],
+    junos=[
+        Template('interfaces_terse', r'^show\s+interfaces\s+terse', [
+            r'^(?P<interface>[a-z]\S*)\s+(?P<admin>up|down)\s+'
+            r'(?P<link>up|down)(?:\s+(?P<proto>\S+))?'
+            r'(?:\s+(?P<local>\S+))?(?:\s+(?P<remote>\S+))?\s*$']),
+        Template('version', r'^show\s+ver', [
+            r'^Hostname:\s*(?P<hostname>\S+)',
+            r'^Model:\s*(?P<model>\S+)',
+            r'^(?:Junos:\s*|JUNOS .*\[)(?P<version>[^\]\s]+)',
+        ], single=True),
+    ],
+    root_unix=[
+        Template('filesystems', r'^df\b', [
+            r'^(?P<filesystem>\S+)\s+(?P<blocks>\d+)\s+(?P<used>\d+)\s+'
+            r'(?P<available>\d+)\s+(?P<capacity>\d+)%\s+'
+            r'(?P<mounted_on>.+?)\s*$']),
+    ],
+)
+
+def load_templates(path):
+    """Templates per dev_type from a YAML file, see the module docstring"""
+    import yaml
+    with open(path) as raw:
+        loaded = yaml.safe_load(raw) or {}
+    templates = {}
+    for dev_type, entries in loaded.items():
+        for entry in entries or []:
+            rules = [Rule(rule['pattern'], rule.get('start', False))
+                     if isinstance(rule, dict) else Rule(rule)
+                     for rule in entry['rules']]
+            templates.setdefault(dev_type.lower(), []).append(Template(
+                entry['name'], entry['command'], rules,
+                entry.get('single', False)))
+    return templates
+
+class StructuredOutput(object):
+    def __init__(self, directory, format='jsonl', templates=None):
+        self.directory = directory
+        self.format = format
+        # Templates loaded from a file are tried before the built in ones
+        self.templates = dict(
+            (dev_type, (templates or {}).get(dev_type, []) + builtin)
+            for dev_type, builtin in templates_by_dev_type.items())
+        for dev_type, extra in (templates or {}).items():
+            self.templates.setdefault(dev_type, extra)
+        # Templates of different dev_types can share a table, which then
+        # has the columns of all of them
+        self.columns = {}
+        for templates in self.templates.values():
+            for template in templates:
+                columns = self.columns.setdefault(
+                    template.name, ['host', 'dev_type'])
+                columns.extend(field for field in template.fields
+                               if field not in columns)
+        self.selected = {}
+        self.lock = threading.Lock()
+        self.tables = {}
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def template(self, dev_type, command):
+        """First template for dev_type that matches command, or None"""
+        key = (dev_type, command)
+        if key not in self.selected:
+            self.selected[key] = None
+            for template in self.templates.get(dev_type, []):
+                if template.command.match(command.strip()):
+                    self.selected[key] = template
+                    break
+        return self.selected[key]
+
+    def sink(self, host, dev_type):
+        """Sink that parses the output of each command run on host"""
+        return StructuredSink(self, host, dev_type.lower())
+
+    def write(self, template, host, dev_type, records):
+        """Append records of template to its table"""
+        columns = self.columns[template.name]
+        with self.lock:
+            table = self.tables.get(template.name)
+            if table is None:
+                path = os.path.join(self.directory, '%s.%s' % (
+                    template.name, self.format))
+                handle = open(path, 'a')
+                writer = None
+                if self.format == 'csv':
+                    writer = csv.writer(handle)
+                    if handle.tell() == 0:
+                        writer.writerow(columns)
+                table = self.tables[template.name] = (handle, writer)
+            handle, writer = table
+            for record in records:
+                record = dict(record, host=host, dev_type=dev_type)
+                if writer:
+                    writer.writerow([record.get(column, '')
+                                     for column in columns])
+                else:
+                    handle.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def close(self):
+        with self.lock:
+            for handle, writer in self.tables.values():
+                handle.close()
+            self.tables = {}
+
+class StructuredSink(Sink):
+    """Parses each command's output a line at a time as it arrives, and
+    appends each record to its table as soon as it is complete"""
+    def __init__(self, output, host, dev_type):
+        self.output = output
+        self.host = host
+        self.dev_type = dev_type
+        self.parser = None
+
+    def begin(self, command):
+        template = self.output.template(self.dev_type, command)
+        self.parser = template.parser() if template else None
+        self.partial = ''
+
+    def emit(self, records):
+        if records:
+            self.output.write(self.parser.template, self.host, self.dev_type,
+                              records)
+
+    def write(self, data):
+        if self.parser is None:
+            return
+        if isinstance(data, bytes) and not isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.emit(self.parser.feed(line.rstrip('\r')))
+
+    def end(self):
+        if self.parser is None:
+            return
+        if self.partial:
+            self.emit(self.parser.feed(self.partial.rstrip('\r')))
+        self.emit(self.parser.close())
+        self.parser = None
+
+    def close(self):
+        # The record a command that never finished was filling in is
+        # left out, the ones it completed are already in their tables
+        self.parser = None
+
+def read_table(path):
+    """Records from a parsed table, JSON lines or CSV"""
+    with open(path) as handle:
+        if path.endswith('.csv'):
+            for record in csv.DictReader(handle):
+                yield record
+        else:
+            for line in handle:
+                yield json.loads(line)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Query the parsed output of a run_cli run")
+    parser.add_argument(
+        'directory', type=str, help='Directory of parsed tables')
+    parser.add_argument(
+        'table', type=str, nargs='?',
+        help='Table to query, lists the tables when left out')
+    parser.add_argument(
+        '-w', '--where', type=str, action='append', default=[],
+        help='field=pattern, shell style, may be repeated')
+    parser.add_argument(
+        '-f', '--fields', type=str,
+        help='Comma separated fields to show, default all')
+    args = parser.parse_args()
+
+    if not args.table:
+        for name in sorted(os.listdir(args.directory)):
+            sys.stdout.write('%s\n' % os.path.splitext(name)[0])
+        return
+    path = None
+    for extension in ('jsonl', 'csv'):
+        candidate = os.path.join(args.directory, '%s.%s' % (
+            args.table, extension))
+        if os.path.exists(candidate):
+            path = candidate
+    if path is None:
+        sys.stderr.write('No table %s in %s\n' % (args.table, args.directory))
+        sys.exit(1)
+    where = [condition.split('=', 1) for condition in args.where]
+    fields = args.fields.split(',') if args.fields else None
+    for record in read_table(path):
+        if all(fnmatch.fnmatch(record.get(field) or '', pattern)
+               for field, pattern in where):
+            if fields:
+                sys.stdout.write('\t'.join(
+                    record.get(field) or '' for field in fields) + '\n')
+            else:
+                sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    main()